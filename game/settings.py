@@ -1,5 +1,7 @@
 # Django settings for game project.
 
+import os
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
@@ -21,6 +23,16 @@ DATABASES = {
     }
 }
 
+# A read replica of the default database, e.g. GAME_REPLICA=replica.db, serves
+# the GameProjection reads behind /status, see main.routers
+if os.environ.get('GAME_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['GAME_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_ROUTERS = ['main.routers.ReplicaRouter']
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -75,6 +87,9 @@ STATICFILES_DIRS = (
     'static',
 )
 
+# Directory that `manage.py build_sprites` writes the card sprite sheet to
+SPRITES_ROOT = 'sprites'
+
 # List of finder classes that know how to find static files in
 # various locations.
 STATICFILES_FINDERS = (
@@ -122,15 +137,47 @@ INSTALLED_APPS = (
     'django.contrib.sites',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    # Uncomment the next line to enable the admin:
-    'django.contrib.admin',
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'main',
 )
 
+# Importing the admin is most of the startup time, so workers and simulation
+# commands that never serve it can run with GAME_ADMIN=0. Admin modules are
+# discovered in game/urls.py, on the first request, rather than at startup.
+ADMIN_ENABLED = os.environ.get('GAME_ADMIN', '1') != '0'
+if ADMIN_ENABLED:
+    INSTALLED_APPS += ('django.contrib.admin.apps.SimpleAdminConfig',)
+
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 
+# Bots: seconds each move may search for and the number of search processes
+# (None for one per CPU, 0 to search in the request's own process)
+AI_MOVE_BUDGET = 0.5
+AI_PROCESSES = None
+
+# Background tasks run in a thread pool of TASK_THREADS threads, or with
+# 'database' in separate `manage.py run_tasks` processes
+TASK_BACKEND = 'thread'
+TASK_THREADS = 2
+
+# Seconds the public state of a game version is cached for spectators
+PUBLIC_STATE_TIMEOUT = 300
+
+# Seconds a client has to wait between polls of /status of a game, earlier
+# polls get the last response again, or an empty 304 with since; 0 for none
+STATUS_MIN_POLL_INTERVAL = 1
+
+# Keep games being dealt and played in memory, saving them to the database
+# in the background through a log on disk (see main.sessions). Only for a
+# single server process.
+GAME_SESSIONS = False
+GAME_SESSION_LOG = 'sessions.log'
+
+# Finished games are moved to the archive tables by `manage.py archive_games`
+# once they're this many days old
+GAME_RETENTION_DAYS = 30
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -1,7 +1,5 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
-from django.contrib import admin
-
-admin.autodiscover()
 
 urlpatterns = patterns('',
     # Examples:
@@ -11,15 +9,29 @@ urlpatterns = patterns('',
     url(r'^draw/', 'main.views.ready', name='draw'),
     url(r'^play/(?P<game_id>\d+)', 'main.views.play', name='play'),
     url(r'^status/(?P<game_id>\d+)', 'main.views.status', name='status'),
+    url(r'^unseen/(?P<game_id>\d+)', 'main.views.unseen', name='unseen'),
+    url(r'^spectate/(?P<game_id>\d+)', 'main.views.spectate', name='spectate'),
+    url(r'^watch/(?P<game_id>\d+)', 'main.views.watch', name='watch'),
+    url(r'^review/(?P<game_id>\d+)', 'main.views.review', name='review'),
     url(r'^game/(?P<game_id>\d+)', 'main.views.game', name='game'),
     url(r'^ready/(?P<game_id>\d+)', 'main.views.ready', name='ready'),
     url(r'^reserve/(?P<game_id>\d+)', 'main.views.reserve', name='reserve'),
     url(r'^rematch/(?P<game_id>\d+)', 'main.views.rematch', name='rematch'),
+    url(r'^profile/(?P<username>[\w.@+-]+)', 'main.views.profile', name='profile'),
+    url(r'^sprites/(?P<filename>[\w.]+)$', 'main.views.sprite', name='sprite'),
+    url(r'^new_tournament/', 'main.views.new_tournament', name='new_tournament'),
+    url(r'^tournament/(?P<tournament_id>\d+)', 'main.views.tournament', name='tournament'),
     # url(r'^game/', include('game.foo.urls')),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
-    # Uncomment the next line to enable the admin:
-    url(r'^admin/', include(admin.site.urls)),
 )
+
+if settings.ADMIN_ENABLED:
+    from django.contrib import admin
+
+    admin.autodiscover()
+    urlpatterns += patterns('',
+        url(r'^admin/', include(admin.site.urls)),
+    )
@@ -0,0 +1,243 @@
+"""
+Monte Carlo player used to fill empty seats.
+
+Each decision samples the hidden hands from the cards that haven't been seen
+yet, plays every candidate out with random moves and picks the candidate with
+the best average result for the bot's team. Rollouts are spread over a process
+pool and stop at a per-move time budget. The statistics gathered for the bot's
+following decision are kept and used as the starting point one trick later.
+"""
+
+from collections import OrderedDict
+import concurrent.futures
+import math
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from main.engine import Deal
+from main.models import ACE, NORMAL_SUITS, OPPONENTS, FriendCard
+from main.rules import Card, CardCombinations, Cards, Trick, get_ruleset
+
+
+# Search trees kept for the bots' next decisions, by (game id, seat), least recently used dropped first
+MAX_TREES = 1000
+
+_executor = None
+_trees = OrderedDict()
+_trees_lock = threading.Lock()
+
+
+def get_processes():
+    processes = getattr(settings, 'AI_PROCESSES', None)
+    return os.cpu_count() if processes is None else processes
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=get_processes())
+    return _executor
+
+
+def play_key(cards):
+    return str(Cards(sorted(cards)))
+
+
+class Node(object):
+    def __init__(self):
+        self.stats = {}
+        self.children = {}
+
+    def add(self, play, value, visits=1):
+        stat = self.stats.setdefault(play, [0, 0.0])
+        stat[0] += visits
+        stat[1] += value
+
+    def child(self, play, lead):
+        return self.children.setdefault((play, lead), Node())
+
+    def merge(self, stats, children):
+        for play, (visits, value) in stats.items():
+            self.add(play, value, visits)
+        for (play, lead), child_stats in children.items():
+            self.child(play, lead).merge(child_stats, {})
+
+    def best(self, plays):
+        def average(play):
+            visits, value = self.stats.get(play, (0, 0.0))
+            return value / visits if visits else float('-inf')
+        return max(plays, key=average)
+
+
+def snapshot(game, player):
+    """Return everything player is allowed to know about the hand in progress."""
+    players = game.get_players()
+    hidden = Cards()
+    for other in players:
+        if other.turn != player.turn:
+            hidden.add_cards(other.get_hand().cards)
+    if player.turn != 0:
+        hidden.add_cards(Cards.fromstr(game.kitty).cards)
+
+    return {
+        'seat': player.turn,
+        'hand': player.hand,
+        'hidden': str(hidden),
+        'sizes': [len(other.get_hand()) for other in players],
+        'kitty': game.kitty if player.turn == 0 else None,
+        'teams': [other.team for other in players],
+        'trump_suit': game.trump_suit,
+        'trump_rank': game.trump_rank,
+        'trump_broken': game.trump_broken,
+        'ruleset': game.ruleset,
+        'turn': game.turn,
+        'lead': game.lead,
+        'trick_points': game.trick_points,
+        'plays': [list(players[(game.turn + i) % len(players)].get_play().card_list)
+                  for i in range(game.trick_turn)],
+    }
+
+
+def determinize(state, rng):
+    """Deal the hidden cards at random into the other hands."""
+    hidden = Cards.fromstr(state['hidden']).cards
+    rng.shuffle(hidden)
+
+    hands = []
+    for i, size in enumerate(state['sizes']):
+        if i == state['seat']:
+            hands.append(Cards.fromstr(state['hand']).cards)
+        else:
+            hands.append(hidden[:size])
+            hidden = hidden[size:]
+
+    kitty = Cards.fromstr(state['kitty']).cards if state['kitty'] is not None else hidden
+    deal = Deal(hands, state['teams'], state['trump_suit'], state['trump_rank'],
+                kitty=kitty, turn=state['turn'], trump_broken=state['trump_broken'],
+                rules=get_ruleset(state['ruleset']))
+
+    # Pick up the trick in progress
+    for i, cards in enumerate(state['plays']):
+        deal.plays[(state['turn'] + i) % len(hands)] = cards
+    if state['plays']:
+        deal.trick_turn = len(state['plays'])
+        deal.trick_points = state['trick_points']
+        deal.lead = state['lead']
+        deal.trick = Trick.start(state['plays'][0], state['trump_suit'], state['trump_rank'])
+        lead_play = CardCombinations(deal.plays[deal.lead], state['trump_suit'], state['trump_rank'])
+        deal.trick.winner = [lead_play.suit, lead_play.rank]
+    return deal
+
+
+def search(state, plays, deadline, seed, priors=None):
+    """Run rollouts for each play until deadline, returning (stats, children).
+
+    priors are statistics from an earlier search that steer which plays are
+    tried but aren't included in the returned stats.
+    """
+    rng = random.Random(seed)
+    prior = Node()
+    prior.merge(priors or {}, {})
+    root = Node()
+    keys = [play_key(play) for play in plays]
+    seat = state['seat']
+    sign = 1 if state['teams'][seat] == OPPONENTS else -1
+
+    def ucb(i, visits):
+        n, value = root.stats.get(keys[i], (0, 0.0))
+        prior_n, prior_value = prior.stats.get(keys[i], (0, 0.0))
+        n += prior_n
+        value += prior_value
+        if n == 0:
+            return float('inf')
+        return value / n + math.sqrt(2 * math.log(visits) / n)
+
+    iterations = 0
+    while iterations < len(plays) or time.time() < deadline:
+        iterations += 1
+        deal = determinize(state, rng)
+
+        visits = iterations + sum(n for n, _ in prior.stats.values())
+        i = max(range(len(plays)), key=lambda i: ucb(i, visits))
+        deal.play(plays[i])
+
+        # Record the bot's next decision so it can be reused a trick later
+        follow = None
+        while not deal.finished():
+            cards = deal.random_play(rng)
+            if follow is None and deal.current() == seat:
+                lead = play_key(deal.plays[deal.turn]) if deal.trick_turn else ''
+                follow = (lead, play_key(cards))
+            deal.play(cards)
+
+        value = sign * deal.opponent_points()
+        root.add(keys[i], value)
+        if follow is not None:
+            root.child(keys[i], follow[0]).add(follow[1], value)
+
+    return root.stats, dict((key, child.stats) for key, child in root.children.items())
+
+
+def choose_play(game, player, budget=None):
+    """Return the cards player should play next."""
+    return search_play(snapshot(game, player), game.id, budget)
+
+
+def search_play(state, game_id, budget=None):
+    """Return the cards to play from a snapshot, which needs no access to the game while searching."""
+    if budget is None:
+        budget = getattr(settings, 'AI_MOVE_BUDGET', 0.5)
+
+    rng = random.Random()
+    plays = determinize(state, rng).legal_plays(limit=getattr(settings, 'AI_MAX_PLAYS', 30))
+    if len(plays) == 1:
+        return plays[0]
+
+    # Reuse statistics from the previous decision if the game went the way it expected
+    tree_key = (game_id, state['seat'])
+    lead = play_key(state['plays'][0]) if state['plays'] else ''
+    with _trees_lock:
+        previous = _trees.pop(tree_key, None)
+    node = previous[0].children.get((previous[1], lead)) if previous else None
+    if node is None:
+        node = Node()
+
+    deadline = time.time() + budget
+    processes = get_processes()
+    if processes == 0:
+        node.merge(*search(state, plays, deadline, rng.random(), node.stats))
+    else:
+        futures = [get_executor().submit(search, state, plays, deadline, rng.random(), node.stats)
+                   for _ in range(processes)]
+        done, _ = concurrent.futures.wait(futures, timeout=budget + 1)
+        for future in done:
+            node.merge(*future.result())
+
+    play = node.best([play_key(play) for play in plays])
+    with _trees_lock:
+        _trees[tree_key] = (node, play)
+        while len(_trees) > MAX_TREES:
+            _trees.popitem(last=False)
+    return Cards.fromstr(play).cards
+
+
+def choose_reserve(game, player):
+    """Return the cards to bury and the friend cards to call for player."""
+    hand = player.get_hand().cards
+    rules = game.rules()
+    hand.sort(key=lambda card: (card.is_trump(game.trump_suit, game.trump_rank), rules.points([card]) > 0,
+                                card.get_rank(game.trump_suit, game.trump_rank)))
+    cards = hand[:game.reserve_size()]
+
+    friend_cards = None
+    if game.find_friends:
+        kept = Cards(hand[game.reserve_size():])
+        suits = sorted((suit for suit in NORMAL_SUITS if suit != game.trump_suit),
+                       key=lambda suit: Card(suit, ACE) in kept.cards)
+        friend_cards = FriendCard.fromstr(','.join('1{}{}'.format(suit, ACE)
+                                                   for suit in suits[:game.number_of_friends()]))
+    return cards, friend_cards
@@ -0,0 +1,134 @@
+"""
+Timing the rules on pathological hands.
+
+The dataset in main/data/pathological_hands.json is a versioned list of
+worst cases seen in real games: tractors across the trump rank, long trump
+tractors, multi-deck triples, big throws against many opponents and the
+declarer's hand after the kitty. Each case gives the hands, with seat 0
+leading and seat 1 optionally following, and the results expected of:
+
+    init        CardCombinations of the lead: [n, consecutive, rank] each
+    validate    the lead's CardCombinations.validate of the follow
+    lead        Game.play of the lead, and the cards it ended up leading
+    follow      Game.play of the follow
+
+Results are checked before anything is timed, so a change that speeds a
+case up by getting it wrong shows up as a mismatch.
+"""
+
+import json
+import os
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from main.models import Game, Player
+from main.rules import CardCombinations, Cards, CardTracker, HandIndex
+
+
+DATASET = os.path.join(os.path.dirname(__file__), 'data', 'pathological_hands.json')
+
+
+def load_dataset(path=DATASET):
+    with open(path) as f:
+        return json.load(f)
+
+
+def combinations(cards, trump_suit, trump_rank):
+    play = CardCombinations(cards, trump_suit, trump_rank)
+    return sorted([combination['n'], combination['consecutive'], combination['rank']]
+                  for combination in play.combinations)
+
+
+def validate_inputs(case):
+    """Return the lead, the follower's cards of the suit followed and the follow, as check_follow decomposes them."""
+    trump_suit, trump_rank = case['trump_suit'], case['trump_rank']
+    follow = Cards.fromstr(case['follow']).cards
+    suit = Cards(follow).single_suit(trump_suit, trump_rank)
+    holding = [card for card in Cards.fromstr(case['hands'][1]).cards
+               if card.get_suit(trump_suit, trump_rank) == suit]
+    return (CardCombinations(Cards.fromstr(case['lead']).cards, trump_suit, trump_rank),
+            CardCombinations(holding, trump_suit, trump_rank),
+            CardCombinations(follow, trump_suit, trump_rank))
+
+
+def validate(case):
+    first, before, after = validate_inputs(case)
+    return first.validate(before, after)
+
+
+def setup_game(case):
+    """Create a game in the Play stage with the case's hands."""
+    players = []
+    for i in range(len(case['hands'])):
+        user = User.objects.get_or_create(username='benchmark{}'.format(i))[0]
+        players.append(Player.objects.get_or_create(user=user)[0])
+    game = Game.setup(players)
+    hands = [Cards.fromstr(hand) for hand in case['hands']]
+    game.stage = Game.PLAY
+    game.trump_suit = case['trump_suit']
+    game.trump_rank = case['trump_rank']
+    game.trump_broken = case.get('trump_broken', False)
+    game.deck = ''
+    game.kitty = ''
+    game.remaining = CardTracker.fromcards([card for hand in hands for card in hand.cards]).encode()
+    game.save()
+
+    game_players = list(game.gameplayer_set.all())
+    for player, hand in zip(game_players, hands):
+        player.hand = str(hand)
+        player.hand_index = HandIndex.build(hand.cards, game.trump_suit, game.trump_rank).encode()
+        player.save()
+    return game, game_players
+
+
+def play(case, timer=None):
+    """Play the case's lead and follow in a transaction that's rolled back, returning the results."""
+    with transaction.atomic():
+        game, players = setup_game(case)
+        start = time.perf_counter()
+        lead = game.play(players[0], Cards.fromstr(case['lead']).cards)
+        follow = None
+        if 'follow' in case and lead is None:
+            follow = game.play(players[1], Cards.fromstr(case['follow']).cards)
+        elapsed = time.perf_counter() - start
+        led = str(Cards(sorted(game.gameplayer_set.get(turn=0).get_play().card_list)))
+        transaction.set_rollback(True)
+    if timer is not None:
+        timer.append(elapsed)
+    return lead, led, follow
+
+
+def check(case):
+    """Return (what, expected, actual) for each result of case that isn't as expected."""
+    expected = case['expected']
+    actual = {'init': combinations(Cards.fromstr(case['lead']).cards, case['trump_suit'], case['trump_rank'])}
+    if 'follow' in case:
+        actual['validate'] = validate(case)
+    actual['lead'], actual['led'], follow = play(case)
+    if 'follow' in case:
+        actual['follow'] = follow
+    return [(key, expected.get(key), actual[key]) for key in sorted(actual) if expected.get(key) != actual[key]]
+
+
+def time_case(case, runs):
+    """Return the median seconds of init, validate and play over runs."""
+    trump_suit, trump_rank = case['trump_suit'], case['trump_rank']
+    lead = Cards.fromstr(case['lead']).cards
+    timings = {'init': [], 'validate': [], 'play': []}
+    for _ in range(runs):
+        start = time.perf_counter()
+        CardCombinations(lead, trump_suit, trump_rank)
+        timings['init'].append(time.perf_counter() - start)
+
+        if 'follow' in case:
+            # validate changes the combinations it's given, so they're built again each run
+            first, before, after = validate_inputs(case)
+            start = time.perf_counter()
+            first.validate(before, after)
+            timings['validate'].append(time.perf_counter() - start)
+
+        play(case, timings['play'])
+    return dict((name, statistics.median(times)) for name, times in timings.items() if times)
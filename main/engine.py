@@ -0,0 +1,167 @@
+"""
+In-memory play of a hand.
+
+Deal applies the same rules as Game.play without touching the database so
+that hands can be simulated quickly, e.g. by the AI players.
+"""
+
+from collections import Counter
+import itertools
+
+from main.models import OPPONENTS, STANDARD, TRUMP
+from main.rules import Cards, HandIndex, Trick, check_follow, check_lead, get_ruleset, is_consecutive
+
+
+class Deal(object):
+    def __init__(self, hands, teams, trump_suit, trump_rank, kitty=None, turn=0, trump_broken=False, rules=None):
+        self.hands = [Cards(hand) for hand in hands]
+        self.indexes = [HandIndex.build(hand, trump_suit, trump_rank) for hand in hands]
+        self.teams = list(teams)
+        self.trump_suit = trump_suit
+        self.trump_rank = trump_rank
+        self.rules = rules or get_ruleset(STANDARD)
+        self.kitty = list(kitty or [])
+        self.turn = turn
+        self.trick_turn = 0
+        self.lead = turn
+        self.trick = None
+        self.trick_points = 0
+        self.trump_broken = trump_broken
+        self.plays = [[] for _ in hands]
+        self.points = [0] * len(hands)
+
+    def number_of_players(self):
+        return len(self.hands)
+
+    def current(self):
+        return (self.turn + self.trick_turn) % self.number_of_players()
+
+    def finished(self):
+        return not any(self.hands)
+
+    def opponent_points(self):
+        return sum(points for points, team in zip(self.points, self.teams) if team == OPPONENTS)
+
+    def play(self, cards):
+        player = self.current()
+        hand = self.hands[player]
+        if cards not in hand:
+            return "Cards are not in hand"
+
+        if self.trick_turn == 0:
+            other_hands = [index for i, index in enumerate(self.indexes) if i != player]
+            ret, cards, self.trump_broken = check_lead(cards, hand, other_hands,
+                                                       self.trump_suit, self.trump_rank, self.trump_broken)
+            if ret:
+                return ret
+
+            self.plays = [[] for _ in self.hands]
+            self.lead = player
+            self.trick = Trick.start(cards, self.trump_suit, self.trump_rank)
+
+        else:
+            ret, combinations_played = check_follow(self.trick.cards, hand, cards,
+                                                    self.trump_suit, self.trump_rank, self.trick.first_play())
+            if ret:
+                return ret
+
+            if Cards(cards).single_suit(self.trump_suit, self.trump_rank) == TRUMP:
+                self.trump_broken = True
+
+            if self.trick.follow(combinations_played):
+                self.lead = player
+
+        hand.play_cards(cards)
+        self.indexes[player].play_cards(hand, cards, self.trump_suit, self.trump_rank)
+        self.plays[player] = list(cards)
+        self.trick_turn += 1
+        self.trick_points += self.rules.points(cards)
+
+        # Evaluate plays on last turn
+        if self.trick_turn == self.number_of_players():
+            self.points[self.lead] += self.trick_points
+            self.turn = self.lead
+            self.trick_turn = 0
+            self.trick_points = 0
+
+            if self.finished() and self.teams[self.lead] == OPPONENTS:
+                self.points[self.lead] += self.rules.kitty_multiplier * self.rules.points(self.kitty)
+
+    def legal_plays(self, limit=None):
+        """Return plays the current player is allowed to make.
+
+        Leads are singles, n-of-a-kinds and tractors of two pairs; throws of
+        several combinations are never generated. Follows are every distinct
+        set of cards that passes check_follow, up to limit.
+        """
+        hand = self.hands[self.current()]
+        if self.trick_turn == 0:
+            return self._leads(hand)[:limit]
+        else:
+            return list(itertools.islice(self._follows(hand, self.trick.cards), limit))
+
+    def random_play(self, rng, attempts=20):
+        """Return a legal play for the current player chosen at random."""
+        hand = self.hands[self.current()]
+        if self.trick_turn == 0:
+            return rng.choice(self._leads(hand))
+
+        first_cards = self.trick.cards
+        suit = first_cards[0].get_suit(self.trump_suit, self.trump_rank)
+        suit_cards = [card for card in hand.cards if card.get_suit(self.trump_suit, self.trump_rank) == suit]
+        if len(suit_cards) > len(first_cards):
+            for _ in range(attempts):
+                cards = rng.sample(suit_cards, len(first_cards))
+                if check_follow(first_cards, hand, cards, self.trump_suit, self.trump_rank,
+                                self.trick.first_play())[0] is None:
+                    return cards
+        else:
+            rest = [card for card in hand.cards if card.get_suit(self.trump_suit, self.trump_rank) != suit]
+            cards = suit_cards + rng.sample(rest, len(first_cards) - len(suit_cards))
+            if check_follow(first_cards, hand, cards, self.trump_suit, self.trump_rank,
+                            self.trick.first_play())[0] is None:
+                return cards
+        return next(self._follows(hand, first_cards))
+
+    def _leads(self, hand):
+        by_suit = {}
+        for card in hand.cards:
+            by_suit.setdefault(card.get_suit(self.trump_suit, self.trump_rank), []).append(card)
+        if not self.trump_broken and len(by_suit) > 1:
+            by_suit.pop(TRUMP, None)
+
+        plays = []
+        for suit in sorted(by_suit):
+            counts = Counter(by_suit[suit])
+            for card in sorted(counts):
+                plays.extend([card] * n for n in range(1, counts[card] + 1))
+
+            pairs = sorted((card for card in counts if counts[card] >= 2),
+                           key=lambda c: c.get_rank(self.trump_suit, self.trump_rank))
+            for low, high in itertools.combinations(pairs, 2):
+                if is_consecutive([low, high], self.trump_suit, self.trump_rank):
+                    plays.append([low, low, high, high])
+        return plays
+
+    def _follows(self, hand, first_cards):
+        suit = first_cards[0].get_suit(self.trump_suit, self.trump_rank)
+        suit_cards = sorted(card for card in hand.cards if card.get_suit(self.trump_suit, self.trump_rank) == suit)
+        if len(suit_cards) >= len(first_cards):
+            candidates = _multisets(suit_cards, len(first_cards))
+        else:
+            rest = sorted(card for card in hand.cards if card.get_suit(self.trump_suit, self.trump_rank) != suit)
+            candidates = (suit_cards + list(cards) for cards in _multisets(rest, len(first_cards) - len(suit_cards)))
+
+        for cards in candidates:
+            if check_follow(first_cards, hand, list(cards), self.trump_suit, self.trump_rank,
+                            self.trick.first_play())[0] is None:
+                yield list(cards)
+
+
+def _multisets(cards, n):
+    seen = set()
+    for combination in itertools.combinations(cards, n):
+        key = tuple(str(card) for card in combination)
+        if key not in seen:
+            seen.add(key)
+            yield combination
@@ -0,0 +1,20 @@
+from django import forms
+from django.contrib.auth import authenticate
+
+from main.models import Player
+
+
+class LoginForm(forms.Form):
+    username = forms.CharField()
+    password = forms.CharField(widget=forms.widgets.PasswordInput)
+
+    def clean(self):
+        cleaned_data = super(LoginForm, self).clean()
+        if 'register' in self.data:
+            Player.create_player(username=cleaned_data.get('username'), password=cleaned_data.get('password'))
+        user = authenticate(username=cleaned_data.get('username'), password=cleaned_data.get('password'))
+        if user is None:
+            self._errors['password'] = self.error_class(["Incorrect password."])
+        else:
+            cleaned_data['user'] = user
+        return cleaned_data
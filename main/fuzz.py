@@ -0,0 +1,252 @@
+"""
+Seeded random games for checking the rules.
+
+Every game is played in memory with main.engine.Deal from a seed, so a
+failure can be replayed exactly from (seed, number of players, hand size).
+A failure is then shrunk to a repro: the hands, kitty and moves of the
+failing game cut down to what still fails the same way, see shrink.
+After each play the invariants below are checked:
+
+    - every card of the deck is in a hand, the kitty or a play
+    - the points taken plus the points on the table equal the points played
+    - players play in turn, each once per trick and as many cards as the lead
+    - the winner of a trick leads the next one
+"""
+
+from collections import Counter
+import random
+
+from main.engine import Deal
+from main.models import DECLARERS, NORMAL_RANKS, NORMAL_SUITS, OPPONENTS, Game
+from main.rules import Cards, DeckPool
+
+
+class InvariantError(Exception):
+    pass
+
+
+def deal_game(seed, number_of_players, hand_size=None):
+    rng = random.Random(seed)
+    number_of_decks, full_hand_size, reserve_size = Game.SETTINGS[number_of_players]
+    if hand_size is None:
+        hand_size = full_hand_size
+
+    deck = Cards.fromstr(DeckPool.shuffle(number_of_decks, seed)).cards
+    hands = [deck[i * hand_size:(i + 1) * hand_size] for i in range(number_of_players)]
+    kitty = deck[number_of_players * full_hand_size:][:reserve_size]
+    if number_of_players == 4:
+        teams = [DECLARERS if turn % 2 == 0 else OPPONENTS for turn in range(number_of_players)]
+    else:
+        teams = [DECLARERS] + [OPPONENTS] * (number_of_players - 1)
+    return Deal(hands, teams, rng.choice(NORMAL_SUITS), rng.choice(NORMAL_RANKS), kitty=kitty)
+
+
+def choose_play(deal, rng):
+    """Return a random legal play, sometimes a throw of several combinations."""
+    if deal.trick_turn == 0 and rng.random() < 0.2:
+        hand = deal.hands[deal.current()]
+        suit = rng.choice(hand.cards).get_suit(deal.trump_suit, deal.trump_rank)
+        cards = [card for card in hand.cards if card.get_suit(deal.trump_suit, deal.trump_rank) == suit]
+        return rng.sample(cards, rng.randint(1, len(cards)))
+    return deal.random_play(rng)
+
+
+def check(deal, deck, played, plays_this_trick):
+    cards = Counter(card for hand in deal.hands for card in hand.cards)
+    cards.update(deal.kitty)
+    cards.update(played)
+    if cards != deck:
+        raise InvariantError("Cards aren't conserved: {} extra, {} missing".format(
+            Cards(sorted((cards - deck).elements())), Cards(sorted((deck - cards).elements()))))
+
+    rules = deal.rules
+    points = sum(deal.points) + deal.trick_points
+    if deal.finished() and deal.teams[deal.lead] == OPPONENTS:
+        points -= rules.kitty_multiplier * rules.points(deal.kitty)
+    if points != rules.points(played):
+        raise InvariantError("Points taken ({}) don't match points played ({})".format(points, rules.points(played)))
+
+    if len(plays_this_trick) != deal.trick_turn:
+        raise InvariantError("{} plays made in the trick but trick turn is {}".format(
+            len(plays_this_trick), deal.trick_turn))
+    if any(len(cards) != len(plays_this_trick[0]) for cards in plays_this_trick):
+        raise InvariantError("Plays of different sizes in one trick")
+
+
+def play_game(seed, number_of_players, hand_size=None, moves=None):
+    """Play a whole game, returning the moves made as (seat, cards) pairs.
+
+    With moves, replay those instead of choosing plays at random. Raises
+    InvariantError when a rule is broken, with the moves up to the failure
+    as its moves.
+    """
+    return play_deal(deal_game(seed, number_of_players, hand_size), random.Random(seed), moves)
+
+
+def play_deal(deal, rng, moves=None):
+    number_of_players = len(deal.hands)
+    deck = Counter(card for hand in deal.hands for card in hand.cards)
+    deck.update(deal.kitty)
+    played = []
+    plays_this_trick = []
+    history = []
+    leader = deal.turn
+
+    try:
+        while not deal.finished() and (moves is None or len(history) < len(moves)):
+            seat = deal.current()
+            if seat != (leader + len(plays_this_trick)) % number_of_players:
+                raise InvariantError("Seat {} is playing out of turn".format(seat))
+
+            if moves is None:
+                cards = choose_play(deal, rng)
+            else:
+                expected_seat, cards = moves[len(history)]
+                if expected_seat != seat:
+                    raise InvariantError("Seat {} played out of turn, expected {}".format(expected_seat, seat))
+                cards = Cards.fromstr(cards).cards
+
+            ret = deal.play(cards)
+            if ret:
+                # A random throw may be rejected, e.g. trump before it's broken
+                if moves is None and deal.trick_turn == 0 and cards not in deal.legal_plays():
+                    continue
+                history.append((seat, str(Cards(cards))))
+                raise InvariantError("Legal play {} by seat {} was rejected: {}".format(Cards(cards), seat, ret))
+
+            cards = deal.plays[seat]
+            history.append((seat, str(Cards(cards))))
+            played.extend(cards)
+            plays_this_trick.append(cards)
+            if len(plays_this_trick) == number_of_players:
+                if deal.turn not in [(leader + i) % number_of_players for i in range(number_of_players)]:
+                    raise InvariantError("Seat {} won a trick it didn't play in".format(deal.turn))
+                leader = deal.turn
+                plays_this_trick = []
+            check(deal, deck, played, plays_this_trick)
+
+        if moves is None and not deal.finished():
+            raise InvariantError("Game ended with cards in hand")
+        if plays_this_trick and deal.finished():
+            raise InvariantError("Game ended in the middle of a trick")
+    except InvariantError as e:
+        e.moves = history
+        raise
+    return history
+
+
+def make_repro(seed, deal, moves):
+    return {
+        'seed': seed,
+        'hands': [str(hand) for hand in deal.hands],
+        'kitty': str(Cards(deal.kitty)),
+        'teams': deal.teams,
+        'trump_suit': deal.trump_suit,
+        'trump_rank': deal.trump_rank,
+        'turn': deal.turn,
+        'trump_broken': deal.trump_broken,
+        'moves': [[seat, cards] for seat, cards in moves],
+    }
+
+
+def replay(repro):
+    """Play a repro's moves, returning them. Raises InvariantError like play_game."""
+    deal = Deal([Cards.fromstr(hand).cards for hand in repro['hands']], repro['teams'],
+                repro['trump_suit'], repro['trump_rank'], kitty=Cards.fromstr(repro['kitty']).cards,
+                turn=repro['turn'], trump_broken=repro['trump_broken'])
+    return play_deal(deal, random.Random(repro['seed']), repro['moves'])
+
+
+def fails(repro, error):
+    try:
+        replay(repro)
+    except InvariantError as e:
+        return str(e) == error
+    return False
+
+
+def drop_first_trick(repro):
+    """Return repro starting one trick later, or None if its failure is in the first trick."""
+    number_of_players = len(repro['hands'])
+    if len(repro['moves']) <= number_of_players:
+        return None
+
+    trick = repro['moves'][:number_of_players]
+    hands = [Cards.fromstr(hand) for hand in repro['hands']]
+    for seat, cards in trick:
+        hands[seat].play_cards(Cards.fromstr(cards).cards)
+    trump_broken = repro['trump_broken'] or any(
+        card.is_trump(repro['trump_suit'], repro['trump_rank']) for _, cards in trick for card in Cards.fromstr(cards).cards)
+    return dict(repro, hands=[str(hand) for hand in hands], turn=repro['moves'][number_of_players][0],
+                trump_broken=trump_broken, moves=repro['moves'][number_of_players:])
+
+
+def drop_cards(repro, seats, unplayed):
+    """Return repro without the cards it never plays from the hands of seats, keeping the first `unplayed` of each."""
+    hands = []
+    for seat, hand in enumerate(repro['hands']):
+        if seat not in seats:
+            hands.append(hand)
+            continue
+        played = Cards()
+        for move_seat, cards in repro['moves']:
+            if move_seat == seat:
+                played.add_cards(Cards.fromstr(cards).cards)
+        rest = Cards.fromstr(hand)
+        rest.play_cards(played.cards)
+        played.add_cards(rest.cards[:unplayed])
+        hands.append(str(played))
+    return dict(repro, hands=hands)
+
+
+def shrink(seed, number_of_players, hand_size=None):
+    """Return a small repro of the failure of the game from seed, or None when it doesn't fail again.
+
+    The moves up to the failure are replayed from explicit hands. Whole
+    tricks are dropped from the start, then the cards never played and the
+    kitty, each change kept only while the replay fails with the same error.
+    """
+    deal = deal_game(seed, number_of_players, hand_size)
+    repro = make_repro(seed, deal, [])
+    try:
+        play_deal(deal, random.Random(seed))
+        return None
+    except InvariantError as e:
+        error = str(e)
+        repro['moves'] = [[seat, cards] for seat, cards in e.moves]
+    if not fails(repro, error):
+        return None
+
+    while True:
+        candidate = drop_first_trick(repro)
+        if candidate is None or not fails(candidate, error):
+            break
+        repro = candidate
+
+    for seat in range(number_of_players):
+        # Keep the fewest of the seat's unplayed cards, in hand order, that still fail
+        for unplayed in range(len(Cards.fromstr(repro['hands'][seat]))):
+            candidate = drop_cards(repro, [seat], unplayed)
+            if fails(candidate, error):
+                repro = candidate
+                break
+
+    candidate = dict(repro, kitty='')
+    if fails(candidate, error):
+        repro = candidate
+    return repro
+
+
+def fuzz(games, seed=0, players=None, hand_size=None):
+    """Play games from consecutive seeds, returning (seed, players, repro, error) for failures.
+
+    repro is None when the failure doesn't happen again on replay.
+    """
+    failures = []
+    for i in range(games):
+        number_of_players = (players or sorted(Game.SETTINGS))[i % len(players or Game.SETTINGS)]
+        try:
+            play_game(seed + i, number_of_players, hand_size)
+        except InvariantError as e:
+            failures.append((seed + i, number_of_players, shrink(seed + i, number_of_players, hand_size), str(e)))
+    return failures
@@ -0,0 +1,31 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.models import ArchivedGame, Game
+
+
+class Command(BaseCommand):
+    help = "Move finished games older than the retention window to the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'GAME_RETENTION_DAYS', 30))
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        # Games are only archived once their ranks and stats are in, since neither can be applied after
+        old = Game.objects.filter(stage=Game.SCORE, finished_at__lt=cutoff, ranked=True, stats_recorded=True)
+
+        last_id = 0
+        total = 0
+        while True:
+            # Each batch is its own transaction so the tables are never locked for long
+            games = list(old.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not games:
+                break
+            total += ArchivedGame.archive(games)
+            last_id = games[-1].id
+        self.stdout.write("Archived {} game(s)".format(total))
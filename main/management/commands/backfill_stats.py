@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Game, PlayerStats
+
+
+class Command(BaseCommand):
+    help = "Add finished games that aren't counted yet to the player stats"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        total = 0
+        while True:
+            # Only one batch of games is held in memory at a time
+            games = list(Game.objects.filter(stage=Game.SCORE, stats_recorded=False, id__gt=last_id)
+                         .only('id', 'winner').order_by('id')[:options['batch_size']])
+            if not games:
+                break
+            total += PlayerStats.record_games(games)
+            last_id = games[-1].id
+        self.stdout.write("Recorded {} game(s)".format(total))
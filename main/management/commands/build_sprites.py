@@ -0,0 +1,55 @@
+import hashlib
+import io
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.rules import DECK
+
+
+COLUMNS = 13
+
+
+class Command(BaseCommand):
+    help = "Pack the card images into one sprite sheet with a CSS map, named by content hash"
+
+    def handle(self, *args, **options):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise CommandError("Pillow is needed to build the sprite sheet")
+
+        images = [Image.open(os.path.join(settings.STATICFILES_DIRS[0], card.image())).convert('RGBA')
+                  for card in DECK]
+        width, height = images[0].size
+        rows = (len(images) + COLUMNS - 1) // COLUMNS
+        sheet = Image.new('RGBA', (width * COLUMNS, height * rows), (0, 0, 0, 0))
+
+        positions = []
+        for i, image in enumerate(images):
+            x, y = i % COLUMNS * width, i // COLUMNS * height
+            sheet.paste(image, (x, y))
+            positions.append((x, y))
+
+        png = io.BytesIO()
+        sheet.save(png, 'PNG', optimize=True)
+        png = png.getvalue()
+        png_name = 'cards.{}.png'.format(hashlib.sha1(png).hexdigest()[:12])
+
+        css = ['.card {{ display: inline-block; width: {}px; height: {}px; background: url({}) no-repeat; }}'
+               .format(width, height, png_name)]
+        css.extend('.card-{} {{ background-position: -{}px -{}px; }}'.format(i, x, y)
+                   for i, (x, y) in enumerate(positions))
+        css = '\n'.join(css).encode('utf-8') + b'\n'
+        css_name = 'cards.{}.css'.format(hashlib.sha1(css).hexdigest()[:12])
+
+        os.makedirs(settings.SPRITES_ROOT, exist_ok=True)
+        for name, content in ((png_name, png), (css_name, css)):
+            with open(os.path.join(settings.SPRITES_ROOT, name), 'wb') as f:
+                f.write(content)
+        with open(os.path.join(settings.SPRITES_ROOT, 'manifest.json'), 'w') as f:
+            json.dump({'png': png_name, 'css': css_name, 'size': [width, height], 'cards': positions}, f)
+
+        self.stdout.write("Wrote {} and {}".format(png_name, css_name))
@@ -0,0 +1,164 @@
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from main.models import OPPONENTS, ArchivedGame, ArchivedGamePlayer, FriendCard, Game, GamePlayer
+
+
+FORMATS = ('ndjson', 'parquet', 'arrow')
+
+# Games that finished more recently than this may not be committed yet, so
+# they're left for the next export rather than skipped by its watermark
+SETTLE_TIME = datetime.timedelta(minutes=1)
+
+
+def arrow_schema():
+    import pyarrow as pa
+
+    player = pa.struct([('username', pa.string()), ('turn', pa.int32()), ('team', pa.string()),
+                        ('points', pa.int32())])
+    friend_card = pa.struct([('number', pa.int32()), ('suit', pa.string()), ('rank', pa.int32()),
+                             ('found', pa.bool_())])
+    return pa.schema([('id', pa.int64()), ('seed', pa.int64()), ('trump_suit', pa.string()),
+                      ('trump_rank', pa.int32()), ('kitty', pa.string()), ('find_friends', pa.bool_()),
+                      ('winner', pa.string()), ('points', pa.int32()), ('finished_at', pa.string()),
+                      ('players', pa.list_(player)),
+                      ('friend_cards', pa.list_(friend_card))])
+
+
+def parse_watermark(watermark):
+    """Return the (finished_at, id) of a watermark printed by the command, e.g. '2016-01-02T03:04:05+00:00,42'."""
+    finished_at, _, game_id = watermark.rpartition(',')
+    finished_at = parse_datetime(finished_at)
+    if finished_at is None or not game_id.isdigit():
+        raise CommandError("--since should be the watermark printed by the last export")
+    return finished_at, int(game_id)
+
+
+def format_watermark(game):
+    return '{},{}'.format(game['finished_at'], game['id'])
+
+
+def finished_after(games, since, until):
+    """Filter games to those that finished after since, in order of finishing."""
+    games = games.filter(finished_at__lt=until)
+    if since is not None:
+        finished_at, game_id = since
+        games = games.filter(Q(finished_at__gt=finished_at) | Q(finished_at=finished_at, id__gt=game_id))
+    return games.order_by('finished_at', 'id')
+
+
+def export_batches(since, batch_size):
+    """Yield lists of finished games as dicts, archived or not, in order of finishing after the watermark since.
+
+    Games finish out of id order, so the watermark is when the game finished
+    with its id to break ties.
+    """
+    until = timezone.now() - SETTLE_TIME
+    while True:
+        # Each batch is a few short queries so the database is never held for the whole export
+        games = list(finished_after(Game.objects.filter(stage=Game.SCORE), since, until).values(
+            'id', 'seed', 'trump_suit', 'trump_rank', 'kitty', 'find_friends', 'winner', 'finished_at')[:batch_size])
+        archived = list(finished_after(ArchivedGame.objects.all(), since, until).values(
+            'id', 'seed', 'trump_suit', 'trump_rank', 'kitty', 'friend_cards', 'winner', 'points',
+            'finished_at')[:batch_size])
+        batch = sorted(games + archived, key=lambda game: (game['finished_at'], game['id']))[:batch_size]
+        if not batch:
+            break
+        since = batch[-1]['finished_at'], batch[-1]['id']
+
+        by_id = {}
+        archived_ids = set()
+        for game in batch:
+            if 'friend_cards' in game:
+                # Archived games keep only the friend cards themselves, not whether they were found
+                game['friend_cards'] = [{'number': int(card[0]), 'suit': card[1], 'rank': int(card[2:]),
+                                         'found': None} for card in game['friend_cards'].split(',') if card]
+                game['find_friends'] = bool(game['friend_cards'])
+                archived_ids.add(game['id'])
+            else:
+                game.update(points=0, friend_cards=[])
+            game['players'] = []
+            by_id[game['id']] = game
+
+        live_ids = [game_id for game_id in by_id if game_id not in archived_ids]
+        for model, ids in ((GamePlayer, live_ids), (ArchivedGamePlayer, archived_ids)):
+            if not ids:
+                continue
+            for game_id, username, turn, team, points in (
+                    model.objects.filter(game__in=list(ids)).order_by('game', 'turn')
+                    .values_list('game_id', 'player__user__username', 'turn', 'team', 'points')):
+                game = by_id[game_id]
+                game['players'].append({'username': username, 'turn': turn, 'team': team, 'points': points})
+                if team == OPPONENTS and model is GamePlayer:
+                    game['points'] += points
+
+        friend_cards = FriendCard.objects.filter(game__in=live_ids).order_by('id')
+        for game_id, number, suit, rank, found in friend_cards.values_list('game_id', 'number', 'suit', 'rank', 'found'):
+            by_id[game_id]['friend_cards'].append({'number': number, 'suit': suit, 'rank': rank, 'found': found})
+
+        for game in batch:
+            game['finished_at'] = game['finished_at'].isoformat()
+        yield batch
+
+
+class Command(BaseCommand):
+    help = "Export finished games with their players, friend cards, kitty and points"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--output', '-o', default='-', help="File to write to, - for stdout (ndjson only)")
+        parser.add_argument('--since', help="Only export games that finished after this watermark, "
+                                             "as printed by the last export")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        since = parse_watermark(options['since']) if options['since'] else None
+        batches = export_batches(since, options['batch_size'])
+        if options['format'] == 'ndjson':
+            if options['output'] == '-':
+                count, watermark = self.write_ndjson(batches, self.stdout)
+            else:
+                with open(options['output'], 'w') as f:
+                    count, watermark = self.write_ndjson(batches, f)
+        else:
+            if options['output'] == '-':
+                raise CommandError("--output is needed for {}".format(options['format']))
+            count, watermark = self.write_arrow(batches, options['format'], options['output'])
+
+        # The watermark of the last game is passed as --since next time
+        watermark = options['since'] if watermark is None else watermark
+        self.stderr.write("Exported {} game(s) up to {}".format(count, watermark))
+
+    def write_ndjson(self, batches, f):
+        count = 0
+        watermark = None
+        for games in batches:
+            f.write(''.join(json.dumps(game, separators=(',', ':')) + '\n' for game in games))
+            count += len(games)
+            watermark = format_watermark(games[-1])
+        return count, watermark
+
+    def write_arrow(self, batches, format, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise CommandError("pyarrow is needed to export to {}".format(format))
+
+        schema = arrow_schema()
+        writer = pq.ParquetWriter(path, schema) if format == 'parquet' else pa.ipc.new_file(path, schema)
+        count = 0
+        watermark = None
+        try:
+            for games in batches:
+                writer.write_table(pa.Table.from_pylist(games, schema=schema))
+                count += len(games)
+                watermark = format_watermark(games[-1])
+        finally:
+            writer.close()
+        return count, watermark
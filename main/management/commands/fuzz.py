@@ -0,0 +1,66 @@
+import json
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import fuzz
+
+
+def _fuzz(args):
+    return fuzz.fuzz(*args)
+
+
+class Command(BaseCommand):
+    help = "Play seeded random games and check the rules' invariants"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--players', type=int, action='append', help="Only play with this many players")
+        parser.add_argument('--hand-size', type=int)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--replay', metavar='SEED:PLAYERS:HAND_SIZE', help="Print the moves of one game")
+        parser.add_argument('--repro', metavar='JSON', help="Replay a repro printed for a failure")
+
+    def handle(self, *args, **options):
+        if options['repro']:
+            try:
+                for seat, cards in fuzz.replay(json.loads(options['repro'])):
+                    self.stdout.write("{} {}".format(seat, cards))
+            except fuzz.InvariantError as e:
+                raise CommandError(str(e))
+            return
+
+        if options['replay']:
+            try:
+                seed, players, hand_size = map(int, options['replay'].split(':'))
+            except ValueError:
+                raise CommandError("--replay takes SEED:PLAYERS:HAND_SIZE")
+            try:
+                for seat, cards in fuzz.play_game(seed, players, hand_size):
+                    self.stdout.write("{} {}".format(seat, cards))
+            except fuzz.InvariantError as e:
+                raise CommandError(str(e))
+            return
+
+        # Split the seeds into one contiguous range per process
+        processes = options['processes']
+        chunk = (options['games'] + processes - 1) // processes
+        jobs = [(min(chunk, options['games'] - i), options['seed'] + i, options['players'], options['hand_size'])
+                for i in range(0, options['games'], chunk)]
+        if processes > 1:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(_fuzz, jobs)
+        else:
+            results = [_fuzz(job) for job in jobs]
+
+        failures = [failure for result in results for failure in result]
+        for seed, players, repro, error in failures:
+            self.stdout.write("seed {} with {} players fails: {}".format(seed, players, error))
+            if repro is None:
+                self.stdout.write("  but not when its moves are replayed")
+            else:
+                self.stdout.write("  replay with --repro '{}'".format(json.dumps(repro, separators=(',', ':'))))
+        self.stdout.write("{} game(s), {} failure(s)".format(options['games'], len(failures)))
+        if failures:
+            raise CommandError("Invariants were broken")
@@ -0,0 +1,60 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import benchmark
+
+
+COLUMNS = ('init', 'validate', 'play')
+
+
+class Command(BaseCommand):
+    help = "Check and time the rules on the pathological hands dataset, keeping a history of the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--dataset', default=benchmark.DATASET)
+        parser.add_argument('--history', default='benchmark_history.ndjson',
+                            help="File the results are appended to, one JSON line per run")
+
+    def handle(self, *args, **options):
+        dataset = benchmark.load_dataset(options['dataset'])
+        cases = dataset['cases']
+
+        mismatches = [(case['name'], key, expected, actual)
+                      for case in cases for key, expected, actual in benchmark.check(case)]
+        for name, key, expected, actual in mismatches:
+            self.stdout.write("{}: {} is {!r}, expected {!r}".format(name, key, actual, expected))
+        if mismatches:
+            raise CommandError("{} result(s) aren't as expected".format(len(mismatches)))
+
+        previous = None
+        if os.path.exists(options['history']):
+            with open(options['history']) as f:
+                lines = [line for line in f if line.strip()]
+            if lines:
+                previous = json.loads(lines[-1])
+                if previous['version'] != dataset['version']:
+                    previous = None
+
+        self.stdout.write("{:<32}".format('case') + ''.join("{:>20}".format(column + ' ms') for column in COLUMNS))
+        results = {}
+        for case in cases:
+            results[case['name']] = benchmark.time_case(case, options['runs'])
+            before = (previous or {}).get('results', {}).get(case['name'], {})
+            row = "{:<32}".format(case['name'])
+            for column in COLUMNS:
+                if column not in results[case['name']]:
+                    row += "{:>20}".format('-')
+                elif column in before:
+                    row += "{:>20}".format("{:.3f} (was {:.3f})".format(
+                        results[case['name']][column] * 1000, before[column] * 1000))
+                else:
+                    row += "{:>20.3f}".format(results[case['name']][column] * 1000)
+            self.stdout.write(row)
+
+        with open(options['history'], 'a') as f:
+            f.write(json.dumps({'time': int(time.time()), 'version': dataset['version'],
+                                'runs': options['runs'], 'results': results}, sort_keys=True) + '\n')
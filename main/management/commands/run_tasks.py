@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import tasks
+
+
+class Command(BaseCommand):
+    help = "Run background tasks queued with TASK_BACKEND = 'database'"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            count = tasks.run_pending()
+            if count:
+                self.stdout.write("Ran {} task(s)".format(count))
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['interval'])
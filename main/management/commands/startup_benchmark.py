@@ -0,0 +1,46 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Run in a fresh interpreter, timed until the first response to / is complete
+FIRST_REQUEST = '''
+import io, sys
+from game.wsgi import application
+environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+           'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http'}
+statuses = []
+b''.join(application(environ, lambda status, headers: statuses.append(status)))
+if not statuses[0].startswith('200'):
+    sys.exit(statuses[0])
+'''
+
+
+class Command(BaseCommand):
+    help = "Time cold starts of `manage.py check`, a test run and the first WSGI request"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--test-label', default='main.tests.CardTest')
+
+    def handle(self, *args, **options):
+        # Paths in the settings are relative to the project directory, so it's the working directory
+        manage = os.path.abspath('manage.py')
+        commands = [
+            ('check', [sys.executable, manage, 'check']),
+            ('test', [sys.executable, manage, 'test', options['test_label']]),
+            ('first request', [sys.executable, '-c', FIRST_REQUEST]),
+        ]
+        for name, command in commands:
+            times = []
+            for _ in range(options['runs']):
+                start = time.time()
+                process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                times.append(time.time() - start)
+                if process.returncode:
+                    raise CommandError("{} failed:\n{}".format(name, process.stderr.decode()))
+            self.stdout.write("{:<14} median {:.3f}s  min {:.3f}s".format(name, statistics.median(times), min(times)))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+# The schema from before there were migrations, so that databases created with
+# syncdb can be brought in with `manage.py migrate --fake-initial`
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendCard',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('number', models.IntegerField()),
+                ('suit', models.CharField(max_length=1, choices=[('C', 'Clubs'), ('D', 'Diamonds'), ('H', 'Hearts'), ('S', 'Spades'), ('J', 'Joker')])),
+                ('rank', models.IntegerField(choices=[(2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6'), (7, '7'), (8, '8'), (9, '9'), (10, '10'), (11, 'Jack'), (12, 'Queen'), (13, 'King'), (14, 'Ace'), (17, 'Black'), (18, 'Red')])),
+                ('counter', models.IntegerField(default=0)),
+                ('found', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Game',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('stage', models.CharField(max_length=1, default='1', choices=[('1', 'Setup'), ('2', 'Deal'), ('3', 'Reserve'), ('4', 'Play'), ('5', 'Score')])),
+                ('turn', models.IntegerField(default=0)),
+                ('trick_turn', models.IntegerField(default=0)),
+                ('trick_points', models.IntegerField(default=0)),
+                ('lead', models.IntegerField(default=0)),
+                ('winner', models.CharField(max_length=1, default='A', choices=[('A', 'Declarers'), ('B', 'Opponents')])),
+                ('find_friends', models.BooleanField(default=False)),
+                ('deck', models.CharField(max_length=1000)),
+                ('kitty', models.CharField(max_length=100)),
+                ('trump_rank', models.IntegerField(choices=[(2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6'), (7, '7'), (8, '8'), (9, '9'), (10, '10'), (11, 'Jack'), (12, 'Queen'), (13, 'King'), (14, 'Ace'), (17, 'Black'), (18, 'Red')])),
+                ('trump_suit', models.CharField(max_length=1, choices=[('C', 'Clubs'), ('D', 'Diamonds'), ('H', 'Hearts'), ('S', 'Spades'), ('J', 'Joker')])),
+                ('trump_count', models.IntegerField(default=0)),
+                ('trump_broken', models.BooleanField(default=False)),
+                ('friend_cards', models.ManyToManyField(to='main.FriendCard')),
+                ('next_game', models.OneToOneField(blank=True, null=True, default=None, to='main.Game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GamePlayer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('team', models.CharField(max_length=1, default='B', choices=[('A', 'Declarers'), ('B', 'Opponents')])),
+                ('ready', models.BooleanField(default=False)),
+                ('turn', models.IntegerField()),
+                ('points', models.IntegerField(default=0)),
+                ('hand', models.CharField(max_length=200, default='')),
+                ('play', models.CharField(max_length=200, default='')),
+                ('game', models.ForeignKey(to='main.Game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Player',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('rank', models.IntegerField(default=2, choices=[(2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6'), (7, '7'), (8, '8'), (9, '9'), (10, '10'), (11, 'Jack'), (12, 'Queen'), (13, 'King'), (14, 'Ace'), (17, 'Black'), (18, 'Red')])),
+                ('plus', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='player',
+            field=models.ForeignKey(to='main.Player'),
+        ),
+    ]
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_ranked(apps, schema_editor):
+    # Games finished before ranked was added had their ranks applied as the last trick was played
+    Game = apps.get_model('main', 'Game')
+    Game.objects.filter(stage='5').update(ranked=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedGame',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('seed', models.BigIntegerField(blank=True, null=True)),
+                ('trump_rank', models.IntegerField(choices=[(2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6'), (7, '7'), (8, '8'), (9, '9'), (10, '10'), (11, 'Jack'), (12, 'Queen'), (13, 'King'), (14, 'Ace'), (17, 'Black'), (18, 'Red')])),
+                ('trump_suit', models.CharField(max_length=1, choices=[('C', 'Clubs'), ('D', 'Diamonds'), ('H', 'Hearts'), ('S', 'Spades'), ('J', 'Joker')])),
+                ('kitty', models.CharField(max_length=100)),
+                ('friend_cards', models.CharField(max_length=100, default='')),
+                ('winner', models.CharField(max_length=1, default='A', choices=[('A', 'Declarers'), ('B', 'Opponents')])),
+                ('points', models.IntegerField(default=0)),
+                ('next_game_id', models.IntegerField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedGamePlayer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('turn', models.IntegerField()),
+                ('team', models.CharField(max_length=1, default='B', choices=[('A', 'Declarers'), ('B', 'Opponents')])),
+                ('points', models.IntegerField(default=0)),
+                ('game', models.ForeignKey(to='main.ArchivedGame')),
+            ],
+            options={
+                'ordering': ('turn',),
+            },
+        ),
+        migrations.CreateModel(
+            name='GameProjection',
+            fields=[
+                ('game_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('version', models.IntegerField(default=0)),
+                ('writes', models.BooleanField(default=False)),
+                ('public', models.TextField()),
+                ('players', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlayerStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('games_played', models.IntegerField(default=0)),
+                ('declarer_games', models.IntegerField(default=0)),
+                ('declarer_wins', models.IntegerField(default=0)),
+                ('opponent_wins', models.IntegerField(default=0)),
+                ('opponent_points', models.IntegerField(default=0)),
+                ('tractors_led', models.IntegerField(default=0)),
+                ('friends_found', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('name', models.CharField(max_length=100)),
+                ('args', models.TextField(default='[]')),
+                ('status', models.CharField(max_length=1, db_index=True, default='1', choices=[('1', 'Pending'), ('2', 'Running'), ('3', 'Done'), ('4', 'Failed')])),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tournament',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('name', models.CharField(max_length=100)),
+                ('table_size', models.IntegerField(default=4)),
+                ('rounds', models.IntegerField(default=3)),
+                ('round', models.IntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TournamentPlayer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('score', models.IntegerField(default=0)),
+                ('played', models.IntegerField(default=0)),
+                ('met', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TournamentTable',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('round', models.IntegerField()),
+                ('finished', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrickHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('number', models.IntegerField()),
+                ('leader', models.IntegerField()),
+                ('winner', models.IntegerField()),
+                ('plays', models.CharField(max_length=1000)),
+                ('points', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('game', 'number'),
+            },
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='ranked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='remaining',
+            field=models.CharField(max_length=400, default=''),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='ruleset',
+            field=models.CharField(max_length=20, default='standard', choices=[('kitty_x4', 'Kitty x4'), ('standard', 'Standard')]),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='seed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='stats_recorded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='trick',
+            field=models.CharField(max_length=400, default=''),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='tricks',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='hand_index',
+            field=models.CharField(max_length=200, default=''),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='bot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='trickhistory',
+            name='game',
+            field=models.ForeignKey(related_name='history', on_delete=django.db.models.deletion.DO_NOTHING, to='main.Game', db_constraint=False),
+        ),
+        migrations.AddField(
+            model_name='tournamenttable',
+            name='game',
+            field=models.OneToOneField(related_name='table', to='main.Game'),
+        ),
+        migrations.AddField(
+            model_name='tournamenttable',
+            name='tournament',
+            field=models.ForeignKey(related_name='tables', to='main.Tournament'),
+        ),
+        migrations.AddField(
+            model_name='tournamentplayer',
+            name='player',
+            field=models.ForeignKey(to='main.Player'),
+        ),
+        migrations.AddField(
+            model_name='tournamentplayer',
+            name='tournament',
+            field=models.ForeignKey(to='main.Tournament'),
+        ),
+        migrations.AddField(
+            model_name='playerstats',
+            name='player',
+            field=models.OneToOneField(related_name='stats', to='main.Player'),
+        ),
+        migrations.AddField(
+            model_name='archivedgameplayer',
+            name='player',
+            field=models.ForeignKey(to='main.Player'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='trickhistory',
+            unique_together=set([('game', 'number')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='tournamenttable',
+            index_together=set([('tournament', 'round', 'finished')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tournamentplayer',
+            unique_together=set([('tournament', 'player')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='tournamentplayer',
+            index_together=set([('tournament', 'score')]),
+        ),
+        migrations.RunPython(mark_ranked, migrations.RunPython.noop),
+    ]
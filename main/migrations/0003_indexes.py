@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_game_state_and_tables'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='gameplayer',
+            options={'ordering': ('turn',)},
+        ),
+        migrations.AlterUniqueTogether(
+            name='gameplayer',
+            unique_together=set([('game', 'turn'), ('game', 'player')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='gameplayer',
+            index_together=set([('game', 'team')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='player',
+            index_together=set([('rank', 'plus'), ('bot', 'user')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def copy_games(apps, schema_editor):
+    FriendCard = apps.get_model('main', 'FriendCard')
+    Through = apps.get_model('main', 'Game').friend_cards.through
+    for game_id, friend_card_id in Through.objects.values_list('game_id', 'friendcard_id'):
+        FriendCard.objects.filter(id=friend_card_id).update(game=game_id)
+    # Cards saved for a reserve that was then rejected never belonged to a game
+    FriendCard.objects.filter(game=None).delete()
+
+
+def copy_friend_cards(apps, schema_editor):
+    FriendCard = apps.get_model('main', 'FriendCard')
+    Through = apps.get_model('main', 'Game').friend_cards.through
+    Through.objects.bulk_create(Through(game_id=game_id, friendcard_id=friend_card_id)
+                                for friend_card_id, game_id in FriendCard.objects.values_list('id', 'game_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='friendcard',
+            name='game',
+            field=models.ForeignKey(related_name='+', to='main.Game', null=True),
+        ),
+        migrations.RunPython(copy_games, copy_friend_cards),
+        migrations.RemoveField(
+            model_name='game',
+            name='friend_cards',
+        ),
+        migrations.AlterField(
+            model_name='friendcard',
+            name='game',
+            field=models.ForeignKey(related_name='friend_cards', to='main.Game'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='friends',
+            field=models.CharField(max_length=200, blank=True, null=True, default=None),
+        ),
+    ]
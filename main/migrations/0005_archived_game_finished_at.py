@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_finished(apps, schema_editor):
+    # Games that finished before finished_at was recorded are counted as finishing now,
+    # so they're exported once and archived after the retention window like any other
+    Game = apps.get_model('main', 'Game')
+    Game.objects.filter(stage='5', finished_at=None).update(finished_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_friend_card_game'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedgame',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+        migrations.RunPython(mark_finished, migrations.RunPython.noop),
+    ]
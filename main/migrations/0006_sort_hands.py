@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def sort_hands(apps, schema_editor):
+    # Hands of games in progress were stored in the order they were dealt before
+    # they were kept in display order
+    from main.rules import Cards, display_key
+
+    Game = apps.get_model('main', 'Game')
+    GamePlayer = apps.get_model('main', 'GamePlayer')
+    trumps = dict((game_id, (trump_suit, trump_rank)) for game_id, trump_suit, trump_rank in
+                  Game.objects.filter(stage__in=('2', '3', '4')).values_list('id', 'trump_suit', 'trump_rank'))
+    for player in GamePlayer.objects.filter(game__in=list(trumps)).exclude(hand=''):
+        hand = Cards.fromstr(player.hand)
+        hand.sort(display_key(*trumps[player.game_id]))
+        if str(hand) != player.hand:
+            player.hand = str(hand)
+            player.save(update_fields=['hand'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_archived_game_finished_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(sort_hands, migrations.RunPython.noop),
+    ]
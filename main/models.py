@@ -1,14 +1,13 @@
-from collections import Counter, deque
-from functools import total_ordering
-import itertools
+from collections import Counter, OrderedDict, deque
+import contextlib
 import json
 import logging
 import random
+import threading
 
-from django import forms
-from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
 
 
 DECLARERS = 'A'
@@ -61,299 +60,86 @@ RANK_CHOICES = (
 logger = logging.getLogger(__name__)
 
 
-@total_ordering
-class Card(object):
-    def __init__(self, suit, rank):
-        self.suit = suit
-        self.rank = rank
-
-    @classmethod
-    def fromstr(cls, s):
-        return cls(suit=s[0], rank=int(s[1:]))
-
-    def __eq__(self, other):
-        return (self.suit, self.rank) == (other.suit, other.rank)
-
-    def __lt__(self, other):
-        return (SUITS.index(self.suit), self.rank) < (SUITS.index(other.suit), other.rank)
-
-    def __str__(self):
-        return self.suit + str(self.rank)
-
-    def __hash__(self):
-        return hash((self.suit, self.rank))
-
-    def image(self):
-        return '{}_of_{}.png'.format(dict(RANK_CHOICES)[self.rank], dict(SUIT_CHOICES)[self.suit]).lower()
-
-    def repr(self):
-        return {'card': str(self), 'image': self.image()}
-
-    def is_trump(self, trump_suit, trump_rank):
-        return self.suit in (trump_suit, JOKER) or self.rank == trump_rank
-
-    def get_suit(self, trump_suit, trump_rank):
-        if self.is_trump(trump_suit, trump_rank):
-            return TRUMP
-        else:
-            return self.suit
-
-    def get_rank(self, trump_suit, trump_rank):
-        if self.rank == trump_rank:
-            if self.suit == trump_suit:
-                return ONSUIT_TRUMP
-            else:
-                return OFFSUIT_TRUMP
-        else:
-            return self.rank
-
-
-def create_deck():
-    return ([Card(suit, rank) for suit in NORMAL_SUITS for rank in NORMAL_RANKS] +
-            [Card(JOKER, rank) for rank in (BLACK, RED)])
-
-
-def is_consecutive(cards, trump_suit, trump_rank):
-    if len(cards) < 2:
-        return False
-
-    ranks = [card.get_rank(trump_suit, trump_rank) for card in cards]
-    min_rank = min(ranks)
-    max_rank = max(ranks)
-    return (sorted(ranks + [trump_rank]) == list(range(min_rank, max_rank + 1)) if min_rank < trump_rank < max_rank else
-            sorted(ranks) == list(range(min_rank, max_rank + 1)))
-
-
-class Cards(object):
-    def __init__(self, cards=None):
-        if cards is None:
-            self.cards = []
-        else:
-            self.cards = cards[:]
-
-    @classmethod
-    def fromstr(cls, s):
-        return cls(cards=[Card.fromstr(ss) for ss in s.split(',')] if s else [])
-
-    def __len__(self):
-        return len(self.cards)
-
-    def __contains__(self, items):
-        cards = self.cards[:]
-
-        for item in items:
-            try:
-                cards.remove(item)
-            except ValueError:
-                return False
-
-        return True
-
-    def __str__(self):
-        return ','.join(str(card) for card in self.cards)
-
-    def add_card(self, card):
-        self.cards.append(card)
-
-    def add_cards(self, cards):
-        for card in cards:
-            self.cards.append(card)
-
-    def play_card(self, card):
-        self.cards.remove(card)
-
-    def play_cards(self, cards):
-        for card in cards:
-            self.cards.remove(card)
-
-    def pop(self):
-        return self.cards.pop()
-
-    def sort(self, key=None):
-        if key is None:
-            self.cards.sort(key=key)
-        else:
-            self.cards.sort()
-
-    def single_suit(self, trump_suit, trump_rank):
-        suits = set(card.get_suit(trump_suit, trump_rank) for card in self.cards)
-        if len(suits) == 1:
-            return suits.pop()
-        else:
-            return None
-
-    def has_suit(self, suit, trump_suit, trump_rank):
-        return any(card.get_suit(trump_suit, trump_rank) == suit for card in self.cards)
-
-
-@total_ordering
-class CardCombinations(object):
-    def __init__(self, cards=None, trump_suit=None, trump_rank=None, consecutive=True):
-        self.cards = []
-        self.suit = None
-        self.rank = None
-        self.combinations = []
-        self.can_win = True
-        if cards:
-            self.init(cards, trump_suit, trump_rank, consecutive)
-
-    def __eq__(self, other):
-        return (self.suit, self.rank) == (other.suit, other.rank)
-
-    def __lt__(self, other):
-        if self.suit != TRUMP and other.suit == TRUMP:
-            return True
-        if self.suit == TRUMP and other.suit != TRUMP:
-            return False
-        return self.rank < other.rank
-
-    def init(self, cards, trump_suit, trump_rank, consecutive=True):
-        self.cards = str(Cards(cards))
-        self.suit = cards[0].get_suit(trump_suit, trump_rank)
-        self.rank = max(card.get_rank(trump_suit, trump_rank) for card in cards)
-        ranks = Counter(card for card in cards)
-
-        if consecutive:
-            subsets = {}
-            for k, v in ranks.items():
-                if v >= 2:
-                    subsets.setdefault(v, []).append(k)
-
-            for n, subset in subsets.items():
-                i = len(subset)
-                while i > 1:
-                    permutations = itertools.permutations(subset, i)
-                    for p in permutations:
-                        if is_consecutive(p, trump_suit, trump_rank):
-                            self.combinations.append(
-                                {'n': n, 'consecutive': i,
-                                 'rank': max(card.get_rank(trump_suit, trump_rank) for card in p)})
-                            for rank in p:
-                                del ranks[rank]
-                                subset.remove(rank)
-                            i = len(subset)
-                            break
-                    else:
-                        i -= 1
-
-        for k, v in ranks.items():
-            self.combinations.append({'n': v, 'consecutive': 1, 'rank': k.get_rank(trump_suit, trump_rank)})
-
-    def validate(self, before, after):
-        # Check which combinations are matched with hand
-        for first_player_combination in self.combinations:
-            remove = []
-            if first_player_combination['consecutive'] >= 2:
-                match = [combination for combination in before.combinations
-                         if combination['consecutive'] >= 2 and
-                         first_player_combination['n'] == combination['n']][:1]
-                if match:
-                    first_player_combination['match'] = True
-                    remove.extend(match)
-
-                else:
-                    self.can_win = False
-                    match = [combination for combination in before.combinations
-                             if first_player_combination['n'] == combination['n']][:first_player_combination['consecutive']]
-                    if match:
-                        first_player_combination['match'] = len(match)
-                        remove.extend(match)
-
-            else:
-                match = [combination for combination in before.combinations
-                         if first_player_combination['n'] == combination['n']][:1]
-                if match:
-                    first_player_combination['match'] = True
-                    remove.extend(match)
-                else:
-                    self.can_win = False
-
-            for r in remove:
-                before.combinations.remove(r)
-
-        # Check which combinations are matched with cards played
-        for first_player_combination in self.combinations:
-            if 'match' not in first_player_combination:
-                continue
-
-            remove = []
-            if first_player_combination['consecutive'] >= 2:
-                if first_player_combination['match'] is True:
-                    match = [combination for combination in after.combinations
-                             if combination['consecutive'] >= 2 and
-                             first_player_combination['n'] == combination['n']][:1]
-                    if match:
-                        remove.extend(match)
-                    else:
-                        return "Consecutive pairs have to be played"
-
-                else:
-                    match = [combination for combination in after.combinations
-                             if first_player_combination['n'] == combination['n']][:first_player_combination['consecutive']]
-                    if len(match) >= first_player_combination['match']:
-                        remove.extend(match)
-                    else:
-                        return "Pairs have to be played"
-
-            else:
-                match = [combination for combination in after.combinations
-                         if first_player_combination['n'] == combination['n']][:1]
-                if match:
-                    first_player_combination['match'] = True
-                    remove.extend(match)
-                else:
-                    return "Pairs have to be played"
-
-            for r in remove:
-                after.combinations.remove(r)
-
-    def encode(self):
-        return json.dumps({'suit': self.suit, 'rank': self.rank, 'combinations': self.combinations, 'cards': self.cards})
-
-    @classmethod
-    def decode(cls, s):
-        try:
-            play_dict = json.loads(s)
-        except TypeError:
-            play_dict = json.loads(str(s, 'utf-8'))
-        play = cls()
-        play.suit = play_dict['suit']
-        play.rank = play_dict['rank']
-        play.combinations = play_dict['combinations']
-        play.cards = play_dict['cards']
-        return play
+STANDARD = 'standard'
+
+RULESETS = {
+    STANDARD: {
+        'name': 'Standard',
+        # Number of players: (number of decks, hand size, kitty size)
+        'layouts': {
+            4: (2, 25, 8),  # 2 * 54 = 108; 4 * 25 + 8 = 108
+            5: (2, 20, 8),  # 2 * 54 = 108; 5 * 20 + 8 = 108
+            6: (3, 26, 6),  # 3 * 54 = 162; 6 * 26 + 6 = 162
+            7: (3, 22, 8),  # 3 * 54 = 162; 7 * 22 + 8 = 162
+            8: (4, 26, 8),  # 4 * 54 = 216; 8 * 26 + 8 = 216
+        },
+        'points': {FIVE: 5, TEN: 10, KING: 10},
+        # Opponents taking the last trick get the kitty's points this many times
+        'kitty_multiplier': 2,
+        # Opponent points needed to win
+        'win': 80,
+        # (lowest opponent points, team that goes up, ranks gained), best first;
+        # the last entry is for fewer points than any of the others
+        'ranks': ((160, OPPONENTS, 3), (120, OPPONENTS, 2), (80, OPPONENTS, 1),
+                  (40, DECLARERS, 1), (0, DECLARERS, 2), (None, DECLARERS, 3)),
+    },
+}
+RULESETS['kitty_x4'] = dict(RULESETS[STANDARD], name='Kitty x4', kitty_multiplier=4)
+RULESET_CHOICES = tuple(sorted((key, ruleset['name']) for key, ruleset in RULESETS.items()))
+
+
+_deferred = threading.local()
+
+
+@contextlib.contextmanager
+def deferred_projections():
+    """Build the projections of games saved inside the block once each, as it ends.
+
+    Used outside a transaction, they're built after it commits rather than
+    inside the write, and not at all if it's rolled back.
+    """
+    if getattr(_deferred, 'games', None) is not None:
+        # The outermost block builds them
+        yield
+        return
+    games = _deferred.games = OrderedDict()
+    try:
+        yield
+    finally:
+        _deferred.games = None
+    for game in games.values():
+        game.project()
+
+
+class WriteBehind(object):
+    """Mixin for rows of a game that can be held in a GameSession, see main.sessions.
+
+    While the game is in a session its saves are appended to the session's
+    write-behind log instead of going to the database.
+    """
+    session = None
+
+    def save(self, *args, **kwargs):
+        if self.session is not None and self.session.defer(self):
+            return
+        super(WriteBehind, self).save(*args, **kwargs)
 
 
 class FriendCard(models.Model):
+    game = models.ForeignKey('Game', related_name='friend_cards')
     number = models.IntegerField()
     suit = models.CharField(max_length=1, choices=SUIT_CHOICES)
     rank = models.IntegerField(choices=RANK_CHOICES)
     counter = models.IntegerField(default=0)
     found = models.BooleanField(default=False)
 
-    def check(self, player, card):
-        if card.suit == self.suit and card.rank == self.rank:
-            self.counter += 1
-            if self.counter == self.number:
-                self.found = True
-                player.team = DECLARERS
-                player.save()
-            self.save()
-
     @classmethod
     def fromstr(cls, s):
-        ret = []
-        for card in s.split(","):
-            friend_card = cls()
-            friend_card.number = card[0]
-            friend_card.suit = card[1]
-            friend_card.rank = card[2:]
-            friend_card.save()
-            ret.append(friend_card)
-        return ret
-
-
-class Game(models.Model):
+        """Return unsaved friend cards, e.g. '1H14,2S14' for the first ace of hearts and the second of spades."""
+        return [cls(number=int(card[0]), suit=card[1], rank=int(card[2:])) for card in s.split(",")]
+
+
+class Game(WriteBehind, models.Model):
     SETUP = '1'
     DEAL = '2'
     RESERVE = '3'
@@ -376,9 +162,11 @@ class Game(models.Model):
     winner = models.CharField(max_length=1, choices=TEAM_CHOICES, default=DECLARERS)
     next_game = models.OneToOneField('self', blank=True, null=True, default=None)
     find_friends = models.BooleanField(default=False)
-    friend_cards = models.ManyToManyField(FriendCard)
+    # Friend cards still to be found, see FriendLookup, None until they're called
+    friends = models.CharField(max_length=200, blank=True, null=True, default=None)
 
     # Cards
+    seed = models.BigIntegerField(blank=True, null=True)
     deck = models.CharField(max_length=1000)
     kitty = models.CharField(max_length=100)
 
@@ -389,18 +177,51 @@ class Game(models.Model):
     trump_count = models.IntegerField(default=0)
     trump_broken = models.BooleanField(default=False)
 
-    SETTINGS = {
-        # (number of players, number of decks, hand size))
-        4: (2, 25, 8),  # 2 * 54 = 108; 4 * 25 + 8 = 108
-        5: (2, 20, 8),  # 2 * 54 = 108; 5 * 20 + 8 = 108
-        6: (3, 25, 6),  # 3 * 54 = 162; 6 * 26 + 6 = 162
-        7: (3, 25, 8),  # 3 * 54 = 162; 7 * 22 + 8 = 162
-        8: (4, 25, 8),  # 4 * 54 = 216; 8 * 26 + 8 = 216
-    }
+    # Trick in progress, see Trick, and the number of tricks finished
+    trick = models.CharField(max_length=400, default='')
+    tricks = models.IntegerField(default=0)
+    # Cards not played yet, see CardTracker
+    remaining = models.CharField(max_length=400, default='')
+
+    # Set once the result has been applied to the players' ranks and stats
+    ranked = models.BooleanField(default=False)
+    stats_recorded = models.BooleanField(default=False)
+    finished_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    ruleset = models.CharField(max_length=20, choices=RULESET_CHOICES, default=STANDARD)
+    # Bumped on every save, so each change to the game or its players is a new version
+    version = models.IntegerField(default=0)
+
+    # Layouts of the standard rules, see RULESETS
+    SETTINGS = RULESETS[STANDARD]['layouts']
 
     def __str__(self):
         return 'Game #{}'.format(self.id)
 
+    def save(self, *args, **kwargs):
+        # Methods that change players save them before the game, so a version includes their changes
+        if self.session is not None or self._state.adding:
+            # A session is the only writer of its game
+            self.version += 1
+            super(Game, self).save(*args, **kwargs)
+        else:
+            # Bumped in the database so concurrent writers never get the same version
+            version = self.version
+            try:
+                with transaction.atomic():
+                    self.version = models.F('version') + 1
+                    super(Game, self).save(*args, **kwargs)
+                    self.version = Game.objects.values_list('version', flat=True).get(id=self.id)
+            except Exception:
+                self.version = version
+                raise
+        # A session rebuilds the projection when its writes reach the database
+        if self.session is None:
+            deferred = getattr(_deferred, 'games', None)
+            if deferred is None:
+                self.project()
+            else:
+                deferred[self.id] = self
+
     def get_absolute_url(self):
         from django.core.urlresolvers import reverse
         return reverse('main.views.game', args=[str(self.id)])
@@ -409,66 +230,97 @@ class Game(models.Model):
         return ', '.join(str(player) for player in self.gameplayer_set.all())
 
     def get_points(self):
+        if self.session is not None:
+            return sum(player.points for player in self.session.players if player.team == OPPONENTS)
         return sum(player.points for player in self.gameplayer_set.filter(team=OPPONENTS))
 
     def get_status(self):
         return 'Stage: {}, Score: {}'.format(self.get_stage_display(), self.get_points())
 
     def number_of_friends(self):
-        return self.gameplayer_set.count() // 2 - 1
+        return self.number_of_players() // 2 - 1
 
     def number_of_players(self):
+        if self.session is not None:
+            return len(self.session.players)
         return self.gameplayer_set.count()
 
+    def get_players(self):
+        """Return the players in turn order, the session's own while the game is in one."""
+        if self.session is not None:
+            return self.session.players
+        return list(self.gameplayer_set.select_related('player__user'))
+
+    def get_friend_lookup(self):
+        from main.rules import FriendLookup
+
+        if self.friends is not None:
+            return FriendLookup.decode(self.friends)
+
+        # Games whose friends were called before the lookup was stored
+        return FriendLookup.build(self.friend_cards.all())
+
+    def rules(self):
+        from main.rules import get_ruleset
+
+        return get_ruleset(self.ruleset)
+
     def number_of_decks(self, number_of_players=None):
         if number_of_players is None:
-            return Game.SETTINGS[self.number_of_players()][0]
+            return self.rules().layouts[self.number_of_players()][0]
         else:
-            return Game.SETTINGS[number_of_players][0]
+            return self.rules().layouts[number_of_players][0]
 
     def hand_size(self):
-        return Game.SETTINGS[self.number_of_players()][1]
+        return self.rules().layouts[self.number_of_players()][1]
 
     def reserve_size(self):
-        return Game.SETTINGS[self.number_of_players()][2]
+        return self.rules().layouts[self.number_of_players()][2]
 
     @classmethod
-    def setup(cls, players, shuffle=False, find_friends=False):
-        if shuffle:
-            random.shuffle(players)
+    def setup(cls, players, shuffle=False, find_friends=False, ruleset=STANDARD):
+        games = cls.bulk_setup([players], shuffle, find_friends, ruleset)
+        return games[0] if games else False
 
-        game = cls()
-        game.find_friends = find_friends
-        game.trump_rank = players[0].rank
+    @classmethod
+    def bulk_setup(cls, tables, shuffle=False, find_friends=False, ruleset=STANDARD):
+        from main.rules import deck_pool, get_ruleset
 
-        try:
-            deck = [card for _ in range(game.number_of_decks(len(players))) for card in create_deck()]
-        except KeyError:
+        if ruleset not in RULESETS or any(len(players) not in get_ruleset(ruleset).layouts for players in tables):
             return False
 
-        random.shuffle(deck)
-        game.deck = ','.join(map(str, deck))
-        game.kitty = ''
-        game.save()
-
-        if len(players) == 4:
-            for turn, player in enumerate(players):
-                if turn % 2 == 0:
-                    team = DECLARERS
-                else:
-                    team = OPPONENTS
-                GamePlayer.objects.create(game=game, player=player, team=team, turn=turn)
-        else:
-            for turn, player in enumerate(players):
-                if turn == 0:
-                    team = DECLARERS
-                else:
-                    team = OPPONENTS
-                GamePlayer.objects.create(game=game, player=player, team=team, turn=turn)
-            game.find_friends = True
+        games = []
+        game_players = []
+        # The games are projected once they're committed with their players
+        with deferred_projections(), transaction.atomic():
+            for players in tables:
+                if shuffle:
+                    random.shuffle(players)
+
+                game = cls(ruleset=ruleset)
+                game.find_friends = find_friends or len(players) != 4
+                game.trump_rank = players[0].rank
+                game.seed, game.deck = deck_pool.draw(game.number_of_decks(len(players)))
+                game.kitty = ''
+                game.save()
+                games.append(game)
+
+                for turn, player in enumerate(players):
+                    if len(players) == 4:
+                        team = DECLARERS if turn % 2 == 0 else OPPONENTS
+                    else:
+                        team = DECLARERS if turn == 0 else OPPONENTS
+                    game_players.append(GamePlayer(game=game, player=player, team=team, turn=turn,
+                                                   ready=player.bot))
+
+            GamePlayer.objects.bulk_create(game_players)
+        return games
+
+    def shuffled_deck(self):
+        """Return the deck as it was dealt, rebuilt from the game's seed."""
+        from main.rules import DeckPool
 
-        game.save()
-        return game
+        return DeckPool.shuffle(self.number_of_decks(), self.seed)
 
     def ready(self, player):
         if self.stage != Game.SETUP:
@@ -477,11 +329,13 @@ class Game(models.Model):
         player.ready = True
         player.save()
 
-        if all(player.ready for player in self.gameplayer_set.all()):
+        if all(player.ready for player in self.get_players()):
             self.stage = Game.DEAL
-            self.save()
+        self.save()
 
     def deal(self, player):
+        from main.rules import Cards, display_key
+
         if self.stage != Game.DEAL or not player.your_turn():
             return False
 
@@ -493,16 +347,18 @@ class Game(models.Model):
         draw = deck.pop()
         self.deck = str(deck)
 
-        player_hand.add_card(draw)
+        player_hand.insert_cards([draw], display_key(self.trump_suit, self.trump_rank))
         player.hand = str(player_hand)
 
         self.turn = (self.turn + 1) % self.number_of_players()
-        self.save()
         player.save()
+        self.save()
 
         return draw
 
     def set_trump_suit(self, player, cards):
+        from main.rules import CardCombinations, Cards
+
         if self.stage != Game.DEAL:
             return False
 
@@ -518,36 +374,55 @@ class Game(models.Model):
 
         if len(cards) > self.trump_count:
             self.trump_count = len(cards)
-            self.trump_suit = cards[0].suit
-            self.save()
+            if cards[0].suit != self.trump_suit:
+                self.trump_suit = cards[0].suit
+                self.sort_hands(player)
 
             play = CardCombinations(cards, self.trump_suit, self.trump_rank)
             player.play = play.encode()
             player.save()
+            self.save()
         else:
             return "Not enough cards to change trump suit"
 
+    def sort_hands(self, player):
+        """Re-sort the hands for a new trump suit, saving all but player's, which the caller saves."""
+        from main.rules import display_key
+
+        key = display_key(self.trump_suit, self.trump_rank)
+        for other in [player] + [other for other in self.get_players() if other.id != player.id]:
+            hand = other.get_hand()
+            hand.sort(key)
+            other.hand = str(hand)
+            if other is not player:
+                other.save(update_fields=['hand'])
+
     def pickup_reserve(self, player):
+        from main.rules import Cards, display_key
+
         if self.stage != Game.DEAL or player.turn != 0 or len(player.get_hand()) != self.hand_size():
             return False
 
         reserve = Cards.fromstr(self.deck)
         if not self.trump_suit:
             self.trump_suit = reserve.cards[0].suit
+            self.sort_hands(player)
         self.deck = ''
         self.stage = Game.RESERVE
-        self.save()
 
         player_hand = player.get_hand()
-        player_hand.add_cards(reserve.cards)
+        player_hand.insert_cards(reserve.cards, display_key(self.trump_suit, self.trump_rank))
         player.hand = str(player_hand)
         player.save()
 
-        for player in self.gameplayer_set.all():
-            player.play = ''
-            player.save()
+        for other in self.get_players():
+            other.play = ''
+            other.save(update_fields=['play'])
+        self.save()
 
     def reserve(self, player, cards, friend_cards=None):
+        from main.rules import CardTracker, Cards, FriendLookup, HandIndex
+
         if self.stage != Game.RESERVE or player.turn != 0:
             return False
 
@@ -566,7 +441,10 @@ class Game(models.Model):
                 return False
 
             for friend_card in friend_cards:
-                self.friend_cards.add(friend_card)
+                friend_card.game = self
+            FriendCard.objects.bulk_create(friend_cards)
+            # bulk_create doesn't set the ids on every database, so they're read back for the lookup
+            self.friends = FriendLookup.build(self.friend_cards.all()).encode()
 
         player_hand.play_cards(cards)
         player.hand = str(player_hand)
@@ -577,9 +455,125 @@ class Game(models.Model):
         self.stage = Game.PLAY
         self.turn = 0
         self.trick_turn = 0
+        self.remaining = CardTracker.full(self.number_of_decks()).encode()
         self.save()
 
+        # Trump is settled and hands are final, so the hand indexes can be built
+        for other in self.get_players():
+            other.hand_index = HandIndex.build(other.get_hand().cards, self.trump_suit, self.trump_rank).encode()
+            other.save(update_fields=['hand_index'])
+
+    def get_remaining(self):
+        """Return the tracker of cards not played yet, or None before play starts."""
+        from main.rules import CardTracker, Cards
+
+        if self.remaining:
+            return CardTracker.decode(self.remaining)
+        if self.stage not in (Game.PLAY, Game.SCORE):
+            return None
+
+        # Games started before the tracker was stored: every card not played is in a hand or the kitty
+        cards = Cards.fromstr(self.kitty).cards
+        for player in self.get_players():
+            cards.extend(player.get_hand().cards)
+        return CardTracker.fromcards(cards)
+
+    def unseen(self, player, remaining=None):
+        """Return the cards still out that player can't see, grouped by effective suit, none before play starts."""
+        from main.rules import Cards
+
+        if remaining is None:
+            remaining = self.get_remaining()
+            if remaining is None:
+                return {}
+        cards = player.get_hand().cards
+        if player.turn == 0 and self.stage in (Game.PLAY, Game.SCORE):
+            cards += Cards.fromstr(self.kitty).cards
+        return remaining.unseen(cards).repr(self.trump_suit, self.trump_rank)
+
+    def public_status(self, players):
+        """Return what anyone may see of the game, as served to spectators."""
+        seat = (self.turn + self.trick_turn) % len(players) if players else None
+        plays = [sorted(player.get_play().card_list) if player.play else [] for player in players]
+        return {
+            'version': self.version,
+            'stage': self.stage,
+            'status': {
+                'trump_rank': self.get_trump_rank_display(),
+                'trump_suit': self.get_trump_suit_display(),
+                'turn': next((str(player) for player in players if player.turn == seat), '')
+            },
+            'players': [{'name': str(player),
+                         'ready': player.ready,
+                         'team': player.team,
+                         'points': player.points,
+                         'cards': [card.repr() for card in play]} for player, play in zip(players, plays)],
+            'friends': len(players) // 2 - 1 if self.find_friends else 0,
+            'winner': 'Red' if self.winner == DECLARERS else 'Blue',
+            'points': sum(player.points for player in players if player.team == OPPONENTS),
+        }
+
+    def player_status(self, player, players, public=None, remaining=None, new_cards=()):
+        """Return what /status sends to player: the public status with their hand."""
+        if public is None:
+            public = self.public_status(players)
+        your_turn = player.turn == (self.turn + self.trick_turn) % len(players)
+        # Hands are kept in display order as they change
+        hand = player.get_hand().cards
+        return dict(public, **{
+            'ready': player.ready,
+            'turn': your_turn,
+            'reserve': self.stage == Game.DEAL and your_turn and len(hand) == self.hand_size(),
+            'hand': {
+                'player': str(player),
+                'str': player.hand,
+                'cards': [card.repr() for card in hand],
+                'new_cards': list(new_cards),
+            },
+            'unseen': self.unseen(player, remaining),
+        })
+
+    def bot_turn(self, players=None):
+        """Return the bot whose move it is, or None when it's a person's or nobody's."""
+        if players is None:
+            players = self.get_players()
+        if not players or self.stage not in (Game.DEAL, Game.RESERVE, Game.PLAY):
+            return None
+        seat = 0 if self.stage == Game.RESERVE else (self.turn + self.trick_turn) % len(players)
+        return next((player for player in players if player.turn == seat and player.player.bot), None)
+
+    def polling_writes(self, players):
+        """Return whether polling /status has work to do, dealing or starting the bots."""
+        return self.stage == Game.DEAL or self.bot_turn(players) is not None
+
+    def project(self):
+        """Rebuild the game's GameProjection from the write tables."""
+        players = list(self.gameplayer_set.select_related('player__user'))
+        for player in players:
+            player.game = self
+        public = self.public_status(players)
+        remaining = self.get_remaining()
+        GameProjection(game_id=self.id, version=self.version, writes=self.polling_writes(players),
+                       public=json.dumps(public),
+                       players=json.dumps(dict((str(player), self.player_status(player, players, public, remaining))
+                                               for player in players))).save()
+
+    def get_trick(self):
+        from main.rules import Trick
+
+        if self.trick:
+            return Trick.decode(self.trick)
+
+        # Tricks started before the trick state was stored are rebuilt from the plays
+        players = self.gameplayer_set.all()
+        trick = Trick.start(list(players[self.turn].get_play().card_list), self.trump_suit, self.trump_rank)
+        lead_play = players[self.lead].get_play()
+        trick.winner = [lead_play.suit, lead_play.rank]
+        return trick
+
     def play(self, player, cards):
+        from main.rules import CardCombinations, Cards, Trick, check_follow, check_lead
+
         if self.stage != Game.PLAY or not player.your_turn():
             return False
 
@@ -588,171 +582,169 @@ class Game(models.Model):
             return False
 
         if self.trick_turn == 0:
-            for other in self.gameplayer_set.all():
+            other_hands = [other.get_hand_index() for other in self.get_players() if other != player]
+            ret, cards, self.trump_broken = check_lead(cards, player_hand, other_hands,
+                                                       self.trump_suit, self.trump_rank, self.trump_broken)
+            if ret:
+                return ret
+
+            for other in self.get_players():
                 other.play = ''
                 other.save()
 
-            # First player has to play a single suit
-            cards_played = Cards(cards)
-            cards_played_suit = cards_played.single_suit(self.trump_suit, self.trump_rank)
-            if cards_played_suit is None:
-                return "Cards have to be a single suit"
-            if cards_played_suit == TRUMP and not self.trump_broken:
-                if set(card.get_suit(self.trump_suit, self.trump_rank) for card in cards) != set(TRUMP):
-                    return "Trump hasn't been broken yet"
-                else:
-                    self.trump_broken = True
-
-            # If combination is played, remove cards that aren't highest
-            play = CardCombinations(cards_played.cards, self.trump_suit, self.trump_rank)
-            if len(play.combinations) > 1:
-                for other in self.gameplayer_set.all():
-                    if player == other:
-                        continue
-
-                    other_hand = [card for card in Cards.fromstr(other.hand).cards
-                                  if card.get_suit(self.trump_suit, self.trump_rank) == cards_played_suit]
-                    other_play = CardCombinations(other_hand, self.trump_suit, self.trump_rank, False)
-
-                    not_highest = []
-                    for combination in play.combinations:
-                        if combination['consecutive'] >= 2:
-                            continue
-
-                        for other_combination in other_play.combinations:
-                            if (combination['n'] <= other_combination['n'] and
-                                    combination['rank'] < other_combination['rank']):
-                                not_highest.append(combination)
-
-                    if not_highest:
-                        cards = Cards()
-                        for combination in play.combinations:
-                            if combination['consecutive'] < 2:
-                                continue
-
-                            for rank in range(combination['rank'], combination['rank'] - combination['consecutive'], -1):
-                                cards.add_cards(Card(play.suit, rank) for _ in range(combination['n']))
-
-                        lowest = min(not_highest, key=lambda c: c['rank'])
-                        cards.add_cards(Card(play.suit, lowest['rank']) for _ in range(lowest['n']))
-                        cards = cards.cards
-                        break
+            trick = Trick.start(cards, self.trump_suit, self.trump_rank)
 
         else:
-            # Other players have to play the same number of cards that the first person played
-            first_player_combinations = CardCombinations.decode(self.gameplayer_set.all()[self.turn].play)
-            first_player_cards = Cards.fromstr(first_player_combinations.cards).cards
-            if len(first_player_cards) != len(cards):
-                return "Play same amount of cards"
-
-            # Other players have to play the suit that the first person played
-            cards_played_suit = Cards(cards).single_suit(self.trump_suit, self.trump_rank)
-            hand_after_play = Cards(player_hand.cards)
-            hand_after_play.play_cards(cards)
-
-            if ((not cards_played_suit or cards_played_suit != first_player_combinations.suit) and
-                    hand_after_play.has_suit(first_player_combinations.suit, self.trump_suit, self.trump_rank)):
-                return "Play leading suit"
-
-            if cards_played_suit in (first_player_combinations.suit, TRUMP):
-                if cards_played_suit == TRUMP:
-                    self.trump_broken = True
-
-                first_player_combinations = CardCombinations(first_player_cards,
-                                                             self.trump_suit, self.trump_rank)
-                combinations_before_play = CardCombinations(
-                    [card for card in player_hand.cards
-                     if card.get_suit(self.trump_suit, self.trump_rank) == cards_played_suit],
-                    self.trump_suit, self.trump_rank)
-                combinations_played = CardCombinations(cards, self.trump_suit, self.trump_rank)
-                ret = first_player_combinations.validate(combinations_before_play, combinations_played)
-                if ret:
-                    return ret
-
-                lead_play = CardCombinations.decode(self.gameplayer_set.all()[self.lead].play)
-                logger.debug("first: %s, lead: %s, play: %s",
-                             first_player_combinations.encode(), lead_play.encode(),
-                             CardCombinations(cards, self.trump_suit, self.trump_rank).encode())
-                logger.debug("can win: %s, win: %s", first_player_combinations.can_win, combinations_played > lead_play)
-                if first_player_combinations.can_win and combinations_played > lead_play:
-                    self.lead = (self.turn + self.trick_turn) % self.number_of_players()
+            trick = self.get_trick()
+            ret, combinations_played = check_follow(trick.cards, player_hand, cards,
+                                                    self.trump_suit, self.trump_rank, trick.first_play())
+            if ret:
+                return ret
+
+            if Cards(cards).single_suit(self.trump_suit, self.trump_rank) == TRUMP:
+                self.trump_broken = True
+
+            logger.debug("trick: %s, play: %s", trick.encode(), combinations_played.encode())
+            if trick.follow(combinations_played):
+                self.lead = (self.turn + self.trick_turn) % self.number_of_players()
+        self.trick = trick.encode()
 
         # Check find a friend
-        for friend_card in self.friend_cards.filter(found=False):
-            for card in cards:
-                friend_card.check(player, card)
+        friends_counted = []
+        if self.find_friends:
+            friends = self.get_friend_lookup()
+            friends_counted = friends.play_cards(cards)
+            self.friends = friends.encode()
+            friends_found = sum(1 for _, _, found in friends_counted if found)
+            if friends_found:
+                player.team = DECLARERS
+                PlayerStats.increment(player.player_id, friends_found=friends_found)
+
+        remaining = self.get_remaining()
+        remaining.play_cards(cards)
+        self.remaining = remaining.encode()
 
         player_hand.play_cards(cards)
         player.hand = str(player_hand)
-        play = CardCombinations(cards, self.trump_suit, self.trump_rank).encode()
+        hand_index = player.get_hand_index()
+        hand_index.play_cards(player_hand, cards, self.trump_suit, self.trump_rank)
+        player.hand_index = hand_index.encode()
+        play = CardCombinations(cards, self.trump_suit, self.trump_rank)
         player.play = play.encode()
         player.save()
+        for friend_card_id, counter, found in friends_counted:
+            FriendCard.objects.filter(id=friend_card_id).update(counter=counter, found=found)
 
+        if self.trick_turn == 0 and any(combination['consecutive'] >= 2 for combination in play.combinations):
+            PlayerStats.increment(player.player_id, tractors_led=1)
+
+        rules = self.rules()
         self.trick_turn += 1
-        self.trick_points += (5 * len([card for card in cards if card.rank == FIVE]) +
-                              10 * len([card for card in cards if card.rank == TEN or card.rank == KING]))
+        self.trick_points += rules.points(cards)
 
         # Evaluate plays on last turn
         if self.trick_turn == self.number_of_players():
-            lead = self.gameplayer_set.all()[self.lead]
+            players = self.get_players()
+            history = TrickHistory(game=self, number=self.tricks, leader=self.turn, winner=self.lead,
+                                   plays=';'.join(other.get_play().cards for other in players),
+                                   points=self.trick_points)
+            history.session = self.session
+
+            lead = players[self.lead]
             lead.points += self.trick_points
             lead.save()
 
             self.turn = self.lead
             self.trick_turn = 0
             self.trick_points = 0
+            self.trick = ''
+            self.tricks += 1
 
             if len(player_hand) == 0:
                 self.stage = Game.SCORE
-                lead = self.gameplayer_set.all()[self.lead]
+                self.finished_at = timezone.now()
                 if lead.team == OPPONENTS:
-                    cards = Cards.fromstr(self.kitty).cards
-                    lead.points += 2 * (5 * len([card for card in cards if card.rank == FIVE]) +
-                                        10 * len([card for card in cards if card.rank == TEN or card.rank == KING]))
+                    kitty_points = rules.kitty_multiplier * rules.points(Cards.fromstr(self.kitty).cards)
+                    lead.points += kitty_points
                     lead.save()
+                    history.points += kitty_points
 
-                opponent_points = self.get_points()
-                if opponent_points >= 80:
-                    players = self.gameplayer_set.filter(team=OPPONENTS)
-                    if opponent_points >= 160:
-                        delta = 3
-                    elif opponent_points >= 120:
-                        delta = 2
-                    else:
-                        delta = 1
-                    for player in players:
-                        player.player.add_rank(delta)
-                    for player in self.gameplayer_set.filter(team=DECLARERS):
-                        player.player.plus = False
-                        player.player.save()
+                if self.get_points() >= rules.win:
                     self.winner = OPPONENTS
-                else:
-                    players = self.gameplayer_set.filter(team=DECLARERS)
-                    if opponent_points >= 40:
-                        delta = 1
-                    elif opponent_points >= 0:
-                        delta = 2
-                    else:
-                        delta = 3
-                    for player in players:
-                        player.player.add_rank(delta)
-                    for player in self.gameplayer_set.filter(team=OPPONENTS):
-                        player.player.plus = False
-                        player.player.save()
+
+            history.save()
 
         self.save()
 
+        if self.stage == Game.SCORE:
+            from main import tasks
+            tasks.enqueue(tasks.finish_game, self.id)
+
+    def update_ranks(self):
+        # The claim and the ranks are written together, so a crash leaves neither
+        with transaction.atomic():
+            # Only the first caller gets to apply the ranks
+            updated = Game.objects.filter(id=self.id, ranked=False).update(ranked=True)
+            self.ranked = True
+            if not updated:
+                return False
+
+            team, delta = self.rules().rank_change(self.get_points())
+            for player in self.gameplayer_set.filter(team=team):
+                player.player.add_rank(delta)
+            for player in self.gameplayer_set.exclude(team=team):
+                player.player.plus = False
+                player.player.save()
+        # Not saving the whole game, which would undo a next_game set meanwhile by rematch
+
+    def play_bots(self, limit=None):
+        """Make the bots' moves until it's a person's turn, or limit moves, returning how many were made."""
+        from main import ai
+        from main.rules import Cards
+
+        moves = 0
+        while limit is None or moves < limit:
+            players = self.get_players()
+            for player in players:
+                player.game = self
+            player = self.bot_turn(players)
+            if player is None:
+                break
+
+            if self.stage == Game.RESERVE:
+                cards, friend_cards = ai.choose_reserve(self, player)
+                if self.reserve(player, cards, friend_cards) is not None:
+                    break
+            elif self.stage == Game.DEAL:
+                if not self.deal(player) and (len(Cards.fromstr(self.deck)) != self.reserve_size() or
+                                              self.pickup_reserve(player) is False):
+                    break
+            else:
+                ret = self.play(player, ai.choose_play(self, player))
+                if ret is not None:
+                    logger.error("bot play rejected: %s", ret)
+                    break
+            moves += 1
+        return moves
+
     def rematch(self):
         if self.stage != Game.SCORE:
             return False
 
         if not self.next_game:
+            self.update_ranks()
             players = deque(self.gameplayer_set.all())
             players.rotate(-1)
             while players[0].team != self.winner:
                 players.rotate(-1)
-            self.next_game = Game.setup([player.player for player in players])
-            self.save()
+            next_game = Game.setup([player.player for player in players], ruleset=self.ruleset)
+
+            # The background worker may have set up the rematch in the meantime
+            if Game.objects.filter(id=self.id, next_game=None).update(next_game=next_game):
+                self.next_game = next_game
+            else:
+                next_game.delete()
+                self.next_game = Game.objects.get(id=self.id).next_game
         return self.next_game
 
 
@@ -760,6 +752,11 @@ class Player(models.Model):
     user = models.ForeignKey(User)
     rank = models.IntegerField(choices=RANK_CHOICES, default=TWO)
     plus = models.BooleanField(default=False)
+    bot = models.BooleanField(default=False)
+
+    class Meta:
+        # The leaderboard on the home page and the users offered in new_game
+        index_together = (('rank', 'plus'), ('bot', 'user'))
 
     def __str__(self):
         return str(self.user)
@@ -777,6 +774,27 @@ class Player(models.Model):
         except IntegrityError:
             return None
 
+    @classmethod
+    def create_bot(cls, username):
+        player = cls(bot=True)
+        try:
+            player.user = User.objects.create_user(username)
+            player.save()
+            return player
+        except IntegrityError:
+            return None
+
+    @classmethod
+    def get_bots(cls, count):
+        bots = list(cls.objects.filter(bot=True)[:count])
+        i = 0
+        while len(bots) < count:
+            i += 1
+            username = 'bot{}'.format(i)
+            if not User.objects.filter(username=username).exists():
+                bots.append(cls.create_bot(username))
+        return bots
+
     def add_rank(self, delta):
         if not self.plus:
             self.plus = True
@@ -785,7 +803,70 @@ class Player(models.Model):
         self.save()
 
 
-class GamePlayer(models.Model):
+class PlayerStats(models.Model):
+    player = models.OneToOneField(Player, related_name='stats')
+    games_played = models.IntegerField(default=0)
+    declarer_games = models.IntegerField(default=0)
+    declarer_wins = models.IntegerField(default=0)
+    opponent_wins = models.IntegerField(default=0)
+    # Sum of the opponents' points over every game played
+    opponent_points = models.IntegerField(default=0)
+    tractors_led = models.IntegerField(default=0)
+    friends_found = models.IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.player)
+
+    def opponent_games(self):
+        return self.games_played - self.declarer_games
+
+    def average_opponent_points(self):
+        return self.opponent_points / self.games_played if self.games_played else 0
+
+    @classmethod
+    def increment(cls, player_id, **counters):
+        update = dict((field, models.F(field) + n) for field, n in counters.items())
+        if not cls.objects.filter(player_id=player_id).update(**update):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(player_id=player_id, **counters)
+            except IntegrityError:
+                cls.objects.filter(player_id=player_id).update(**update)
+
+    @classmethod
+    def record_games(cls, games):
+        """Add finished games to the stats of their players, skipping games already counted."""
+        with transaction.atomic():
+            # Claim each game first so that it is never counted twice
+            games = dict((game.id, game) for game in games
+                         if Game.objects.filter(id=game.id, stats_recorded=False).update(stats_recorded=True))
+            if not games:
+                return 0
+
+            game_players = list(GamePlayer.objects.filter(game__in=list(games)).values_list(
+                'game_id', 'player_id', 'team', 'points'))
+            points = Counter()
+            for game_id, _, team, player_points in game_players:
+                if team == OPPONENTS:
+                    points[game_id] += player_points
+
+            # Add up the counters per player so that each player is only updated once
+            counters = {}
+            for game_id, player_id, team, _ in game_players:
+                player_counters = counters.setdefault(player_id, Counter())
+                player_counters['games_played'] += 1
+                player_counters['opponent_points'] += points[game_id]
+                if team == DECLARERS:
+                    player_counters['declarer_games'] += 1
+                if team == games[game_id].winner:
+                    player_counters['declarer_wins' if team == DECLARERS else 'opponent_wins'] += 1
+
+            for player_id, player_counters in counters.items():
+                cls.increment(player_id, **player_counters)
+        return len(games)
+
+
+class GamePlayer(WriteBehind, models.Model):
     game = models.ForeignKey(Game)
     player = models.ForeignKey(Player)
 
@@ -795,34 +876,332 @@ class GamePlayer(models.Model):
     points = models.IntegerField(default=0)
     hand = models.CharField(max_length=200, default='')
     play = models.CharField(max_length=200, default='')
+    hand_index = models.CharField(max_length=200, default='')
+
+    class Meta:
+        unique_together = (('game', 'turn'), ('game', 'player'))
+        index_together = ('game', 'team')
+        ordering = ('turn',)
 
     def __str__(self):
         return str(self.player)
 
     def get_hand(self):
+        from main.rules import Cards
+
         return Cards.fromstr(self.hand)
 
+    def get_hand_index(self):
+        from main.rules import HandIndex
+
+        if self.hand_index:
+            return HandIndex.decode(self.hand_index)
+        return HandIndex.build(self.get_hand().cards, self.game.trump_suit, self.game.trump_rank)
+
     def your_turn(self):
         return (self.game.turn + self.game.trick_turn) % self.game.number_of_players() == self.turn
 
     def get_play(self):
+        from main.rules import CardCombinations
+
         if self.play:
             return CardCombinations.decode(self.play)
         else:
             return None
 
 
-class LoginForm(forms.Form):
-    username = forms.CharField()
-    password = forms.CharField(widget=forms.widgets.PasswordInput)
+def swiss_pairing(players, table_size, met, window=8):
+    """Split players into tables, keeping players with similar standings together.
+
+    players must be in standings order and met maps each player to the set of
+    players they have already shared a table with. Within the next window
+    players, those who haven't met anyone at the table yet are seated first.
+    Left over players are spread over the top tables.
+    """
+    number_of_tables = len(players) // table_size
+    sizes = [table_size] * number_of_tables
+    for i in range(len(players) - table_size * number_of_tables):
+        sizes[i % number_of_tables] += 1
+
+    remaining = list(players)
+    tables = []
+    for size in sizes:
+        table = [remaining.pop(0)]
+        while len(table) < size:
+            candidates = remaining[:window]
+            player = next((candidate for candidate in candidates
+                           if not any(candidate in met.get(other, ()) for other in table)), candidates[0])
+            remaining.remove(player)
+            table.append(player)
+        tables.append(table)
+    return tables
+
+
+class Tournament(models.Model):
+    name = models.CharField(max_length=100)
+    table_size = models.IntegerField(default=4)
+    rounds = models.IntegerField(default=3)
+    round = models.IntegerField(default=0)
+    finished = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+    def get_absolute_url(self):
+        from django.core.urlresolvers import reverse
+        return reverse('main.views.tournament', args=[str(self.id)])
+
+    @staticmethod
+    def seating_error(number_of_players, table_size=4):
+        """Return why number_of_players can't be split into tables of table_size, or None."""
+        if table_size not in Game.SETTINGS:
+            return "Tables of {} players aren't allowed".format(table_size)
+        if number_of_players < table_size:
+            return "At least {} players are needed".format(table_size)
+        if number_of_players > number_of_players // table_size * max(Game.SETTINGS):
+            return "{} players can't be split into tables of {} to {}".format(
+                number_of_players, table_size, max(Game.SETTINGS))
+        return None
+
+    @classmethod
+    def create(cls, name, players, rounds=3, table_size=4):
+        if cls.seating_error(len(players), table_size) is not None:
+            return False
+
+        with transaction.atomic():
+            tournament = cls.objects.create(name=name, rounds=rounds, table_size=table_size, round=1)
+            TournamentPlayer.objects.bulk_create(TournamentPlayer(tournament=tournament, player=player)
+                                                 for player in players)
+            tournament.start_round()
+        return tournament
+
+    def standings(self):
+        return self.tournamentplayer_set.select_related('player').order_by(
+            '-score', '-player__rank', '-player__plus', 'id')
+
+    def start_round(self):
+        standings = list(self.standings())
+        met = dict((entry.player_id, set(map(int, entry.met.split(',')) if entry.met else ()))
+                   for entry in standings)
+        tables = swiss_pairing([entry.player_id for entry in standings], self.table_size, met)
+
+        players = dict((entry.player_id, entry.player) for entry in standings)
+        games = Game.bulk_setup([[players[player_id] for player_id in table] for table in tables])
+        TournamentTable.objects.bulk_create(TournamentTable(tournament=self, round=self.round, game=game)
+                                            for game in games)
+
+        seats = dict((player_id, table) for table in tables for player_id in table)
+        for entry in standings:
+            met[entry.player_id].update(seats[entry.player_id])
+            entry.met = ','.join(str(player_id) for player_id in sorted(met[entry.player_id])
+                                 if player_id != entry.player_id)
+        # One UPDATE per batch, the batches keeping under SQLite's limit on query parameters
+        for i in range(0, len(standings), 400):
+            batch = standings[i:i + 400]
+            TournamentPlayer.objects.filter(id__in=[entry.id for entry in batch]).update(met=models.Case(
+                *[models.When(id=entry.id, then=models.Value(entry.met)) for entry in batch],
+                output_field=models.TextField()))
+
+    def table_finished(self, table):
+        # Only the first caller gets to count the result
+        if not TournamentTable.objects.filter(id=table.id, finished=False).update(finished=True):
+            return False
+
+        winners = [player.player_id for player in table.game.gameplayer_set.filter(team=table.game.winner)]
+        self.tournamentplayer_set.filter(player__in=winners).update(score=models.F('score') + 1)
+        self.tournamentplayer_set.filter(player__in=[player.player_id for player in table.game.gameplayer_set.all()]
+                                         ).update(played=models.F('played') + 1)
+
+        if table.round != self.round or self.tables.filter(round=self.round, finished=False).exists():
+            return True
+
+        # Only the first table to see the round finished moves the tournament on
+        if self.round >= self.rounds:
+            Tournament.objects.filter(id=self.id).update(finished=True)
+            self.finished = True
+        elif Tournament.objects.filter(id=self.id, round=self.round).update(round=self.round + 1):
+            self.round += 1
+            self.start_round()
+        return True
+
+
+class TournamentPlayer(models.Model):
+    tournament = models.ForeignKey(Tournament)
+    player = models.ForeignKey(Player)
+    score = models.IntegerField(default=0)
+    played = models.IntegerField(default=0)
+    # Comma separated ids of the players already met
+    met = models.TextField(blank=True, default='')
+
+    class Meta:
+        unique_together = ('tournament', 'player')
+        index_together = ('tournament', 'score')
+
+    def __str__(self):
+        return str(self.player)
+
+
+class TournamentTable(models.Model):
+    tournament = models.ForeignKey(Tournament, related_name='tables')
+    round = models.IntegerField()
+    game = models.OneToOneField(Game, related_name='table')
+    finished = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = ('tournament', 'round', 'finished')
+
+
+class GameProjection(models.Model):
+    """What /status serves for a game, rebuilt by Game.project each time the game is saved.
+
+    Polling reads only this table, so it doesn't wait on the Game and
+    GamePlayer writes and can be sent to a replica, see main.routers.
+    """
+    game_id = models.IntegerField(primary_key=True)
+    version = models.IntegerField(default=0)
+    # Polling has to go through Game to deal or let a bot move
+    writes = models.BooleanField(default=False)
+    public = models.TextField()
+    # JSON of each player's status by username
+    players = models.TextField()
+
+    def player_status(self, username):
+        return json.loads(self.players).get(username)
+
+
+class TrickHistory(WriteBehind, models.Model):
+    """A finished trick, written once when the trick ends.
+
+    plays holds each seat's cards separated by ';'. points is what the winner
+    took, including the kitty on the last trick. Rows outlive their game when
+    it's archived, so there is no database constraint on game.
+    """
+    game = models.ForeignKey('Game', db_constraint=False, on_delete=models.DO_NOTHING, related_name='history')
+    number = models.IntegerField()
+    leader = models.IntegerField()
+    winner = models.IntegerField()
+    plays = models.CharField(max_length=1000)
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('game', 'number')
+        ordering = ('game', 'number')
+
+    def repr(self):
+        return {'number': self.number, 'leader': self.leader, 'winner': self.winner, 'points': self.points,
+                'plays': [plays.split(',') if plays else [] for plays in self.plays.split(';')]}
+
+
+class ArchivedGame(models.Model):
+    """A finished game moved out of the Game table by `manage.py archive_games`.
+
+    Keeps the game's id so links to it still work, but only the result: the
+    deck, hands and plays are dropped.
+    """
+    id = models.IntegerField(primary_key=True)
+    seed = models.BigIntegerField(blank=True, null=True)
+    trump_rank = models.IntegerField(choices=RANK_CHOICES)
+    trump_suit = models.CharField(max_length=1, choices=SUIT_CHOICES)
+    kitty = models.CharField(max_length=100)
+    friend_cards = models.CharField(max_length=100, default='')
+    winner = models.CharField(max_length=1, choices=TEAM_CHOICES, default=DECLARERS)
+    points = models.IntegerField(default=0)
+    next_game_id = models.IntegerField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    def __str__(self):
+        return 'Game #{}'.format(self.id)
+
+    def get_absolute_url(self):
+        from django.core.urlresolvers import reverse
+        return reverse('main.views.game', args=[str(self.id)])
+
+    def get_players_names(self):
+        return ', '.join(str(player) for player in self.archivedgameplayer_set.all())
+
+    def get_status(self):
+        return 'Stage: Archived, Score: {}'.format(self.points)
+
+    @classmethod
+    def archive(cls, games):
+        """Move finished games to the archive tables, returning how many were moved.
+
+        Games that are still the next game of a game that isn't being archived,
+        or that belong to a tournament, are left alone.
+        """
+        with transaction.atomic():
+            ids = [game.id for game in games if game.stage == Game.SCORE]
+            kept = set(Game.objects.filter(next_game__in=ids).exclude(id__in=ids)
+                       .values_list('next_game_id', flat=True))
+            kept.update(TournamentTable.objects.filter(game__in=ids).values_list('game_id', flat=True))
+            games = [game for game in games if game.id in ids and game.id not in kept]
+            if not games:
+                return 0
+            ids = [game.id for game in games]
+
+            friend_cards = {}
+            for game_id, number, suit, rank in FriendCard.objects.filter(game__in=ids).order_by('id').values_list(
+                    'game_id', 'number', 'suit', 'rank'):
+                friend_cards.setdefault(game_id, []).append('{}{}{}'.format(number, suit, rank))
+
+            game_players = list(GamePlayer.objects.filter(game__in=ids).order_by('game', 'turn'))
+            points = Counter()
+            for player in game_players:
+                if player.team == OPPONENTS:
+                    points[player.game_id] += player.points
+
+            cls.objects.bulk_create(cls(id=game.id, seed=game.seed, trump_rank=game.trump_rank,
+                                        trump_suit=game.trump_suit, kitty=game.kitty,
+                                        friend_cards=','.join(friend_cards.get(game.id, [])),
+                                        winner=game.winner, points=points[game.id],
+                                        next_game_id=game.next_game_id, finished_at=game.finished_at)
+                                    for game in games)
+            ArchivedGamePlayer.objects.bulk_create(
+                ArchivedGamePlayer(game_id=player.game_id, player_id=player.player_id, turn=player.turn,
+                                   team=player.team, points=player.points)
+                for player in game_players)
+
+            FriendCard.objects.filter(game__in=ids).delete()
+            GameProjection.objects.filter(game_id__in=ids).delete()
+            # Earlier games in the batch point at later ones, so unlink them before deleting
+            Game.objects.filter(id__in=ids).update(next_game=None)
+            Game.objects.filter(id__in=ids).delete()
+        return len(ids)
+
+
+class ArchivedGamePlayer(models.Model):
+    game = models.ForeignKey(ArchivedGame)
+    player = models.ForeignKey(Player)
+    turn = models.IntegerField()
+    team = models.CharField(max_length=1, choices=TEAM_CHOICES, default=OPPONENTS)
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('turn',)
+
+    def __str__(self):
+        return str(self.player)
+
+
+class Task(models.Model):
+    PENDING = '1'
+    RUNNING = '2'
+    DONE = '3'
+    FAILED = '4'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    name = models.CharField(max_length=100)
+    args = models.TextField(default='[]')
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return '{}{}'.format(self.name, tuple(json.loads(self.args)))
 
-    def clean(self):
-        cleaned_data = super(LoginForm, self).clean()
-        if 'register' in self.data:
-            Player.create_player(username=cleaned_data.get('username'), password=cleaned_data.get('password'))
-        user = authenticate(username=cleaned_data.get('username'), password=cleaned_data.get('password'))
-        if user is None:
-            self._errors['password'] = self.error_class(["Incorrect password."])
-        else:
-            cleaned_data['user'] = user
-        return cleaned_data
@@ -0,0 +1,23 @@
+from django.conf import settings
+
+
+class ReplicaRouter(object):
+    """Send reads of GameProjection to the 'replica' database, everything else to 'default'.
+
+    Status polls only read projections, so they can lag the writes a little
+    and keep the load of polling off the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.model_name == 'gameprojection' and 'replica' in settings.DATABASES:
+            return 'replica'
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
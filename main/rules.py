@@ -0,0 +1,685 @@
+"""
+The rules of the game, apart from the database.
+
+Cards and plays, checking leads and follows, tricks, rulesets and decks are
+plain Python here. main.models imports them in the methods that need them
+rather than at the top, so manage.py commands and workers that never deal a
+card don't load them.
+"""
+
+import bisect
+from collections import Counter, namedtuple
+from functools import lru_cache, reduce, total_ordering
+import itertools
+import json
+import math
+import random
+import threading
+import types
+
+from main.models import (BLACK, JOKER, NORMAL_RANKS, NORMAL_SUITS, OFFSUIT_TRUMP, ONSUIT_TRUMP, RANK_CHOICES, RED,
+                         RULESETS, STANDARD, SUIT_CHOICES, SUITS, TRUMP)
+
+
+@total_ordering
+class Card(object):
+    def __init__(self, suit, rank):
+        self.suit = suit
+        self.rank = rank
+
+    @classmethod
+    def fromstr(cls, s):
+        return cls(suit=s[0], rank=int(s[1:]))
+
+    def __eq__(self, other):
+        return (self.suit, self.rank) == (other.suit, other.rank)
+
+    def __lt__(self, other):
+        return (SUITS.index(self.suit), self.rank) < (SUITS.index(other.suit), other.rank)
+
+    def __str__(self):
+        return self.suit + str(self.rank)
+
+    def __hash__(self):
+        return hash((self.suit, self.rank))
+
+    @classmethod
+    def fromid(cls, i):
+        return cls(suit=DECK[i].suit, rank=DECK[i].rank)
+
+    def id(self):
+        return CARD_IDS[self.suit, self.rank]
+
+    def image(self):
+        return '{}_of_{}.png'.format(dict(RANK_CHOICES)[self.rank], dict(SUIT_CHOICES)[self.suit]).lower()
+
+    def repr(self):
+        return {'card': str(self), 'id': self.id()}
+
+    def is_trump(self, trump_suit, trump_rank):
+        return self.suit in (trump_suit, JOKER) or self.rank == trump_rank
+
+    def get_suit(self, trump_suit, trump_rank):
+        if self.is_trump(trump_suit, trump_rank):
+            return TRUMP
+        else:
+            return self.suit
+
+    def get_rank(self, trump_suit, trump_rank):
+        if self.rank == trump_rank:
+            if self.suit == trump_suit:
+                return ONSUIT_TRUMP
+            else:
+                return OFFSUIT_TRUMP
+        else:
+            return self.rank
+
+
+def display_key(trump_suit, trump_rank):
+    """Return the sort key hands are stored in: by suit with trump last, then rank."""
+    return lambda card: (card.get_suit(trump_suit, trump_rank), card.get_rank(trump_suit, trump_rank), card.suit)
+
+
+def create_deck():
+    return ([Card(suit, rank) for suit in NORMAL_SUITS for rank in NORMAL_RANKS] +
+            [Card(JOKER, rank) for rank in (BLACK, RED)])
+
+
+# Cards are numbered by their position in a new deck
+DECK = create_deck()
+CARD_IDS = dict(((card.suit, card.rank), i) for i, card in enumerate(DECK))
+
+
+class DeckPool(object):
+    """Shuffled decks for each number of decks, drawn in batches of size.
+
+    Every deck comes from random.Random(seed) so the deal of a game can be
+    rebuilt from the seed stored with it.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.decks = {}
+        self.lock = threading.Lock()
+        self.random = random.SystemRandom()
+
+    @staticmethod
+    def shuffle(number_of_decks, seed):
+        deck = [str(card) for _ in range(number_of_decks) for card in create_deck()]
+        random.Random(seed).shuffle(deck)
+        return ','.join(deck)
+
+    def draw(self, number_of_decks):
+        """Return (seed, deck) for a new game."""
+        with self.lock:
+            decks = self.decks.setdefault(number_of_decks, [])
+            if not decks:
+                for _ in range(self.size):
+                    seed = self.random.getrandbits(63)
+                    decks.append((seed, self.shuffle(number_of_decks, seed)))
+            return decks.pop()
+
+
+deck_pool = DeckPool()
+
+
+def is_consecutive(cards, trump_suit, trump_rank):
+    if len(cards) < 2:
+        return False
+
+    ranks = [card.get_rank(trump_suit, trump_rank) for card in cards]
+    min_rank = min(ranks)
+    max_rank = max(ranks)
+    return (sorted(ranks + [trump_rank]) == list(range(min_rank, max_rank + 1)) if min_rank < trump_rank < max_rank else
+            sorted(ranks) == list(range(min_rank, max_rank + 1)))
+
+
+class Cards(object):
+    def __init__(self, cards=None):
+        if cards is None:
+            self.cards = []
+        else:
+            self.cards = cards[:]
+
+    @classmethod
+    def fromstr(cls, s):
+        return cls(cards=[Card.fromstr(ss) for ss in s.split(',')] if s else [])
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, items):
+        cards = self.cards[:]
+
+        for item in items:
+            try:
+                cards.remove(item)
+            except ValueError:
+                return False
+
+        return True
+
+    def __str__(self):
+        return ','.join(str(card) for card in self.cards)
+
+    def add_card(self, card):
+        self.cards.append(card)
+
+    def add_cards(self, cards):
+        for card in cards:
+            self.cards.append(card)
+
+    def play_card(self, card):
+        self.cards.remove(card)
+
+    def play_cards(self, cards):
+        for card in cards:
+            self.cards.remove(card)
+
+    def pop(self):
+        return self.cards.pop()
+
+    def sort(self, key=None):
+        self.cards.sort(key=key)
+
+    def insert_cards(self, cards, key):
+        """Add cards to cards sorted by key, keeping them sorted."""
+        keys = [key(card) for card in self.cards]
+        if any(a > b for a, b in zip(keys, keys[1:])):
+            # Stored before hands were kept in order
+            self.cards.sort(key=key)
+            keys.sort()
+        for card in cards:
+            card_key = key(card)
+            i = bisect.bisect_right(keys, card_key)
+            keys.insert(i, card_key)
+            self.cards.insert(i, card)
+
+    def single_suit(self, trump_suit, trump_rank):
+        suits = set(card.get_suit(trump_suit, trump_rank) for card in self.cards)
+        if len(suits) == 1:
+            return suits.pop()
+        else:
+            return None
+
+    def has_suit(self, suit, trump_suit, trump_rank):
+        return any(card.get_suit(trump_suit, trump_rank) == suit for card in self.cards)
+
+
+@total_ordering
+class CardCombinations(object):
+    def __init__(self, cards=None, trump_suit=None, trump_rank=None, consecutive=True):
+        self.cards = []
+        self.suit = None
+        self.rank = None
+        self.combinations = []
+        self.can_win = True
+        if cards:
+            self.init(cards, trump_suit, trump_rank, consecutive)
+
+    def __eq__(self, other):
+        return (self.suit, self.rank) == (other.suit, other.rank)
+
+    def __lt__(self, other):
+        if self.suit != TRUMP and other.suit == TRUMP:
+            return True
+        if self.suit == TRUMP and other.suit != TRUMP:
+            return False
+        return self.rank < other.rank
+
+    def init(self, cards, trump_suit, trump_rank, consecutive=True):
+        self.cards = str(Cards(cards))
+        self.suit = cards[0].get_suit(trump_suit, trump_rank)
+        self.rank = max(card.get_rank(trump_suit, trump_rank) for card in cards)
+        ranks = Counter(card for card in cards)
+
+        if consecutive:
+            subsets = {}
+            for k, v in ranks.items():
+                if v >= 2:
+                    subsets.setdefault(v, []).append(k)
+
+            for n, subset in subsets.items():
+                i = len(subset)
+                while i > 1:
+                    permutations = itertools.permutations(subset, i)
+                    for p in permutations:
+                        if is_consecutive(p, trump_suit, trump_rank):
+                            self.combinations.append(
+                                {'n': n, 'consecutive': i,
+                                 'rank': max(card.get_rank(trump_suit, trump_rank) for card in p)})
+                            for rank in p:
+                                del ranks[rank]
+                                subset.remove(rank)
+                            i = len(subset)
+                            break
+                    else:
+                        i -= 1
+
+        for k, v in ranks.items():
+            self.combinations.append({'n': v, 'consecutive': 1, 'rank': k.get_rank(trump_suit, trump_rank)})
+
+    def validate(self, before, after):
+        # Check which combinations are matched with hand
+        for first_player_combination in self.combinations:
+            remove = []
+            if first_player_combination['consecutive'] >= 2:
+                match = [combination for combination in before.combinations
+                         if combination['consecutive'] >= 2 and
+                         first_player_combination['n'] == combination['n']][:1]
+                if match:
+                    first_player_combination['match'] = True
+                    remove.extend(match)
+
+                else:
+                    self.can_win = False
+                    match = [combination for combination in before.combinations
+                             if first_player_combination['n'] == combination['n']][:first_player_combination['consecutive']]
+                    if match:
+                        first_player_combination['match'] = len(match)
+                        remove.extend(match)
+
+            else:
+                match = [combination for combination in before.combinations
+                         if first_player_combination['n'] == combination['n']][:1]
+                if match:
+                    first_player_combination['match'] = True
+                    remove.extend(match)
+                else:
+                    self.can_win = False
+
+            for r in remove:
+                before.combinations.remove(r)
+
+        # Check which combinations are matched with cards played
+        for first_player_combination in self.combinations:
+            if 'match' not in first_player_combination:
+                continue
+
+            remove = []
+            if first_player_combination['consecutive'] >= 2:
+                if first_player_combination['match'] is True:
+                    match = [combination for combination in after.combinations
+                             if combination['consecutive'] >= 2 and
+                             first_player_combination['n'] == combination['n']][:1]
+                    if match:
+                        remove.extend(match)
+                    else:
+                        return "Consecutive pairs have to be played"
+
+                else:
+                    match = [combination for combination in after.combinations
+                             if first_player_combination['n'] == combination['n']][:first_player_combination['consecutive']]
+                    if len(match) >= first_player_combination['match']:
+                        remove.extend(match)
+                    else:
+                        return "Pairs have to be played"
+
+            else:
+                match = [combination for combination in after.combinations
+                         if first_player_combination['n'] == combination['n']][:1]
+                if match:
+                    first_player_combination['match'] = True
+                    remove.extend(match)
+                else:
+                    return "Pairs have to be played"
+
+            for r in remove:
+                after.combinations.remove(r)
+
+    def encode(self):
+        return json.dumps({'suit': self.suit, 'rank': self.rank, 'combinations': self.combinations, 'cards': self.cards})
+
+    @classmethod
+    def decode(cls, s):
+        if isinstance(s, bytes):
+            s = str(s, 'utf-8')
+        return decode_play(s)
+
+
+class DecodedPlay(namedtuple('DecodedPlay', ['suit', 'rank', 'combinations', 'cards', 'card_list'])):
+    """A stored play as read back from GamePlayer.play.
+
+    Decoded plays are shared between callers, so they're read-only: the
+    combinations are read-only dicts and card_list holds the parsed cards.
+    """
+    __slots__ = ()
+
+    def encode(self):
+        return json.dumps({'suit': self.suit, 'rank': self.rank,
+                           'combinations': [dict(combination) for combination in self.combinations],
+                           'cards': self.cards})
+
+
+@lru_cache(maxsize=4096)
+def decode_play(s):
+    play_dict = json.loads(s)
+    return DecodedPlay(play_dict['suit'], play_dict['rank'],
+                       tuple(types.MappingProxyType(combination) for combination in play_dict['combinations']),
+                       play_dict['cards'], tuple(Cards.fromstr(play_dict['cards']).cards))
+
+
+def card_points(cards, rules=None):
+    return (rules or get_ruleset(STANDARD)).points(cards)
+
+
+class Ruleset(object):
+    """A variant from RULESETS compiled into lookup tables.
+
+    card_points holds the points of each card id and rank_table the result
+    for every possible number of opponent points, one entry per points step,
+    so that scoring never has to walk the variant's rules.
+    """
+
+    def __init__(self, layouts, points, kitty_multiplier, win, ranks, name=None):
+        self.name = name
+        self.layouts = dict(layouts)
+        self.card_points = tuple(points.get(card.rank, 0) for card in DECK)
+        self.kitty_multiplier = kitty_multiplier
+        self.win = win
+
+        # Card points are all multiples of step, so every score lands on an entry
+        self.step = reduce(math.gcd, (value for value in self.card_points if value), 0) or 1
+        max_decks = max(decks for decks, _, _ in self.layouts.values())
+        max_points = max_decks * sum(self.card_points) * kitty_multiplier
+        self.below = ranks[-1][1:]
+        self.rank_table = tuple(self._rank_change(ranks, points)
+                                for points in range(0, max_points + self.step, self.step))
+
+    def _rank_change(self, ranks, opponent_points):
+        for lowest, team, delta in ranks[:-1]:
+            if opponent_points >= lowest:
+                return team, delta
+        return self.below
+
+    def points(self, cards):
+        card_points = self.card_points
+        return sum(card_points[CARD_IDS[card.suit, card.rank]] for card in cards)
+
+    def rank_change(self, opponent_points):
+        """Return (team, ranks gained) for a game where the opponents took opponent_points."""
+        if opponent_points < 0:
+            return self.below
+        return self.rank_table[min(opponent_points // self.step, len(self.rank_table) - 1)]
+
+
+_rulesets = {}
+
+
+def get_ruleset(name):
+    ruleset = _rulesets.get(name)
+    if ruleset is None:
+        ruleset = _rulesets[name] = Ruleset(**RULESETS[name])
+    return ruleset
+
+
+class HandIndex(object):
+    """The highest rank a hand holds in each suit for every size of n-of-a-kind.
+
+    best[suit][n - 1] is the highest rank of which the hand has at least n
+    copies, so checking whether a led combination can be beaten is a lookup.
+    """
+
+    def __init__(self, best=None):
+        self.best = best if best is not None else {}
+
+    @classmethod
+    def build(cls, cards, trump_suit, trump_rank):
+        index = cls()
+        index.update(cards, set(card.get_suit(trump_suit, trump_rank) for card in cards), trump_suit, trump_rank)
+        return index
+
+    @classmethod
+    def decode(cls, s):
+        return cls(json.loads(s))
+
+    def encode(self):
+        return json.dumps(self.best)
+
+    def update(self, cards, suits, trump_suit, trump_rank):
+        """Recompute suits from the cards now in the hand."""
+        for suit in suits:
+            counts = Counter(card for card in cards if card.get_suit(trump_suit, trump_rank) == suit)
+            best = []
+            for card, count in counts.items():
+                rank = card.get_rank(trump_suit, trump_rank)
+                best.extend([rank] * (count - len(best)))
+                for n in range(count):
+                    best[n] = max(best[n], rank)
+            if best:
+                self.best[suit] = best
+            else:
+                self.best.pop(suit, None)
+
+    def play_cards(self, hand, cards, trump_suit, trump_rank):
+        """Update the index once cards have left hand."""
+        self.update(hand.cards, set(card.get_suit(trump_suit, trump_rank) for card in cards), trump_suit, trump_rank)
+
+    def beats(self, suit, n, rank):
+        best = self.best.get(suit, [])
+        return len(best) >= n and best[n - 1] > rank
+
+
+def check_lead(cards, hand, other_hands, trump_suit, trump_rank, trump_broken):
+    """Validate the first play of a trick.
+
+    other_hands are the HandIndex of every other player. Returns (error, cards,
+    trump_broken). When several combinations are led and one of them can be
+    beaten by another hand, cards is reduced to the play that is forced instead.
+    """
+    # First player has to play a single suit
+    cards_played = Cards(cards)
+    cards_played_suit = cards_played.single_suit(trump_suit, trump_rank)
+    if cards_played_suit is None:
+        return "Cards have to be a single suit", cards, trump_broken
+    if cards_played_suit == TRUMP and not trump_broken:
+        if any(card.get_suit(trump_suit, trump_rank) != TRUMP for card in hand.cards):
+            return "Trump hasn't been broken yet", cards, trump_broken
+        else:
+            trump_broken = True
+
+    # If combination is played, remove cards that aren't highest
+    play = CardCombinations(cards_played.cards, trump_suit, trump_rank)
+    if len(play.combinations) > 1:
+        for other_hand in other_hands:
+            not_highest = [combination for combination in play.combinations
+                           if combination['consecutive'] < 2 and
+                           other_hand.beats(cards_played_suit, combination['n'], combination['rank'])]
+
+            if not_highest:
+                ranks = []
+                for combination in play.combinations:
+                    if combination['consecutive'] < 2:
+                        continue
+
+                    ranks.extend(range(combination['rank'], combination['rank'] - combination['consecutive'], -1))
+
+                forced = Cards([card for card in cards if card.get_rank(trump_suit, trump_rank) in ranks])
+                lowest = min(not_highest, key=lambda c: c['rank'])
+                forced.add_cards([card for card in cards
+                                  if card.get_rank(trump_suit, trump_rank) == lowest['rank']][:lowest['n']])
+                return None, forced.cards, trump_broken
+
+    return None, cards, trump_broken
+
+
+def check_follow(first_cards, hand, cards, trump_suit, trump_rank, first_play=None):
+    """Validate a play that follows the first play of a trick.
+
+    first_play is the first play's decomposition if it's already known, e.g.
+    Trick.first_play(); it's changed by the validation. Returns (error, play)
+    where play.can_win tells whether the cards are allowed to beat the current
+    lead.
+    """
+    # Other players have to play the same number of cards that the first person played
+    if len(first_cards) != len(cards):
+        return "Play same amount of cards", None
+
+    # Other players have to play the suit that the first person played
+    if first_play is None:
+        first_play = CardCombinations(first_cards, trump_suit, trump_rank)
+    first_player_combinations = first_play
+    cards_played_suit = Cards(cards).single_suit(trump_suit, trump_rank)
+    hand_after_play = Cards(hand.cards)
+    hand_after_play.play_cards(cards)
+
+    if ((not cards_played_suit or cards_played_suit != first_player_combinations.suit) and
+            hand_after_play.has_suit(first_player_combinations.suit, trump_suit, trump_rank)):
+        return "Play leading suit", None
+
+    combinations_played = CardCombinations(cards, trump_suit, trump_rank)
+    combinations_played.can_win = False
+    if cards_played_suit in (first_player_combinations.suit, TRUMP):
+        combinations_before_play = CardCombinations(
+            [card for card in hand.cards
+             if card.get_suit(trump_suit, trump_rank) == cards_played_suit],
+            trump_suit, trump_rank)
+        ret = first_player_combinations.validate(combinations_before_play,
+                                                 CardCombinations(cards, trump_suit, trump_rank))
+        if ret:
+            return ret, None
+        combinations_played.can_win = first_player_combinations.can_win
+
+    return None, combinations_played
+
+
+class Trick(object):
+    """The trick in progress.
+
+    Keeps the first play's cards and decomposition, and the suit and rank of
+    the play winning so far, so that each follow is checked and compared
+    without decoding and decomposing the earlier plays again.
+    """
+
+    def __init__(self, cards, suit, combinations, winner):
+        self.cards = cards
+        self.suit = suit
+        self.combinations = combinations
+        self.winner = winner
+
+    @classmethod
+    def start(cls, cards, trump_suit, trump_rank):
+        play = CardCombinations(cards, trump_suit, trump_rank)
+        return cls(list(cards), play.suit, play.combinations, [play.suit, play.rank])
+
+    @classmethod
+    def decode(cls, s):
+        trick = json.loads(s)
+        return cls(Cards.fromstr(trick['cards']).cards, trick['suit'], trick['combinations'], trick['winner'])
+
+    def encode(self):
+        return json.dumps({'cards': str(Cards(self.cards)), 'suit': self.suit,
+                           'combinations': self.combinations, 'winner': self.winner})
+
+    def first_play(self):
+        """Return a copy of the first play's decomposition for check_follow."""
+        play = CardCombinations()
+        play.cards = str(Cards(self.cards))
+        play.suit = self.suit
+        play.rank = max(combination['rank'] for combination in self.combinations)
+        play.combinations = [dict(combination) for combination in self.combinations]
+        return play
+
+    def winning_play(self):
+        play = CardCombinations()
+        play.suit, play.rank = self.winner
+        return play
+
+    def follow(self, play):
+        """Record a follow that passed check_follow, returning whether it wins the trick so far."""
+        if play.can_win and play > self.winning_play():
+            self.winner = [play.suit, play.rank]
+            return True
+        return False
+
+
+class CardTracker(object):
+    """How many copies of each card haven't been played yet.
+
+    counts is indexed by Card.id() so a play is applied in one step per card;
+    it's grouped by effective suit only when it's read.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    @classmethod
+    def full(cls, number_of_decks):
+        return cls([number_of_decks] * len(DECK))
+
+    @classmethod
+    def fromcards(cls, cards):
+        tracker = cls([0] * len(DECK))
+        for card in cards:
+            tracker.counts[card.id()] += 1
+        return tracker
+
+    @classmethod
+    def decode(cls, s):
+        return cls(json.loads(s))
+
+    def encode(self):
+        return json.dumps(self.counts, separators=(',', ':'))
+
+    def play_cards(self, cards):
+        for card in cards:
+            self.counts[card.id()] -= 1
+
+    def unseen(self, cards):
+        """Return a tracker of the cards still out that aren't in cards, e.g. a player's own hand."""
+        tracker = CardTracker(self.counts[:])
+        tracker.play_cards(cards)
+        return tracker
+
+    def repr(self, trump_suit, trump_rank):
+        suits = {}
+        for card, count in zip(DECK, self.counts):
+            if count:
+                suit = suits.setdefault(card.get_suit(trump_suit, trump_rank), {'total': 0, 'cards': {}})
+                suit['total'] += count
+                suit['cards'][str(card)] = count
+        return suits
+
+
+class FriendLookup(object):
+    """The friend cards not found yet, by the card that finds them.
+
+    cards maps str(card) to [friend card id, number, counter] for each friend
+    card of that card, so a play is checked with one lookup per card played.
+    """
+
+    def __init__(self, cards=None):
+        self.cards = cards or {}
+
+    @classmethod
+    def build(cls, friend_cards):
+        lookup = cls()
+        for friend_card in friend_cards:
+            if not friend_card.found:
+                lookup.cards.setdefault(friend_card.suit + str(friend_card.rank), []).append(
+                    [friend_card.id, friend_card.number, friend_card.counter])
+        return lookup
+
+    @classmethod
+    def decode(cls, s):
+        return cls(json.loads(s))
+
+    def encode(self):
+        return json.dumps(self.cards, separators=(',', ':'))
+
+    def play_cards(self, cards):
+        """Count cards towards the friend cards, returning (id, counter, found) for each one counted."""
+        counted = {}
+        for card in cards:
+            entries = self.cards.get(str(card))
+            if not entries:
+                continue
+            for entry in entries:
+                entry[2] += 1
+                counted[entry[0]] = (entry[0], entry[2], entry[2] == entry[1])
+            entries = [entry for entry in entries if entry[2] < entry[1]]
+            if entries:
+                self.cards[str(card)] = entries
+            else:
+                del self.cards[str(card)]
+        return list(counted.values())
@@ -0,0 +1,280 @@
+"""
+Active games held in memory.
+
+With GAME_SESSIONS on, a game in the Deal, Reserve or Play stage is loaded
+once into a GameSession: its Game and GamePlayers stay in memory and
+requests act on them under the session's lock, so a deal or a play
+doesn't read and parse the game again.
+
+Saves of those rows are deferred (see models.WriteBehind): each is
+serialized to a line of the write-behind log on disk and written to the
+database by a background thread, which retries rows that fail. When the
+game is scored the session flushes and ends, and the game is back to the
+database only; a flush that can't write everything raises instead.
+
+On restart, the log is replayed into the database before the first session
+is opened, so a crash loses no action that was acknowledged. Rows of games
+the database already has a later version of are skipped. The sessions are
+in one process's memory, so this mode needs a single server process.
+"""
+
+from collections import deque
+import itertools
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core import serializers
+from django.db import IntegrityError, connection, transaction
+
+from main.models import Game
+
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STAGES = (Game.DEAL, Game.RESERVE, Game.PLAY)
+
+_sessions = {}
+_lock = threading.Lock()
+_log = None
+
+
+def serialize(obj):
+    fields = [field.name for field in obj._meta.concrete_fields if not field.primary_key]
+    return serializers.serialize('json', [obj], fields=fields)
+
+
+# Bytes of rows written out before the log is rewritten without them, when
+# it's never empty long enough to be truncated
+COMPACT_SIZE = 1 << 20
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+def write_entries(lines):
+    """Write logged rows to the database in order, then rebuild the games' projections.
+
+    A game row older than the database's is skipped, and so are all the rows
+    of a game the database has a later version of than any logged.
+    """
+    entries = [entry for line in lines for entry in serializers.deserialize('json', line)]
+    logged = {}
+    for entry in entries:
+        if isinstance(entry.object, Game):
+            logged[entry.object.pk] = max(entry.object.version, logged.get(entry.object.pk, 0))
+    versions = dict(Game.objects.filter(id__in=list(logged)).values_list('id', 'version'))
+
+    game_ids = set()
+    with transaction.atomic():
+        for entry in entries:
+            obj = entry.object
+            game_id = obj.pk if isinstance(obj, Game) else getattr(obj, 'game_id', None)
+            if game_id in logged and versions.get(game_id, 0) > logged[game_id]:
+                continue
+            if isinstance(obj, Game) and obj.version < versions.get(obj.pk, 0):
+                continue
+            if obj.pk is None:
+                # A new TrickHistory, which is already there if the line is replayed
+                try:
+                    with transaction.atomic():
+                        entry.save()
+                except IntegrityError:
+                    pass
+            else:
+                entry.save()
+            game_ids.add(game_id)
+    for game in Game.objects.filter(id__in=game_ids - {None}):
+        game.project()
+
+
+def recover(path):
+    """Replay a log left by a process that stopped before writing it out."""
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return 0
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    write_entries(lines)
+    open(path, 'w').close()
+    logger.info("recovered %d write(s) from %s", len(lines), path)
+    return len(lines)
+
+
+class WriteBehindLog(object):
+    """Rows logged to a file, then written to the database in batches.
+
+    lines holds each row not written yet with the size of the log after it,
+    so the log is only cut back to what has been written.
+    """
+
+    def __init__(self, path, start=True, batch_size=100, retry_delay=1):
+        self.path = path
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.lines = deque()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Only one batch is written at a time
+        self.writing = threading.Lock()
+        self.logged = 0
+        self.done = 0
+        self.attempts = 0
+        self.error = None
+
+        recover(path)
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+        self.thread = None
+        if start:
+            self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.thread.start()
+
+    def append(self, obj):
+        line = serialize(obj)
+        with self.lock:
+            self.file.write((line + '\n').encode())
+            self.file.flush()
+            self.size = self.file.tell()
+            self.lines.append((line, self.size))
+            self.logged += 1
+            self.changed.notify_all()
+
+    def run(self):
+        while True:
+            if not self.write_pending(block=True):
+                time.sleep(self.retry_delay)
+
+    def write_pending(self, block=False):
+        """Write out a batch of logged rows, returning how many.
+
+        Rows that fail stay queued for the next call to retry.
+        """
+        with self.writing:
+            with self.lock:
+                while block and not self.lines:
+                    self.changed.wait()
+                batch = list(itertools.islice(self.lines, self.batch_size))
+            if not batch:
+                return 0
+
+            try:
+                write_entries([line for line, size in batch])
+            except Exception as e:
+                logger.exception("write-behind of %d row(s) failed, will retry", len(batch))
+                with self.lock:
+                    self.attempts += 1
+                    self.error = e
+                    self.changed.notify_all()
+                return 0
+            finally:
+                if self.thread is not None:
+                    connection.close()
+
+            with self.lock:
+                for _ in batch:
+                    self.lines.popleft()
+                self.attempts += 1
+                self.error = None
+                self.done += len(batch)
+                self.truncate(batch[-1][1])
+                self.changed.notify_all()
+            return len(batch)
+
+    def truncate(self, size):
+        """Drop the first size bytes of the log, which are in the database. Called with the lock held."""
+        if size == self.size:
+            # Everything logged is in the database
+            self.file.truncate(0)
+            self.size = 0
+        elif size >= COMPACT_SIZE:
+            with open(self.path, 'rb') as f:
+                f.seek(size)
+                rest = f.read()
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(rest)
+            self.file.close()
+            os.replace(self.path + '.tmp', self.path)
+            self.file = open(self.path, 'ab')
+            self.size -= size
+            self.lines = deque((line, end - size) for line, end in self.lines)
+
+    def flush(self):
+        """Wait until every row logged so far is in the database.
+
+        Raises WriteBehindError when a try to write them fails, leaving them
+        logged and queued to be retried.
+        """
+        with self.lock:
+            logged = self.logged
+            attempts = self.attempts
+        if self.thread is None:
+            while self.write_pending():
+                pass
+        with self.lock:
+            while self.done < logged:
+                if self.error is not None and self.attempts > attempts:
+                    raise WriteBehindError("{} logged row(s) aren't in the database".format(
+                        logged - self.done)) from self.error
+                self.changed.wait()
+
+
+class GameSession(object):
+    def __init__(self, game, log):
+        self.game = game
+        self.log = log
+        self.lock = threading.RLock()
+        self.players = list(game.gameplayer_set.select_related('player__user'))
+        for player in self.players:
+            player.game = game
+        for obj in [game] + self.players:
+            obj.session = self
+
+    def player(self, username):
+        return next((player for player in self.players if str(player) == username), None)
+
+    def defer(self, obj):
+        """Log a save of obj, returning False when it should be saved right away instead."""
+        if obj is self.game and self.game.stage not in ACTIVE_STAGES:
+            # Finished: everything goes to the database before the game's own save
+            self.close()
+            return False
+        self.log.append(obj)
+        return True
+
+    def close(self):
+        self.log.flush()
+        for obj in [self.game] + self.players:
+            obj.session = None
+        with _lock:
+            if _sessions.get(self.game.id) is self:
+                del _sessions[self.game.id]
+
+
+def get_log():
+    global _log
+    with _lock:
+        if _log is None:
+            _log = WriteBehindLog(getattr(settings, 'GAME_SESSION_LOG', 'sessions.log'))
+        return _log
+
+
+def get_session(game_id):
+    """Return the session of an active game, opening it if needed, or None."""
+    if not getattr(settings, 'GAME_SESSIONS', False):
+        return None
+    with _lock:
+        session = _sessions.get(int(game_id))
+    if session is not None:
+        return session
+
+    log = get_log()
+    game = Game.objects.filter(id=game_id, stage__in=ACTIVE_STAGES).first()
+    if game is None:
+        return None
+    session = GameSession(game, log)
+    with _lock:
+        # Another request may have opened it meanwhile
+        return _sessions.setdefault(game.id, session)
@@ -0,0 +1,170 @@
+"""
+Background tasks.
+
+Work that doesn't have to finish before a response is sent is handed to
+enqueue. TASK_BACKEND picks where it runs:
+
+    'thread'    a thread pool inside the web process (default)
+    'database'  Task rows picked up by `manage.py run_tasks` workers
+    'immediate' right away in the caller, e.g. for tests
+
+Bots move in play_bots, one move at a time under a per-game lock kept in
+the cache, so several workers only share it when the cache is shared
+between processes (e.g. memcached). In a game held in a session the bot
+searches for its play outside the session's lock, so requests for the game
+aren't held up while it thinks.
+"""
+
+import concurrent.futures
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker may hold a game's bot lock for one move, or a game may stay queued
+BOTS_LOCK_TIMEOUT = 60
+
+registry = {}
+_executor = None
+
+
+def task(func):
+    registry[func.__name__] = func
+    return func
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(settings, 'TASK_THREADS', 2))
+    return _executor
+
+
+def run(name, args):
+    try:
+        registry[name](*args)
+    except Exception:
+        logger.exception("task %s%r failed", name, tuple(args))
+        raise
+
+
+def _run_in_thread(name, args):
+    try:
+        run(name, args)
+    finally:
+        connection.close()
+
+
+def enqueue(func, *args):
+    backend = getattr(settings, 'TASK_BACKEND', 'thread')
+    if backend == 'immediate':
+        run(func.__name__, args)
+    elif backend == 'database':
+        from main.models import Task
+        Task.objects.create(name=func.__name__, args=json.dumps(args))
+    else:
+        get_executor().submit(_run_in_thread, func.__name__, args)
+
+
+def run_pending(limit=None):
+    """Run queued Task rows, returning how many were run."""
+    from main.models import Task
+
+    count = 0
+    while limit is None or count < limit:
+        task = Task.objects.filter(status=Task.PENDING).order_by('id').first()
+        if task is None:
+            break
+
+        # Claim the task so other workers skip it
+        if not Task.objects.filter(id=task.id, status=Task.PENDING).update(status=Task.RUNNING,
+                                                                            started=timezone.now()):
+            continue
+
+        count += 1
+        try:
+            run(task.name, json.loads(task.args))
+        except Exception as e:
+            Task.objects.filter(id=task.id).update(status=Task.FAILED, error=repr(e))
+        else:
+            Task.objects.filter(id=task.id).update(status=Task.DONE)
+    return count
+
+
+@task
+def finish_game(game_id):
+    from main.models import Game, PlayerStats, TournamentTable
+
+    game = Game.objects.get(id=game_id)
+    game.update_ranks()
+    PlayerStats.record_games([game])
+    try:
+        table = game.table
+    except TournamentTable.DoesNotExist:
+        game.rematch()
+    else:
+        table.tournament.table_finished(table)
+
+
+def start_bots(game_id):
+    """Queue play_bots for a game, unless it's queued already."""
+    if cache.add('bots_queued:{}'.format(game_id), True, BOTS_LOCK_TIMEOUT):
+        enqueue(play_bots, game_id)
+
+
+def play_session_bot(session):
+    """Make a bot's move in a game held in a session, returning whether one was made and the game's version."""
+    from main import ai
+    from main.models import Game
+
+    with session.lock:
+        game = session.game
+        player = game.bot_turn()
+        if player is None or game.stage != Game.PLAY:
+            return bool(game.play_bots(limit=1)), game.version
+        version = game.version
+        state = ai.snapshot(game, player)
+
+    cards = ai.search_play(state, game.id)
+    with session.lock:
+        if game.session is not session or game.version != version:
+            # Someone moved meanwhile, so the bot looks again
+            return True, game.version
+        ret = game.play(player, cards)
+        if ret is not None:
+            logger.error("bot play rejected: %s", ret)
+            return False, game.version
+        return True, game.version
+
+
+@task
+def play_bots(game_id):
+    from main.models import Game
+    from main.sessions import get_session
+
+    cache.delete('bots_queued:{}'.format(game_id))
+    lock = 'bots:{}'.format(game_id)
+    while cache.add(lock, True, BOTS_LOCK_TIMEOUT):
+        try:
+            session = get_session(game_id)
+            if session is not None:
+                moved, version = play_session_bot(session)
+            else:
+                game = Game.objects.get(id=game_id)
+                moved, version = game.play_bots(limit=1), game.version
+        finally:
+            cache.delete(lock)
+
+        # A worker started while the lock was held gave up, so look again unless nothing changed
+        if not moved:
+            if session is not None and session.game.session is session:
+                if session.game.version == version:
+                    return
+            elif Game.objects.filter(id=game_id, version=version).exists():
+                return
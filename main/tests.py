@@ -5,8 +5,12 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import io
+import os
+
+from django.test import TestCase, override_settings
 from main.models import *
+from main.rules import *
 
 
 class CardTest(TestCase):
@@ -26,6 +30,14 @@ class CardTest(TestCase):
         self.assertTrue(is_consecutive(ranks2, HEARTS, THREE))
 
 
+class CardIdTest(TestCase):
+    def test_ids(self):
+        self.assertEqual(len(set(card.id() for card in create_deck())), 54)
+        for card in create_deck():
+            self.assertEqual(Card.fromid(card.id()), card)
+        self.assertEqual(Card(HEARTS, FIVE).repr(), {'card': 'H5', 'id': 29})
+
+
 class PlayTest(TestCase):
     def assert_combination(self, combination, n, consecutive, ranks):
         self.assertEqual(combination['n'], n)
@@ -172,6 +184,66 @@ class PlayTest(TestCase):
         rank2 = combination['rank']
         self.assertTrue(sorted([rank1, rank2]) == sorted([TWO, THREE]))
 
+    def test_hand_index(self):
+        hand = Cards.fromstr("S5,S5,S9,S9,S9,S13,H2")
+        index = HandIndex.build(hand.cards, HEARTS, FOUR)
+        self.assertTrue(index.beats(SPADES, 1, QUEEN))
+        self.assertTrue(index.beats(SPADES, 2, EIGHT))
+        self.assertFalse(index.beats(SPADES, 2, NINE))
+        self.assertTrue(index.beats(SPADES, 3, EIGHT))
+        self.assertFalse(index.beats(SPADES, 4, TWO))
+        self.assertFalse(index.beats(CLUBS, 1, TWO))
+
+        played = Cards.fromstr("S9,S13").cards
+        hand.play_cards(played)
+        index.play_cards(hand, played, HEARTS, FOUR)
+        self.assertFalse(index.beats(SPADES, 1, QUEEN))
+        self.assertFalse(index.beats(SPADES, 3, EIGHT))
+        self.assertTrue(index.beats(SPADES, 2, EIGHT))
+        self.assertEqual(HandIndex.decode(index.encode()).best, index.best)
+
+    def test_decode(self):
+        encoded = CardCombinations(Cards.fromstr("S2,S2,S3,S3").cards, HEARTS, FOUR).encode()
+        play = CardCombinations.decode(encoded)
+        self.assertIs(CardCombinations.decode(encoded), play)
+        self.assertIs(CardCombinations.decode(encoded.encode('utf-8')), play)
+        self.assertEqual(play.card_list, tuple(Cards.fromstr("S2,S2,S3,S3").cards))
+        self.assertEqual(play.encode(), encoded)
+        self.assertTrue(CardCombinations(Cards.fromstr("H2,H2,H3,H3").cards, HEARTS, FOUR) > play)
+
+        with self.assertRaises(AttributeError):
+            play.suit = HEARTS
+        with self.assertRaises(TypeError):
+            play.combinations[0]['n'] = 1
+
+
+class RulesetTest(TestCase):
+    def test_standard(self):
+        rules = get_ruleset(STANDARD)
+        self.assertIs(get_ruleset(STANDARD), rules)
+        self.assertEqual(rules.points(Cards.fromstr("S5,H10,D13,C14,J18").cards), 25)
+        self.assertEqual(rules.layouts, Game.SETTINGS)
+
+        for points, result in ((-5, (DECLARERS, 3)), (0, (DECLARERS, 2)), (35, (DECLARERS, 2)),
+                               (40, (DECLARERS, 1)), (75, (DECLARERS, 1)), (80, (OPPONENTS, 1)),
+                               (120, (OPPONENTS, 2)), (155, (OPPONENTS, 2)), (160, (OPPONENTS, 3)),
+                               (10000, (OPPONENTS, 3))):
+            self.assertEqual(rules.rank_change(points), result)
+
+    def test_variant(self):
+        from main.engine import Deal
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        self.assertFalse(Game.setup(players, ruleset='unknown'))
+        game = Game.setup(players, ruleset='kitty_x4')
+        self.assertEqual(Game.objects.get(id=game.id).rules().kitty_multiplier, 4)
+
+        deal = Deal([[Card(SPADES, ACE)], [Card(SPADES, TWO)]], [OPPONENTS, DECLARERS], HEARTS, THREE,
+                    kitty=[Card(SPADES, FIVE)], rules=game.rules())
+        deal.play([Card(SPADES, ACE)])
+        deal.play([Card(SPADES, TWO)])
+        self.assertEqual(deal.points, [20, 0])
+
 
 class PlayerTest(TestCase):
     def test_player(self):
@@ -212,6 +284,97 @@ class GameTest(TestCase):
         self.assertTrue(len(Cards.fromstr(player.hand)) == game.hand_size())
         self.assertTrue(len(Cards.fromstr(game.kitty)) == game.reserve_size())
 
+    def test_insert_into_unsorted_hand(self):
+        key = display_key(HEARTS, TWO)
+        # A hand stored before hands were kept in order is sorted once cards are added
+        hand = Cards.fromstr('S14,H2,C5,D9')
+        hand.insert_cards(Cards.fromstr('C3,H5').cards, key)
+        self.assertEqual(hand.cards, sorted(Cards.fromstr('S14,H2,C5,D9,C3,H5').cards, key=key))
+
+    def test_hand_order(self):
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        # The first card dealt is of the trump rank, so there's always one to set the trump suit with
+        deck = Cards.fromstr(game.deck).cards
+        deck.append(deck.pop(next(i for i, card in enumerate(deck)
+                                  if card.rank == game.trump_rank and card.suit != JOKER)))
+        game.deck = str(Cards(deck))
+        game.save()
+        players = list(game.gameplayer_set.all())
+        for player in players:
+            game.ready(player)
+        for player in itertools.islice(itertools.cycle(players), 40):
+            game.deal(player)
+
+        def assert_sorted():
+            key = display_key(game.trump_suit, game.trump_rank)
+            for player in game.gameplayer_set.all():
+                cards = player.get_hand().cards
+                self.assertEqual(cards, sorted(cards, key=key))
+
+        assert_sorted()
+        player = game.gameplayer_set.get(turn=players[0].turn)
+        card = next(card for card in player.get_hand().cards
+                    if card.rank == game.trump_rank and card.suit != JOKER)
+        self.assertIsNone(game.set_trump_suit(player, [card]))
+        self.assertEqual(game.trump_suit, card.suit)
+        assert_sorted()
+
+        players = list(game.gameplayer_set.all())
+        for player in itertools.islice(itertools.cycle(players), 100):
+            game.deal(player)
+        assert_sorted()
+        self.assertIsNone(game.pickup_reserve(players[0]))
+        assert_sorted()
+
+    def test_friend_lookup(self):
+        players = [Player.create_player(str(i), str(i)) for i in range(5)]
+        game = Game.setup(players)
+        game.stage = Game.RESERVE
+        game.trump_suit = HEARTS
+        game.save()
+        declarer, friend = game.gameplayer_set.all()[:2]
+        kitty = ['C3'] * game.reserve_size()
+        declarer.hand = ','.join(kitty + ['C4'])
+        declarer.save()
+        friend.hand = 'H14'
+        friend.save()
+
+        self.assertIsNone(game.reserve(declarer, Cards.fromstr(','.join(kitty)).cards,
+                                       FriendCard.fromstr('1H14')))
+        self.assertEqual(list(game.get_friend_lookup().cards), ['H14'])
+
+        # The first and second ace of spades
+        lookup = FriendLookup.build([FriendCard(id=1, number=2, suit=SPADES, rank=ACE),
+                                     FriendCard(id=2, number=1, suit=SPADES, rank=ACE)])
+        self.assertEqual(sorted(lookup.play_cards([Card(SPADES, ACE), Card(HEARTS, ACE)])),
+                         [(1, 1, False), (2, 1, True)])
+        self.assertEqual(lookup.play_cards([Card(SPADES, ACE)]), [(1, 2, True)])
+        self.assertEqual(lookup.cards, {})
+
+        self.assertIsNone(game.play(declarer, [Card(CLUBS, FOUR)]))
+        friend = game.gameplayer_set.get(id=friend.id)
+        self.assertIsNone(game.play(friend, [Card(HEARTS, ACE)]))
+        self.assertEqual(game.gameplayer_set.get(id=friend.id).team, DECLARERS)
+        self.assertTrue(game.friend_cards.get().found)
+        self.assertEqual(game.get_friend_lookup().cards, {})
+
+    def test_bulk_setup(self):
+        players = [Player.create_player(str(i), str(i)) for i in range(9)]
+        games = Game.bulk_setup([players[:4], players[4:]])
+        self.assertEqual(len(games), 2)
+        self.assertEqual(GamePlayer.objects.count(), 9)
+
+        game = Game.objects.get(id=games[1].id)
+        self.assertTrue(game.find_friends)
+        self.assertEqual([player.turn for player in game.gameplayer_set.order_by('turn')], list(range(5)))
+        self.assertEqual(len(Cards.fromstr(game.deck)), 2 * 54)
+        self.assertEqual(game.deck, game.shuffled_deck())
+        self.assertNotEqual(games[0].seed, games[1].seed)
+
+        self.assertFalse(Game.bulk_setup([players[:4], players[:3]]))
+        self.assertEqual(Game.objects.count(), 2)
+
     def test_play(self):
         players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
         game = Game.setup(players)
@@ -255,6 +418,14 @@ class GameTest(TestCase):
         self.assertEqual(lead_play.suit, DIAMONDS)
         self.assertEqual(lead_play.rank, QUEEN)
 
+        trick = game.get_trick()
+        self.assertEqual(trick.cards, Cards.fromstr("D12").cards)
+        self.assertEqual(trick.winner, [DIAMONDS, QUEEN])
+        stored = game.trick
+        game.trick = ''
+        self.assertEqual(game.get_trick().encode(), stored)
+        game.trick = stored
+
         self.assertTrue(game.play(player1, hands[1].cards))
         self.assertEqual(game.lead, 0)
 
@@ -270,4 +441,866 @@ class GameTest(TestCase):
         lead_play = CardCombinations.decode(game.gameplayer_set.all()[game.lead].play)
         self.assertEqual(lead_play.suit, DIAMONDS)
         self.assertEqual(lead_play.rank, KING)
+        self.assertEqual(game.get_trick().winner, [DIAMONDS, KING])
         self.assertEqual(game.trick_points, 10)
+
+
+class QueryPlanTest(TestCase):
+    def query_plan(self, queryset):
+        from django.db import connection
+
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assert_indexed(self, queryset):
+        for step in self.query_plan(queryset):
+            # A scan is fine when it's in index order, e.g. for the leaderboard
+            self.assertNotRegex(step, r'^SCAN (TABLE )?\w+( AS \w+)?$', "Full table scan")
+            self.assertNotIn('TEMP B-TREE', step)
+
+    def test_hot_queries(self):
+        from django.db import connection
+
+        if connection.vendor != 'sqlite':
+            self.skipTest("EXPLAIN QUERY PLAN is SQLite's")
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+
+        self.assert_indexed(game.gameplayer_set.filter(player__user=players[0].user))
+        self.assert_indexed(game.gameplayer_set.filter(team=OPPONENTS))
+        self.assert_indexed(game.friend_cards.filter(found=False))
+        self.assert_indexed(User.objects.filter(player__bot=False))
+        self.assert_indexed(Player.objects.order_by('-rank', '-plus'))
+
+
+class BotTest(TestCase):
+    def test_legal_plays(self):
+        from main.engine import Deal
+
+        hands = [Cards.fromstr(s).cards for s in ("H5,H5,H6,H6,S3", "H9,H10,D4,D4,S4", "S5,S6,S7,S8,S9", "D5,D6,D7,D8,D9")]
+        deal = Deal(hands, [DECLARERS, OPPONENTS] * 2, CLUBS, TWO)
+        leads = deal.legal_plays()
+        self.assertIn(Cards.fromstr("H5,H5,H6,H6").cards, leads)
+        self.assertIn(Cards.fromstr("S3").cards, leads)
+
+        self.assertIsNone(deal.play(Cards.fromstr("H5,H5,H6,H6").cards))
+        follows = deal.legal_plays()
+        self.assertTrue(follows)
+        for cards in follows:
+            self.assertIn(Card(HEARTS, NINE), cards)
+            self.assertIn(Card(HEARTS, TEN), cards)
+
+    @override_settings(AI_PROCESSES=0, AI_MOVE_BUDGET=0.01, TASK_BACKEND='immediate')
+    def test_bots(self):
+        from unittest import mock
+        from main import ai
+
+        players = Player.get_bots(4)
+        self.assertEqual(len(set(player.id for player in players)), 4)
+        game = Game.setup(players)
+        game.ready(game.gameplayer_set.all()[0])
+        with mock.patch.object(ai, 'MAX_TREES', 2):
+            game.play_bots()
+            # Only the most recently used search trees are kept
+            self.assertEqual(len(ai._trees), 2)
+
+        self.assertEqual(game.stage, Game.SCORE)
+        for player in game.gameplayer_set.all():
+            self.assertEqual(player.hand, '')
+
+    @override_settings(AI_PROCESSES=0, AI_MOVE_BUDGET=0.01, TASK_BACKEND='immediate')
+    def test_play_bots_task(self):
+        from django.core.cache import cache
+        from main import tasks
+
+        players = [Player.create_player('a', 'a')] + Player.get_bots(3)
+        game = Game.setup(players)
+        self.client.login(username='a', password='a')
+        self.client.post('/ready/{}'.format(game.id))
+        game = Game.objects.get(id=game.id)
+        self.assertEqual(game.stage, Game.DEAL)
+        # The person deals first, so nothing for the bots yet
+        self.assertIsNone(game.bot_turn())
+
+        self.client.get('/status/{}'.format(game.id))
+        game = Game.objects.get(id=game.id)
+        self.assertEqual(game.turn, 0)
+        self.assertEqual([len(player.get_hand()) for player in game.gameplayer_set.all()], [1, 1, 1, 1])
+
+        # Another worker has the game's bots
+        game.turn = 1
+        game.save()
+        cache.add('bots:{}'.format(game.id), True)
+        tasks.play_bots(game.id)
+        self.assertEqual(Game.objects.get(id=game.id).turn, 1)
+        cache.delete('bots:{}'.format(game.id))
+        tasks.start_bots(game.id)
+        self.assertEqual(Game.objects.get(id=game.id).turn, 0)
+
+
+class TaskTest(TestCase):
+    @override_settings(TASK_BACKEND='database')
+    def test_finish_game(self):
+        from main import tasks
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        game.stage = Game.SCORE
+        game.save()
+        opponent = game.gameplayer_set.get(turn=1)
+        opponent.points = 120
+        opponent.save()
+        game.winner = OPPONENTS
+        game.save()
+
+        tasks.enqueue(tasks.finish_game, game.id)
+        self.assertEqual(Task.objects.filter(status=Task.PENDING).count(), 1)
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(Task.objects.get().status, Task.DONE)
+
+        self.assertEqual(Player.objects.get(id=opponent.player.id).rank, THREE)
+        game = Game.objects.get(id=game.id)
+        self.assertTrue(game.ranked)
+        self.assertIsNotNone(game.next_game)
+        self.assertEqual(game.next_game.gameplayer_set.get(turn=0).player, opponent.player)
+
+        # Ranks are only applied once
+        self.assertFalse(game.update_ranks())
+        self.assertEqual(game.rematch(), game.next_game)
+        self.assertEqual(Player.objects.get(id=opponent.player.id).rank, THREE)
+
+    def test_update_ranks(self):
+        from unittest import mock
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        game.stage = Game.SCORE
+        game.save()
+
+        # A crash part-way through leaves the game to be ranked again
+        with mock.patch.object(Player, 'add_rank', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                game.update_ranks()
+        self.assertFalse(Game.objects.get(id=game.id).ranked)
+
+        # A rematch set up meanwhile is kept
+        next_game = Game.setup(players)
+        Game.objects.filter(id=game.id).update(next_game=next_game)
+        game.update_ranks()
+        game = Game.objects.get(id=game.id)
+        self.assertTrue(game.ranked)
+        self.assertEqual(game.next_game, next_game)
+        self.assertEqual(Player.objects.get(id=players[0].id).get_rank(), '3+')
+
+
+class TournamentTest(TestCase):
+    def test_swiss_pairing(self):
+        tables = swiss_pairing(list(range(9)), 4, {})
+        self.assertEqual(tables, [[0, 1, 2, 3, 4], [5, 6, 7, 8]])
+
+        met = {0: {1, 2}, 1: {0, 2}, 2: {0, 1}}
+        tables = swiss_pairing(list(range(8)), 4, met)
+        self.assertEqual(tables[0][:2], [0, 3])
+        self.assertEqual(sorted(sum(tables, [])), list(range(8)))
+
+    @override_settings(TASK_BACKEND='immediate')
+    def test_tournament(self):
+        from main import tasks
+
+        players = [Player.create_player(str(i), str(i)) for i in range(8)]
+        tournament = Tournament.create('Open', players, rounds=2)
+        self.assertEqual(tournament.tables.filter(round=1).count(), 2)
+
+        for table in tournament.tables.filter(round=1):
+            Game.objects.filter(id=table.game.id).update(stage=Game.SCORE, winner=DECLARERS)
+            tasks.finish_game(table.game.id)
+            self.assertIsNone(Game.objects.get(id=table.game.id).next_game)
+
+        tournament = Tournament.objects.get(id=tournament.id)
+        self.assertEqual(tournament.round, 2)
+        standings = list(tournament.standings())
+        self.assertEqual([entry.score for entry in standings], [1] * 4 + [0] * 4)
+        self.assertTrue(all(entry.played == 1 for entry in standings))
+
+        # Winners of the first round play each other
+        winners = set(entry.player_id for entry in standings[:4])
+        tables = tournament.tables.filter(round=2)
+        self.assertIn(winners, [set(player.player_id for player in table.game.gameplayer_set.all())
+                                for table in tables])
+
+        for table in tables:
+            Game.objects.filter(id=table.game.id).update(stage=Game.SCORE, winner=OPPONENTS)
+            tasks.finish_game(table.game.id)
+        self.assertTrue(Tournament.objects.get(id=tournament.id).finished)
+
+    def test_new_tournament(self):
+        players = [Player.create_player(str(i), str(i)) for i in range(3)]
+        self.client.login(username='0', password='0')
+        users = [str(player) for player in players]
+        response = self.client.post('/new_tournament/', {'users': users, 'rounds': 'x'})
+        self.assertEqual(response.context['error'], 'Rounds has to be a whole number of at least 1')
+        response = self.client.post('/new_tournament/', {'users': users, 'rounds': '2'})
+        self.assertEqual(response.context['error'], 'At least 4 players are needed')
+        self.assertEqual(Tournament.seating_error(9, 8), "9 players can't be split into tables of 8 to 8")
+
+        response = self.client.post('/new_game/', {'users': users, 'bots': 'x'})
+        self.assertEqual(response.context['error'], 'Only 4-8 players are allowed')
+        self.assertRedirects(self.client.post('/new_game/', {'users': users, 'bots': '1'}),
+                             Game.objects.get().get_absolute_url())
+
+
+class PlayerStatsTest(TestCase):
+    def test_record_games(self):
+        from django.core.management import call_command
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        games = Game.bulk_setup([players, players[1:] + players[:1]])
+        for game in games:
+            Game.objects.filter(id=game.id).update(stage=Game.SCORE, winner=OPPONENTS)
+            game.gameplayer_set.filter(turn=1).update(points=90)
+
+        call_command('backfill_stats', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(PlayerStats.record_games(Game.objects.all()), 0)
+
+        stats = Player.objects.get(id=players[0].id).stats
+        self.assertEqual(stats.games_played, 2)
+        self.assertEqual(stats.declarer_games, 1)
+        self.assertEqual(stats.declarer_wins, 0)
+        self.assertEqual(stats.opponent_wins, 1)
+        self.assertEqual(stats.average_opponent_points(), 90)
+
+        self.client.login(username='b', password='b')
+        response = self.client.get('/profile/a')
+        self.assertContains(response, 'Wins as opponent')
+
+    def test_increment(self):
+        player = Player.create_player('a', 'a')
+        PlayerStats.increment(player.id, tractors_led=1)
+        PlayerStats.increment(player.id, tractors_led=1, friends_found=1)
+        stats = PlayerStats.objects.get(player=player)
+        self.assertEqual((stats.tractors_led, stats.friends_found), (2, 1))
+
+
+class ExportTest(TestCase):
+    def test_export_games(self):
+        import datetime
+        from django.core.management import call_command
+        from django.utils import timezone
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        games = Game.bulk_setup([players] * 4, find_friends=True)
+        # games[1] finished first, and games[3] only just finished so it may not be committed yet
+        now = timezone.now()
+        for game, minutes in zip(games, (10, 20, 5, 0)):
+            Game.objects.filter(id=game.id).update(stage=Game.SCORE, winner=OPPONENTS, kitty='S5',
+                                                   finished_at=now - datetime.timedelta(minutes=minutes))
+            game.gameplayer_set.filter(turn=1).update(points=90)
+        friend_cards = FriendCard.fromstr('1H14')
+        for friend_card in friend_cards:
+            friend_card.game = games[0]
+        FriendCard.objects.bulk_create(friend_cards)
+        ArchivedGame.archive([Game.objects.get(id=games[2].id)])
+
+        out = io.StringIO()
+        err = io.StringIO()
+        call_command('export_games', batch_size=1, stdout=out, stderr=err)
+        exported = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([game['id'] for game in exported], [games[1].id, games[0].id, games[2].id])
+        self.assertEqual(exported[1]['kitty'], 'S5')
+        self.assertEqual(exported[1]['points'], 90)
+        self.assertEqual([player['username'] for player in exported[1]['players']], ['a', 'b', 'c', 'd'])
+        self.assertEqual(exported[1]['friend_cards'], [{'number': 1, 'suit': HEARTS, 'rank': ACE, 'found': False}])
+        self.assertEqual(exported[0]['friend_cards'], [])
+        self.assertEqual((exported[2]['points'], exported[2]['find_friends']), (90, False))
+        self.assertEqual([player['username'] for player in exported[2]['players']], ['a', 'b', 'c', 'd'])
+        watermark = err.getvalue().split(' up to ')[1].strip()
+        self.assertTrue(watermark.endswith(',{}'.format(games[2].id)))
+
+        out = io.StringIO()
+        call_command('export_games', since='{},{}'.format(exported[1]['finished_at'], games[0].id),
+                     stdout=out, stderr=io.StringIO())
+        self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()], [games[2].id])
+
+        Game.objects.filter(id=games[3].id).update(finished_at=now - datetime.timedelta(minutes=2))
+        out = io.StringIO()
+        call_command('export_games', since=watermark, stdout=out, stderr=io.StringIO())
+        self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()], [games[3].id])
+
+
+class ArchiveTest(TestCase):
+    def test_archive_games(self):
+        import datetime
+        from django.core.management import call_command
+        from django.utils import timezone
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        games = Game.bulk_setup([players] * 5, find_friends=True)
+        old = timezone.now() - datetime.timedelta(days=60)
+        for game, next_game in zip(games[:4], games[1:]):
+            Game.objects.filter(id=game.id).update(stage=Game.SCORE, finished_at=old, kitty='S5',
+                                                   next_game=next_game, ranked=True, stats_recorded=True)
+        # games[2] is the next game of a game that won't be archived
+        Game.objects.filter(id=games[1].id).update(finished_at=timezone.now())
+        friend_cards = FriendCard.fromstr('1H14')
+        for friend_card in friend_cards:
+            friend_card.game = games[0]
+        FriendCard.objects.bulk_create(friend_cards)
+        games[0].gameplayer_set.filter(turn=1).update(points=90)
+
+        call_command('archive_games', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(sorted(Game.objects.values_list('id', flat=True)), [game.id for game in games[1:]])
+        self.assertEqual(ArchivedGame.objects.count(), 1)
+        self.assertFalse(FriendCard.objects.exists())
+
+        archived = ArchivedGame.objects.get(id=games[0].id)
+        self.assertEqual((archived.points, archived.kitty, archived.friend_cards), (90, 'S5', '1H14'))
+        self.assertEqual(archived.next_game_id, games[1].id)
+        self.assertEqual(archived.get_players_names(), 'a, b, c, d')
+
+        Game.objects.filter(id=games[1].id).update(finished_at=old)
+        # Games whose stats haven't been recorded or with no finish time are kept
+        Game.objects.filter(id=games[3].id).update(stats_recorded=False)
+        Game.objects.filter(id=games[4].id).update(stage=Game.SCORE, ranked=True, stats_recorded=True)
+        call_command('archive_games', stdout=io.StringIO())
+        self.assertEqual(sorted(ArchivedGame.objects.values_list('id', flat=True)),
+                         [game.id for game in games[:3]])
+
+        Game.objects.filter(id=games[3].id).update(stats_recorded=True)
+        call_command('archive_games', stdout=io.StringIO())
+        self.assertEqual(sorted(ArchivedGame.objects.values_list('id', flat=True)),
+                         [game.id for game in games[:4]])
+        self.assertEqual(list(Game.objects.values_list('id', flat=True)), [games[4].id])
+
+        self.client.login(username='a', password='a')
+        response = self.client.get('/game/{}'.format(games[0].id))
+        self.assertContains(response, '/game/{}'.format(games[1].id))
+        self.assertEqual([game.id for game in self.client.get('/').context['games']],
+                         [games[4].id, games[3].id, games[2].id, games[1].id, games[0].id])
+
+
+class SpriteTest(TestCase):
+    def test_sprites(self):
+        import tempfile
+        from django.core.management import call_command
+        from main import views
+
+        try:
+            import PIL
+        except ImportError:
+            self.skipTest("Pillow isn't installed")
+
+        with tempfile.TemporaryDirectory() as root, self.settings(SPRITES_ROOT=root):
+            views._sprite_manifest = None
+            call_command('build_sprites', stdout=io.StringIO())
+            manifest = views.get_sprite_manifest()
+            self.assertEqual(len(manifest['cards']), 54)
+
+            response = self.client.get('/sprites/' + manifest['css'])
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000')
+            self.assertIn(manifest['png'], response.content.decode())
+            self.assertEqual(self.client.get('/sprites/manifest.json').status_code, 404)
+        views._sprite_manifest = None
+
+
+class StatusTest(TestCase):
+    @override_settings(STATUS_MIN_POLL_INTERVAL=0)
+    def test_compact(self):
+        import gzip
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        player = game.gameplayer_set.get(turn=1)
+        player.hand = 'H5,S14'
+        player.play = CardCombinations(Cards.fromstr('H5').cards, HEARTS, TWO).encode()
+        player.save()
+        game.project()
+
+        self.client.login(username='b', password='b')
+        data = json.loads(self.client.get('/status/{}'.format(game.id)).content.decode())
+        compact = json.loads(self.client.get('/status/{}'.format(game.id), {'format': 'compact'}).content.decode())
+        self.assertEqual(compact[0], 1)
+        self.assertEqual(compact[1], int(data['stage']))
+        self.assertEqual(compact[6][1], [card['id'] for card in data['hand']['cards']])
+        self.assertEqual(compact[7][1], ['b', 0, OPPONENTS, 0, [Card(HEARTS, FIVE).id()]])
+
+        # Compressed only when asked for
+        response = self.client.get('/status/{}'.format(game.id), {'format': 'compact'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response = self.client.get('/status/{}'.format(game.id), {'format': 'compact', 'encoding': 'gzip'},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content).decode()), compact)
+
+    @override_settings(STATUS_MIN_POLL_INTERVAL=0)
+    def test_projection(self):
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        player = game.gameplayer_set.get(turn=1)
+        player.hand = 'H5,S14'
+        player.save()
+        game.ready(player)
+
+        self.client.login(username='b', password='b')
+        # Only the session, user and projection are read
+        with self.assertNumQueries(3):
+            data = json.loads(self.client.get('/status/{}'.format(game.id)).content.decode())
+        self.assertTrue(data['ready'])
+        self.assertEqual(data['hand']['str'], 'H5,S14')
+        self.assertEqual(data, game.player_status(player, list(game.gameplayer_set.all())))
+
+        # Dealing has to go through the game
+        game.stage = Game.DEAL
+        game.save()
+        self.assertTrue(GameProjection.objects.get(game_id=game.id).writes)
+        data = json.loads(self.client.get('/status/{}'.format(game.id)).content.decode())
+        self.assertEqual(data['stage'], Game.DEAL)
+
+    def test_poll(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        self.client.login(username='b', password='b')
+        response = self.client.get('/status/{}'.format(game.id))
+        version = response['X-Game-Version']
+
+        # Nothing changed since the version the client has
+        response = self.client.get('/status/{}'.format(game.id), {'since': version})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        # Polls inside the interval aren't looked at, even after a change
+        game.ready(game.gameplayer_set.get(turn=0))
+        self.assertEqual(self.client.get('/status/{}'.format(game.id), {'since': version}).status_code, 304)
+        cache.clear()
+        response = self.client.get('/status/{}'.format(game.id), {'since': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-Game-Version']), int(version))
+
+    def test_poll_without_since(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        self.client.login(username='b', password='b')
+        response = self.client.get('/status/{}'.format(game.id))
+        self.assertEqual(response.status_code, 200)
+
+        # Inside the interval the last response is sent again without looking at the game
+        game.ready(game.gameplayer_set.get(turn=0))
+        with self.assertNumQueries(2):
+            again = self.client.get('/status/{}'.format(game.id))
+        self.assertEqual(again.content, response.content)
+        self.assertEqual(again['X-Game-Version'], response['X-Game-Version'])
+        # A different format has no response to repeat
+        self.assertEqual(self.client.get('/status/{}'.format(game.id), {'format': 'compact'}).status_code, 304)
+
+        # A move of the client's own is shown by the next poll
+        self.client.get('/ready/{}'.format(game.id))
+        response = self.client.get('/status/{}'.format(game.id))
+        self.assertGreater(int(response['X-Game-Version']), int(again['X-Game-Version']))
+
+    def test_deferred_projections(self):
+        from unittest import mock
+        from main.models import deferred_projections
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        with mock.patch.object(Game, 'project', autospec=True) as project:
+            games = Game.bulk_setup([players, players])
+        # Once per game, with its players
+        self.assertEqual([call[0][0].id for call in project.call_args_list], [game.id for game in games])
+        self.assertEqual(GameProjection.objects.count(), 0)
+
+        with mock.patch.object(Game, 'project') as project:
+            with self.assertRaises(RuntimeError):
+                with deferred_projections():
+                    games[0].save()
+                    raise RuntimeError
+        self.assertFalse(project.called)
+
+    def test_concurrent_versions(self):
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        # Two requests that loaded the same version each save a new one
+        first, second = Game.objects.get(id=game.id), Game.objects.get(id=game.id)
+        first.save()
+        second.save()
+        self.assertEqual((first.version, second.version), (game.version + 1, game.version + 2))
+        self.assertEqual(GameProjection.objects.get(game_id=game.id).version, second.version)
+
+    def test_single_flight(self):
+        import threading
+        import time
+        from main.coalesce import SingleFlight
+
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', compute))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1] * 4)
+        # Once it's done the next call runs again
+        self.assertEqual(flight.do('key', compute), 2)
+
+    def test_spectate(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        Player.create_player('e', 'e')
+        game = Game.setup(players)
+        player = game.gameplayer_set.get(turn=1)
+        player.hand = 'H5,S14'
+        player.save()
+
+        self.client.login(username='e', password='e')
+        self.assertRedirects(self.client.get('/game/{}'.format(game.id)), '/watch/{}'.format(game.id))
+        state = json.loads(self.client.get('/spectate/{}'.format(game.id)).content.decode())
+        self.assertEqual([player['name'] for player in state['players']], ['a', 'b', 'c', 'd'])
+        self.assertNotIn('hand', state)
+        self.assertEqual(json.loads(self.client.get('/status/{}'.format(game.id)).content.decode()), state)
+
+        # Later watchers of the same version share the state: only the session, user and game are read
+        with self.assertNumQueries(3):
+            self.client.get('/spectate/{}'.format(game.id))
+
+        game.ready(player)
+        state = json.loads(self.client.get('/spectate/{}'.format(game.id)).content.decode())
+        self.assertEqual(state['version'], Game.objects.get(id=game.id).version)
+        self.assertTrue(state['players'][1]['ready'])
+
+    @override_settings(TASK_BACKEND='database')
+    def test_review(self):
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        game.trump_rank = TWO
+        game.trump_suit = HEARTS
+        game.kitty = 'S5'
+        game.stage = Game.PLAY
+        game.save()
+        players = list(game.gameplayer_set.all())
+        for player, hand in zip(players, ("D13,D12", "D10,D2", "H5,S14", "C3,J18")):
+            player.hand = hand
+            player.save()
+
+        for player, cards in zip(players, ("D13", "D10", "H5", "C3")):
+            self.assertIsNone(game.play(game.gameplayer_set.get(id=player.id), Cards.fromstr(cards).cards))
+        for player, cards in zip(players[2:] + players[:2], ("S14", "J18", "D12", "D2")):
+            self.assertIsNone(game.play(game.gameplayer_set.get(id=player.id), Cards.fromstr(cards).cards))
+
+        self.client.login(username='a', password='a')
+        response = self.client.get('/review/{}'.format(game.id))
+        review = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(review['players'], ['a', 'b', 'c', 'd'])
+        self.assertEqual(review['kitty'], 'S5')
+        self.assertEqual(review['tricks'], [
+            {'number': 0, 'leader': 0, 'winner': 2, 'points': 25, 'plays': [['D13'], ['D10'], ['H5'], ['C3']]},
+            # The opponents took the last trick and with it twice the kitty
+            {'number': 1, 'leader': 2, 'winner': 3, 'points': 10, 'plays': [['D12'], ['D2'], ['S14'], ['J18']]},
+        ])
+
+    def test_unseen(self):
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        game.trump_rank = TWO
+        game.trump_suit = HEARTS
+        game.deck = ''
+        game.kitty = 'S5'
+        game.stage = Game.PLAY
+        game.save()
+        for player, hand in zip(game.gameplayer_set.all(), ("D13,D12", "D13,D2", "H5,S14", "C3,J18")):
+            player.hand = hand
+            player.save()
+
+        tracker = CardTracker.full(2)
+        tracker.play_cards(Cards.fromstr("D13,D2").cards)
+        self.assertEqual(tracker.counts[Card(DIAMONDS, KING).id()], 1)
+        self.assertEqual(tracker.repr(HEARTS, TWO)[TRUMP]['total'], 2 * (13 + 3 + 2) - 1)
+
+        player = game.gameplayer_set.get(turn=0)
+        self.assertIsNone(game.play(player, Cards.fromstr("D12").cards))
+        self.assertEqual(CardTracker.decode(game.remaining).repr(HEARTS, TWO), {
+            DIAMONDS: {'total': 2, 'cards': {'D13': 2}},
+            SPADES: {'total': 2, 'cards': {'S5': 1, 'S14': 1}},
+            TRUMP: {'total': 3, 'cards': {'D2': 1, 'H5': 1, 'J18': 1}},
+            CLUBS: {'total': 1, 'cards': {'C3': 1}},
+        })
+
+        self.client.login(username='b', password='b')
+        unseen = json.loads(self.client.get('/unseen/{}'.format(game.id)).content.decode())
+        self.assertEqual(unseen[DIAMONDS], {'total': 1, 'cards': {'D13': 1}})
+        status = json.loads(self.client.get('/status/{}'.format(game.id)).content.decode())
+        self.assertEqual(status['unseen'], unseen)
+
+    def test_unseen_untracked(self):
+        from main.sessions import GameSession, WriteBehindLog
+        import tempfile
+
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        game = Game.setup(players)
+        player = game.get_players()[1]
+        # Nothing is tracked before play starts
+        with self.assertNumQueries(0):
+            self.assertIsNone(game.get_remaining())
+            self.assertEqual(game.unseen(player), {})
+
+        # A game started before the tracker was stored is rebuilt from the hands, the session's own while in one
+        game.trump_rank = TWO
+        game.trump_suit = HEARTS
+        game.stage = Game.PLAY
+        game.save()
+        with tempfile.NamedTemporaryFile() as f:
+            session = GameSession(Game.objects.get(id=game.id), WriteBehindLog(f.name, start=False))
+            for player, hand in zip(session.players, ("D13,D12", "D13,D2", "H5,S14", "C3,J18")):
+                player.hand = hand
+            with self.assertNumQueries(0):
+                unseen = session.game.unseen(session.players[1])
+        self.assertEqual(unseen[DIAMONDS], {'total': 2, 'cards': {'D13': 1, 'D12': 1}})
+
+
+class SessionTest(TestCase):
+    def setUp(self):
+        import tempfile
+
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        players = [Player.create_player(s, s) for s in ('a', 'b', 'c', 'd')]
+        self.game = Game.setup(players)
+        for player in self.game.gameplayer_set.all():
+            self.game.ready(player)
+
+    def test_write_behind(self):
+        from main.sessions import GameSession, WriteBehindLog
+
+        log = WriteBehindLog(self.path, start=False)
+        session = GameSession(Game.objects.get(id=self.game.id), log)
+        game = session.game
+        with self.assertNumQueries(0):
+            for player in session.players:
+                self.assertTrue(game.deal(player))
+        self.assertEqual([player.hand for player in self.game.gameplayer_set.all()], [''] * 4)
+
+        log.flush()
+        self.assertEqual([player.hand for player in self.game.gameplayer_set.all()],
+                         [player.hand for player in session.players])
+        self.assertEqual(Game.objects.get(id=game.id).deck, game.deck)
+        self.assertEqual(GameProjection.objects.get(game_id=game.id).version, game.version)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        # Once scored the game is saved straight away and leaves the session
+        game.stage = Game.SCORE
+        game.save()
+        self.assertIsNone(game.session)
+        self.assertEqual(Game.objects.get(id=game.id).stage, Game.SCORE)
+
+    def test_recover(self):
+        from main.sessions import GameSession, WriteBehindLog
+
+        session = GameSession(Game.objects.get(id=self.game.id), WriteBehindLog(self.path, start=False))
+        for player in session.players:
+            session.game.deal(player)
+        self.assertEqual(Game.objects.get(id=self.game.id).version, self.game.version)
+
+        # A new process replays the writes that never reached the database
+        WriteBehindLog(self.path, start=False)
+        self.assertEqual(Game.objects.get(id=self.game.id).version, session.game.version)
+        self.assertEqual([player.hand for player in self.game.gameplayer_set.all()],
+                         [player.hand for player in session.players])
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_write_failure(self):
+        from unittest import mock
+        from main import sessions
+
+        log = sessions.WriteBehindLog(self.path, start=False, batch_size=1)
+        session = sessions.GameSession(Game.objects.get(id=self.game.id), log)
+        for player in session.players:
+            session.game.deal(player)
+        size = os.path.getsize(self.path)
+
+        # Failed rows stay queued and logged, and the game can't leave the session until they're written
+        with mock.patch.object(sessions, 'write_entries', side_effect=RuntimeError):
+            session.game.stage = Game.SCORE
+            with self.assertRaises(sessions.WriteBehindError), self.assertLogs('main.sessions', 'ERROR'):
+                session.game.save()
+        self.assertIsNotNone(session.game.session)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        # The log is cut back to what's written, even while rows are left
+        with mock.patch.object(sessions, 'COMPACT_SIZE', 1):
+            self.assertEqual(log.write_pending(), 1)
+        self.assertLess(os.path.getsize(self.path), size)
+
+        session.game.save()
+        self.assertIsNone(session.game.session)
+        self.assertEqual(Game.objects.get(id=self.game.id).stage, Game.SCORE)
+        self.assertEqual([player.hand for player in self.game.gameplayer_set.all()],
+                         [player.hand for player in session.players])
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_recover_stale(self):
+        from main.sessions import GameSession, WriteBehindLog
+
+        session = GameSession(Game.objects.get(id=self.game.id), WriteBehindLog(self.path, start=False))
+        for player in session.players:
+            session.game.deal(player)
+        # The game moved on in the database after the rows were logged
+        Game.objects.filter(id=self.game.id).update(stage=Game.SCORE, version=session.game.version + 1)
+
+        WriteBehindLog(self.path, start=False)
+        self.assertEqual(Game.objects.get(id=self.game.id).stage, Game.SCORE)
+        self.assertEqual([player.hand for player in self.game.gameplayer_set.all()], [''] * 4)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    @override_settings(AI_PROCESSES=0, AI_MOVE_BUDGET=0.01)
+    def test_session_bots(self):
+        from unittest import mock
+        from main import ai, sessions, tasks
+
+        game = Game.setup(Player.get_bots(4))
+        game.ready(game.gameplayer_set.all()[0])
+        while game.stage != Game.PLAY:
+            game.play_bots(limit=1)
+        session = sessions.GameSession(Game.objects.get(id=game.id), sessions.WriteBehindLog(self.path, start=False))
+        player = session.game.bot_turn()
+        size = len(player.get_hand())
+
+        # The bot searches without holding the session's lock
+        search_play = ai.search_play
+        def search(state, game_id):
+            self.assertFalse(session.lock._is_owned())
+            return search_play(state, game_id)
+        with mock.patch.object(ai, 'search_play', side_effect=search):
+            self.assertEqual(tasks.play_session_bot(session), (True, session.game.version))
+        # A lead may be more than one card
+        self.assertLess(len(player.get_hand()), size)
+
+        # A move made meanwhile means the bot looks again instead of playing
+        player = session.game.bot_turn()
+        size = len(player.get_hand())
+        def move(state, game_id):
+            session.game.version += 1
+            return search_play(state, game_id)
+        with mock.patch.object(ai, 'search_play', side_effect=move):
+            self.assertTrue(tasks.play_session_bot(session)[0])
+        self.assertEqual(len(player.get_hand()), size)
+
+    def test_status(self):
+        from main import sessions
+
+        self.addCleanup(setattr, sessions, '_log', sessions._log)
+        sessions._log = sessions.WriteBehindLog(self.path, start=False)
+        self.addCleanup(sessions._sessions.clear)
+
+        self.client.login(username='a', password='a')
+        with self.settings(GAME_SESSIONS=True):
+            data = json.loads(self.client.get('/status/{}'.format(self.game.id)).content.decode())
+            self.assertEqual(len(data['hand']['new_cards']), 1)
+            session = sessions.get_session(self.game.id)
+            self.assertEqual(session.player('a').hand, data['hand']['str'])
+            self.assertEqual(self.game.gameplayer_set.get(turn=0).hand, '')
+        sessions._log.flush()
+        self.assertEqual(self.game.gameplayer_set.get(turn=0).hand, data['hand']['str'])
+
+
+class FuzzTest(TestCase):
+    def test_fuzz(self):
+        from main import fuzz
+
+        self.assertEqual(fuzz.fuzz(10, hand_size=6), [])
+
+        moves = fuzz.play_game(3, 5, 4)
+        self.assertEqual(len(moves), 5 * 4)
+        self.assertEqual(fuzz.play_game(3, 5, 4, moves), moves)
+
+    def test_shrink(self):
+        from collections import Counter
+        from unittest import mock
+        from main import fuzz
+
+        def check(deal, deck, played, plays_this_trick):
+            if len(played) >= 8:
+                raise fuzz.InvariantError("Too many cards played")
+
+        with mock.patch.object(fuzz, 'check', check):
+            [(seed, players, repro, error)] = fuzz.fuzz(1, players=[4])
+            self.assertEqual((seed, players, error), (0, 4, "Too many cards played"))
+            with self.assertRaisesRegex(fuzz.InvariantError, "Too many cards played"):
+                fuzz.replay(repro)
+
+        # The failing game's own moves are kept and the cards never played dropped
+        played = Counter()
+        for seat, cards in repro['moves']:
+            played[seat] += len(Cards.fromstr(cards))
+        self.assertEqual([len(Cards.fromstr(hand)) for hand in repro['hands']], [played[seat] for seat in range(4)])
+        # and it still ends with the play that goes past 8 cards
+        self.assertGreaterEqual(sum(played.values()), 8)
+        self.assertLess(sum(played.values()) - len(Cards.fromstr(repro['moves'][-1][1])), 8)
+
+        # A failure that doesn't happen again has no repro
+        calls = []
+
+        def check_once(deal, deck, played, plays_this_trick):
+            calls.append(1)
+            if len(calls) == 1:
+                raise fuzz.InvariantError("First play")
+
+        with mock.patch.object(fuzz, 'check', check_once):
+            self.assertEqual(fuzz.fuzz(1, players=[4]), [(0, 4, None, "First play")])
+
+
+class BenchmarkTest(TestCase):
+    def test_run_benchmarks(self):
+        import json
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from main import benchmark
+
+        dataset = benchmark.load_dataset()
+        for case in dataset['cases']:
+            self.assertEqual(benchmark.check(case), [], case['name'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            history = os.path.join(directory, 'history.ndjson')
+            call_command('run_benchmarks', runs=1, history=history, stdout=io.StringIO())
+            out = io.StringIO()
+            call_command('run_benchmarks', runs=1, history=history, stdout=out)
+            self.assertIn('was', out.getvalue())
+            with open(history) as f:
+                runs = [json.loads(line) for line in f]
+            self.assertEqual(len(runs), 2)
+            self.assertEqual(set(runs[1]['results']), set(case['name'] for case in dataset['cases']))
+
+            # A wrong result fails the run before anything is timed
+            dataset['cases'][0]['expected']['led'] = 'S3,S3'
+            path = os.path.join(directory, 'dataset.json')
+            with open(path, 'w') as f:
+                json.dump(dataset, f)
+            with self.assertRaises(CommandError):
+                call_command('run_benchmarks', dataset=path, history=history, stdout=io.StringIO())
+            with open(history) as f:
+                self.assertEqual(len(f.readlines()), 2)
@@ -1,10 +1,22 @@
-from django.http import HttpResponse
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 
 from django.shortcuts import render as django_render, redirect, get_object_or_404
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
 
+from main import tasks
+from main.coalesce import SingleFlight
+from main.forms import LoginForm
 from main.models import *
+from main.rules import DECK, Cards
+from main.sessions import get_session
 
 
 def render(request, template_name, additional=None):
@@ -26,19 +38,54 @@ def send_message(func):
     return wrapper
 
 
+_sprite_manifest = None
+
+
+def get_sprite_manifest():
+    global _sprite_manifest
+    if _sprite_manifest is None:
+        try:
+            with open(os.path.join(settings.SPRITES_ROOT, 'manifest.json')) as f:
+                _sprite_manifest = json.load(f)
+        except IOError:
+            _sprite_manifest = {}
+    return _sprite_manifest
+
+
+def sprite(request, filename):
+    manifest = get_sprite_manifest()
+    if filename not in (manifest.get('png'), manifest.get('css')):
+        raise Http404
+
+    with open(os.path.join(settings.SPRITES_ROOT, filename), 'rb') as f:
+        response = HttpResponse(f.read(), content_type='image/png' if filename.endswith('.png') else 'text/css')
+    # File names change with their content so they can be cached forever
+    response['Cache-Control'] = 'public, max-age=31536000'
+    return response
+
+
+def recent_games(user, count=10):
+    games = list(Game.objects.filter(gameplayer__player__user=user).order_by('-id')[:count])
+    if len(games) < count:
+        # Older games may have been archived
+        games.extend(ArchivedGame.objects.filter(archivedgameplayer__player__user=user)
+                     .order_by('-id')[:count - len(games)])
+    return games
+
+
 def home(request):
     if request.user.is_authenticated():
         return render(request, "home.html",
-                      {'games': Game.objects.filter(gameplayer__player__user=request.user).order_by('-id')[:10],
-                       'players': sorted(Player.objects.all(), key=lambda p: (-p.rank, -p.plus))})
+                      {'games': recent_games(request.user),
+                       'players': Player.objects.order_by('-rank', '-plus')})
 
     if request.method == "POST":
         form = LoginForm(request.POST)
         if form.is_valid():
             auth.login(request, form.cleaned_data['user'])
             return render(request, "home.html",
-                          {'games': Game.objects.filter(gameplayer__player__user=request.user).order_by('-id')[:10],
-                           'players': sorted(Player.objects.all(), key=lambda p: (-p.rank, -p.plus))})
+                          {'games': recent_games(request.user),
+                           'players': Player.objects.order_by('-rank', '-plus')})
     else:
         form = LoginForm()
 
@@ -47,8 +94,21 @@ def home(request):
 
 @login_required(login_url=home)
 def game(request, game_id):
-    game = get_object_or_404(Game, id=game_id)
+    try:
+        game = Game.objects.get(id=game_id)
+    except Game.DoesNotExist:
+        archived_game = get_object_or_404(ArchivedGame, id=game_id)
+        return render(request, "archived_game.html",
+                      {'game': archived_game, 'players': archived_game.archivedgameplayer_set.all(),
+                       'winner': 'Red' if archived_game.winner == DECLARERS else 'Blue'})
+    if not game.gameplayer_set.filter(player__user=request.user).exists():
+        return redirect(watch, game_id)
+
+    manifest = get_sprite_manifest()
     return render(request, "game.html", {'game': game, 'range': range(game.number_of_decks()),
+                                         'sprite': reverse('sprite', args=[manifest['css']]) if manifest else None,
+                                         'card_images': [card.image() for card in DECK],
+                                         'card_names': [str(card) for card in DECK],
                                          'suits': [(k, v) for k, v in SUIT_CHOICES
                                                    if k in NORMAL_SUITS and k != game.trump_suit],
                                          'ranks': [(k, v) for k, v in RANK_CHOICES
@@ -60,48 +120,223 @@ def logout(request):
     return redirect(home)
 
 
+COMPACT_STATUS_VERSION = 1
+
+
+def compact_response(request, data):
+    if request.GET.get('format') == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            pass
+        else:
+            return HttpResponse(msgpack.packb(data), content_type='application/x-msgpack')
+
+    response = HttpResponse(json.dumps(data, separators=(',', ':')), content_type='application/json')
+    # Compressing costs more than it saves on most polls, so clients ask for it with encoding=gzip
+    if request.GET.get('encoding') == 'gzip':
+        if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            response.content = compress_string(response.content)
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def public_state(game):
+    """Return the JSON state anyone may see, built once per version of the game."""
+    key = 'public_state:{}:{}'.format(game.id, game.version)
+    state = cache.get(key)
+    if state is None:
+        state = json.dumps(game.public_status(list(game.gameplayer_set.all())))
+        cache.set(key, state, getattr(settings, 'PUBLIC_STATE_TIMEOUT', 300))
+    return state
+
+
+def compact_status(data):
+    """Return a player's status as the positional arrays decoded by decodeStatus in game.html."""
+    return [
+        COMPACT_STATUS_VERSION,
+        int(data['stage']),
+        int(data['ready']),
+        int(data['turn']),
+        int(data['reserve']),
+        [data['status']['trump_rank'], data['status']['trump_suit'], data['status']['turn']],
+        [data['hand']['player'], [card['id'] for card in data['hand']['cards']],
+         [card['id'] for card in data['hand']['new_cards']]],
+        [[player['name'], int(player['ready']), player['team'], player['points'],
+          [card['id'] for card in player['cards']]] for player in data['players']],
+        data['friends'],
+        int(data['winner'] == 'Red'),
+        data['points'],
+    ]
+
+
 @login_required(login_url=home)
-def status(request, game_id):
+def watch(request, game_id):
     game = get_object_or_404(Game, id=game_id)
-    players = game.gameplayer_set.all()
-    player = game.gameplayer_set.get(player__user=request.user)
+    manifest = get_sprite_manifest()
+    return render(request, "watch.html", {'game': game,
+                                          'sprite': reverse('sprite', args=[manifest['css']]) if manifest else None,
+                                          'card_images': [card.image() for card in DECK]})
+
+
+@login_required(login_url=home)
+def spectate(request, game_id):
+    game = get_object_or_404(Game, id=game_id)
+    return HttpResponse(public_state(game), content_type='application/json')
+
+
+status_flight = SingleFlight()
+
+
+def start_bots(game, players=None):
+    """Let the bots move in the background if it's one of their turns."""
+    if game.bot_turn(players) is not None:
+        tasks.start_bots(game.id)
+
+
+def session_player(session, user):
+    player = session.player(user.username)
+    if player is None:
+        raise Http404
+    return player
 
+
+def deal_new_cards(game, player):
+    """Deal player their next card if it's their turn, returning the cards dealt."""
     new_cards = []
     if game.stage == Game.DEAL:
         new_card = game.deal(player)
         if new_card:
             new_cards.append(new_card.repr())
+    return new_cards
+
+
+def session_status(session, user):
+    """Return the player's status from the game in memory, or None for spectators."""
+    with session.lock:
+        game = session.game
+        player = session.player(user.username)
+        if player is None:
+            return None
+        new_cards = deal_new_cards(game, player)
+        data = game.player_status(player, session.players, new_cards=new_cards)
+        # The bots move in the background, outside the lock
+        start_bots(game, session.players)
+        return data
+
+
+def write_status(request, game_id):
+    """Return the player's status after dealing them a card, or None for spectators."""
+    game = get_object_or_404(Game, id=game_id)
+    try:
+        player = game.gameplayer_set.get(player__user=request.user)
+    except GamePlayer.DoesNotExist:
+        return None
+
+    new_cards = deal_new_cards(game, player)
+    players = list(game.gameplayer_set.all())
+    player = next(p for p in players if p.id == player.id)
+    data = game.player_status(player, players, new_cards=new_cards)
+    # In case the move that gave a bot its turn didn't start them; their moves show in a later poll
+    start_bots(game, players)
+    return data
+
+
+def status_response(request, data):
+    if request.GET.get('format') in ('compact', 'msgpack'):
+        response = compact_response(request, compact_status(data))
+    else:
+        response = HttpResponse(json.dumps(data), content_type='application/json')
+    response['X-Game-Version'] = data['version']
+    return response
 
-    return HttpResponse(json.dumps({
-        'stage': game.stage,
-        'ready': player.ready,
-        'turn': player.your_turn(),
-        'reserve': game.stage == Game.DEAL and player.your_turn() and len(player.get_hand()) == game.hand_size(),
-        'status': {
-            'trump_rank': game.get_trump_rank_display(),
-            'trump_suit': game.get_trump_suit_display(),
-            'turn': next((str(player) for player in players if player.your_turn()), '')
-        },
-        'hand': {
-            'player': str(player),
-            'str': ','.join(str(card) for card in sorted(player.get_hand().cards)),
-            'cards': [card.repr() for card in sorted(player.get_hand().cards,
-                                                     key=lambda c: (c.get_suit(game.trump_suit, game.trump_rank),
-                                                                    c.get_rank(game.trump_broken, game.trump_rank),
-                                                                    c.suit))],
-            'new_cards': new_cards,
-        },
-        'players': [{'name': str(player),
-                     'ready': player.ready,
-                     'team': player.team,
-                     'points': player.points,
-                     'cards': [card.repr()
-                               for card in sorted(Cards.fromstr(player.get_play().cards).cards)]
-        if player.play else []} for player in players],
-        'friends': game.number_of_friends() if game.find_friends else 0,
-        'winner': 'Red' if game.winner == DECLARERS else 'Blue',
-        'points': game.get_points(),
-    }), content_type='application/json')
+
+def poll_key(request, game_id):
+    return 'poll:{}:{}'.format(game_id, request.session.session_key)
+
+
+@login_required(login_url=home)
+def status(request, game_id):
+    # Polls are held to one per interval per client: later ones get the last response again,
+    # or an empty 304 when they send the version they have or there's no response to repeat
+    interval = getattr(settings, 'STATUS_MIN_POLL_INTERVAL', 1)
+    if not interval:
+        return poll_status(request, game_id)
+    key = poll_key(request, game_id)
+    encoding = (request.GET.get('format'), request.GET.get('encoding'))
+    if not cache.add(key, None, interval):
+        last = cache.get(key)
+        if request.GET.get('since') is None and last is not None and last[0] == encoding:
+            return last[1]
+        return HttpResponseNotModified()
+    response = poll_status(request, game_id)
+    if response.status_code == 200:
+        cache.set(key, (encoding, response), interval)
+    return response
+
+
+def poll_status(request, game_id):
+    since = request.GET.get('since')
+    session = get_session(game_id)
+    if session is not None:
+        data = session_status(session, request.user)
+        if data is None:
+            with session.lock:
+                public = session.game.public_status(session.players)
+            return HttpResponse(json.dumps(public), content_type='application/json')
+        return status_response(request, data)
+
+    # Polls are served from the projection unless there's dealing or a bot move to do
+    projection = GameProjection.objects.filter(game_id=game_id).first()
+    if projection is not None and not projection.writes:
+        if since == str(projection.version):
+            return HttpResponseNotModified()
+        data = projection.player_status(request.user.username)
+        if data is None:
+            return HttpResponse(projection.public, content_type='application/json')
+    else:
+        # Tabs of one player polling the same version share one computation
+        version = projection.version if projection is not None else None
+        data = status_flight.do((int(game_id), version, request.user.username), write_status, request, game_id)
+        if data is None:
+            return HttpResponse(public_state(Game.objects.get(id=game_id)), content_type='application/json')
+    return status_response(request, data)
+
+
+@login_required(login_url=home)
+def unseen(request, game_id):
+    session = get_session(game_id)
+    if session is not None:
+        with session.lock:
+            data = session.game.unseen(session_player(session, request.user))
+    else:
+        game = get_object_or_404(Game, id=game_id)
+        player = game.gameplayer_set.get(player__user=request.user)
+        data = game.unseen(player)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+@login_required(login_url=home)
+def review(request, game_id):
+    try:
+        game = Game.objects.get(id=game_id)
+        players = [str(player) for player in game.gameplayer_set.select_related('player__user')]
+        finished = game.stage == Game.SCORE
+    except Game.DoesNotExist:
+        game = get_object_or_404(ArchivedGame, id=game_id)
+        players = [str(player) for player in game.archivedgameplayer_set.select_related('player__user')]
+        finished = True
+
+    def stream():
+        # The kitty stays hidden until the game is over
+        yield '{{"game":{},"players":{},"kitty":{},"tricks":['.format(
+            game.id, json.dumps(players), json.dumps(game.kitty if finished else None))
+        for i, trick in enumerate(TrickHistory.objects.filter(game_id=game.id).iterator()):
+            yield (',' if i else '') + json.dumps(trick.repr(), separators=(',', ':'))
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
 
 
 @login_required(login_url=home)
@@ -112,27 +347,56 @@ def ready(request, game_id):
 
     if game.stage == Game.SETUP:
         game.ready(player)
+        start_bots(game)
+        cache.delete(poll_key(request, game_id))
+
+
+def get_int(request, name, default):
+    """Return the POST field name as an int, or None when it isn't one."""
+    try:
+        return int(request.POST.get(name, default))
+    except ValueError:
+        return None
 
 
 @login_required(login_url=home)
 def new_game(request):
     if request.method == "POST":
         players = [Player.objects.get(user__username=username) for username in request.POST.getlist('users')]
-        game = Game.setup(players)
-        if game:
-            return redirect(game)
-        else:
+        bots = get_int(request, 'bots', 0)
+        if bots is None or bots < 0 or len(players) + bots not in Game.SETTINGS:
             error = 'Only 4-8 players are allowed'
+        else:
+            game = Game.setup(players + Player.get_bots(bots), ruleset=request.POST.get('ruleset', STANDARD))
+            if game:
+                return redirect(game)
+            error = 'Unknown rules'
     else:
         error = None
-    return render(request, "new_game.html", {'users': User.objects.all(), 'error': error})
+    return render(request, "new_game.html", {'users': User.objects.filter(player__bot=False), 'error': error,
+                                             'bots': range(8), 'rulesets': RULESET_CHOICES})
 
 
 @login_required(login_url=home)
 @send_message
 def play(request, game_id):
+    # The page reloads after a move, which should show it rather than the last poll
+    cache.delete(poll_key(request, game_id))
+    session = get_session(game_id)
+    if session is not None:
+        with session.lock:
+            result = play_cards(request, session.game, session_player(session, request.user))
+            start_bots(session.game)
+        return result
+
     game = get_object_or_404(Game, id=game_id)
     player = game.gameplayer_set.get(player__user=request.user)
+    result = play_cards(request, game, player)
+    start_bots(game)
+    return result
+
+
+def play_cards(request, game, player):
     if request.method == "POST":
         cards = Cards.fromstr(request.POST['data']).cards
         if not cards:
@@ -149,9 +413,17 @@ def play(request, game_id):
 @login_required(login_url=home)
 def reserve(request, game_id):
     if request.method == "POST":
-        game = get_object_or_404(Game, id=game_id)
-        player = game.gameplayer_set.get(player__user=request.user)
-        game.pickup_reserve(player)
+        cache.delete(poll_key(request, game_id))
+        session = get_session(game_id)
+        if session is not None:
+            with session.lock:
+                session.game.pickup_reserve(session_player(session, request.user))
+                start_bots(session.game)
+        else:
+            game = get_object_or_404(Game, id=game_id)
+            player = game.gameplayer_set.get(player__user=request.user)
+            game.pickup_reserve(player)
+            start_bots(game)
     return HttpResponse()
 
 
@@ -163,3 +435,38 @@ def rematch(request, game_id):
         if new_game:
             return HttpResponse(new_game.get_absolute_url())
     return HttpResponse()
+
+
+@login_required(login_url=home)
+def profile(request, username):
+    player = get_object_or_404(Player, user__username=username)
+    try:
+        stats = player.stats
+    except PlayerStats.DoesNotExist:
+        stats = PlayerStats(player=player)
+    return render(request, "profile.html", {'player': player, 'stats': stats})
+
+
+@login_required(login_url=home)
+def new_tournament(request):
+    if request.method == "POST":
+        players = [Player.objects.get(user__username=username) for username in request.POST.getlist('users')]
+        rounds = get_int(request, 'rounds', 3)
+        if rounds is None or rounds < 1:
+            error = 'Rounds has to be a whole number of at least 1'
+        else:
+            tournament = Tournament.create(request.POST.get('name') or 'Tournament', players, rounds=rounds)
+            if tournament:
+                return redirect(tournament)
+            error = Tournament.seating_error(len(players))
+    else:
+        error = None
+    return render(request, "new_tournament.html", {'users': User.objects.all(), 'error': error})
+
+
+@login_required(login_url=home)
+def tournament(request, tournament_id):
+    tournament = get_object_or_404(Tournament, id=tournament_id)
+    return render(request, "tournament.html",
+                  {'tournament': tournament, 'standings': tournament.standings(),
+                   'tables': tournament.tables.filter(round=tournament.round).select_related('game')})